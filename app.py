@@ -9,11 +9,38 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError, TelegramNotFound
 import asyncio
 import datetime
 from PIL import Image, ImageDraw, ImageFont
 import os
 import pathlib
+import sys
+import gc
+import threading
+import time
+import array
+import collections.abc
+import itertools
+import struct
+import zlib
+import gzip
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import io
+import bisect
+import heapq
+import contextlib
+import contextvars
+import hmac
+import signal
+import aiohttp
+from aiohttp import web
 
 def safe_print(text: str):
     try:
@@ -28,15 +55,151 @@ def is_admin(user_id: int) -> bool:
     """проверяет, является ли пользователь админом"""
     return user_id in ADMIN_IDS
 
+# === кэш проверки подписки ===
+# кнопку бонуса жмут снова и снова, пока идёт кулдаун, и каждое нажатие было запросом
+# get_chat_member. теперь ответ хранится по игроку SUBSCRIPTION_TTL секунд, отказ - меньше
+# (SUBSCRIPTION_NEGATIVE_TTL), чтобы только что подписавшийся не ждал. одновременные проверки
+# одного игрока сливаются в один запрос, а если бот админ в канале, обновления chat_member
+# меняют запись сразу. ошибки телеграма не кэшируются
+SUBSCRIPTION_CHANNEL = 'daisicx'
+SUBSCRIPTION_TTL = float(os.getenv('SUBSCRIPTION_TTL', '600'))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))
+SUBSCRIPTION_CACHE_LIMIT = 100000
+
+class SubscriptionCache:
+    """подписан ли игрок на канал, с ограниченным временем жизни ответа"""
+
+    def __init__(self):
+        self.entries = {}  # user_id -> (подписан, годен до, когда записан) по monotonic
+        self.pending = {}  # user_id -> задача запроса, который уже идёт
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.updates = 0
+
+    def _store(self, user_id: int, subscribed: bool, now: float):
+        if len(self.entries) >= SUBSCRIPTION_CACHE_LIMIT and user_id not in self.entries:
+            self.entries = {uid: entry for uid, entry in self.entries.items() if entry[1] > now}
+        ttl = SUBSCRIPTION_TTL if subscribed else SUBSCRIPTION_NEGATIVE_TTL
+        self.entries[user_id] = (subscribed, now + ttl, now)
+
+    async def _fetch(self, user_id: int) -> bool:
+        started = time.monotonic()
+        try:
+            member = await bot.get_chat_member(chat_id=f'@{SUBSCRIPTION_CHANNEL}', user_id=user_id)
+        except Exception as e:
+            print(f"ошибка проверки подписки: {e}")
+            return False
+        finally:
+            self.pending.pop(user_id, None)
+        subscribed = member.status not in ['left', 'kicked']
+        entry = self.entries.get(user_id)
+        # пока шёл запрос, могло прийти обновление из канала - оно свежее
+        if entry is None or entry[2] < started:
+            self._store(user_id, subscribed, time.monotonic())
+        return subscribed
+
+    async def check(self, user_id: int) -> bool:
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        task = self.pending.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = self.pending[user_id] = asyncio.ensure_future(self._fetch(user_id))
+        else:
+            self.coalesced += 1
+        # shield: если один из ждущих отменён, запрос для остальных продолжается
+        return await asyncio.shield(task)
+
+    def update(self, user_id: int, subscribed: bool):
+        """свежий статус из обновления chat_member"""
+        self.updates += 1
+        self._store(user_id, subscribed, time.monotonic())
+
+subscription_cache = SubscriptionCache()
+
 async def check_channel_subscription(user_id: int) -> bool:
     """проверяет, подписан ли пользователь на канал @daisicx"""
-    try:
-        # Проверяем подписку на канал @daisicx
-        member = await bot.get_chat_member(chat_id='@daisicx', user_id=user_id)
-        return member.status not in ['left', 'kicked']
-    except Exception as e:
-        print(f"ошибка проверки подписки: {e}")
-        return False
+    return await subscription_cache.check(user_id)
+
+# === кэш данных телеграма ===
+# юзернейм бота нужен для каждой реферальной ссылки, и за ним каждый раз ходили в get_me,
+# а id основного чата разрешался по юзернейму прямо посреди рассылки. теперь данные бота
+# берутся один раз при старте, юзернеймы чатов переводятся в id и хранятся CHAT_ID_TTL
+# секунд, а одинаковые запросы, пришедшие одновременно, сливаются в один
+CHAT_ID_TTL = 86400
+CHAT_ID_NEGATIVE_TTL = 300  # не нашли чат - спросим снова через 5 минут
+
+class TelegramMetadata:
+    """данные бота и id чатов по юзернейму без лишних запросов"""
+
+    def __init__(self):
+        self.me = None
+        self.chats = {}  # юзернейм в нижнем регистре -> (id или None, годен до по monotonic)
+        self.pending = {}  # ключ запроса -> задача, которая уже идёт
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def bot_username(self) -> str | None:
+        return self.me.username if self.me is not None else None
+
+    def chat_id(self, username: str) -> int | None:
+        """id чата из кэша, без запроса"""
+        entry = self.chats.get(username.lstrip('@').lower())
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    async def _once(self, key, factory):
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = self.pending[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def get_me(self) -> types.User:
+        if self.me is not None:
+            self.hits += 1
+            return self.me
+        self.me = await self._once('me', bot.get_me)
+        return self.me
+
+    async def _fetch_chat(self, key: str) -> int | None:
+        try:
+            chat = await bot.get_chat(f'@{key}')
+            chat_id, ttl = int(chat.id), CHAT_ID_TTL
+        except Exception as e:
+            print(f"⚠️ Не удалось найти чат @{key}: {e}")
+            chat_id, ttl = None, CHAT_ID_NEGATIVE_TTL
+        self.chats[key] = (chat_id, time.monotonic() + ttl)
+        return chat_id
+
+    async def resolve_chat(self, username: str) -> int | None:
+        key = username.lstrip('@').lower()
+        entry = self.chats.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        return await self._once(('chat', key), lambda: self._fetch_chat(key))
+
+    async def warm_up(self):
+        """заранее берём то, что нужно обработчикам: данные бота и id основного чата"""
+        try:
+            me = await self.get_me()
+            print(f"🤖 Бот @{me.username}")
+        except Exception as e:
+            print(f"⚠️ Не удалось получить данные бота: {e}")
+        if MAIN_CHAT_ID is None and MAIN_CHAT_USERNAME:
+            await self.resolve_chat(MAIN_CHAT_USERNAME)
+
+telegram_metadata = TelegramMetadata()
 
 def update_roulette_history(user_id: str, amount: int, bet_type: str):
     """
@@ -80,7 +243,12 @@ if not API_TOKEN:
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=API_TOKEN)
+# свой сервер Bot API: локальный telegram-bot-api или заглушка для нагрузочных прогонов
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER', '')
+if TELEGRAM_API_SERVER:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)))
+else:
+    bot = Bot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
@@ -123,6 +291,7 @@ TRANSFER_COMMISSION_TOP20 = 20
 BANK_MAX_DEPOSIT = 1_000_000_000_000_000_000_000_000
 
 # Система промокодов
+PROMO_CODES_FILE = 'promo_codes.json'
 promo_codes = {}  # {code: {'reward': amount, 'activations': max_activations, 'current_activations': 0, 'expiry': timestamp, 'created_by': admin_id}}
 
 # Система работы грузчика
@@ -148,92 +317,2661 @@ cargo_types = [
     {'name': 'антиквариат', 'weight': 'средний', 'time': 35, 'payment': 3500000000, 'emoji': '🏺', 'super_rare': True},
 ]
 
-def load_users():
-    """Загружает пользователей из JSON файла"""
+# === номер шарда ===
+# при SHARD_WORKERS>0 обновления обрабатывают несколько процессов-воркеров (см. "шардирование
+# по игрокам"). каждый воркер получает от фронта SHARD_COUNT и свой SHARD_INDEX и владеет
+# игроками с user_id % SHARD_COUNT == SHARD_INDEX: только он пишет их в базу. админы всегда
+# живут на шарде 0 - их команды трогают чужие данные и глобальные настройки
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))  # сколько воркеров запускает фронт, 0 - один процесс
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))  # задаёт фронт воркерам, 0 - не шард
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+
+_shard_outbox = []  # сообщения другим шардам, отправленные до подключения к фронту
+
+def shard_for(user_id, count: int) -> int:
+    """номер шарда игрока при count шардах; без id (служебные обновления) - шард 0"""
     try:
-        with open(DB_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            
-            # Исправляем базу данных: убираем дубликаты и неправильные записи
-            fixed_data = {}
-            
-            for user_id, user_data in data.items():
-                # Конвертируем user_id в строку для единообразия
-                user_id_str = str(user_id)
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return 0
+    return 0 if user_id in ADMIN_IDS else user_id % count
+
+def shard_of(user_id) -> int:
+    """номер шарда, который владеет игроком"""
+    return shard_for(user_id, SHARD_COUNT) if SHARD_COUNT else 0
+
+def shard_owns(user_id) -> bool:
+    return not SHARD_COUNT or shard_of(user_id) == SHARD_INDEX
+
+def shard_local_path(path: str) -> str:
+    """свой файл на каждый шард для локальных кэшей (file_id, недоступные получатели)"""
+    if not SHARD_COUNT or not SHARD_INDEX:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{SHARD_INDEX}{ext}'
+
+def _shard_send(to, message: dict):
+    """отправляет сообщение шарду to (номер или '*' - всем остальным) через фронт"""
+    link = globals().get('shard_link')
+    if link is not None and link.connected:
+        link.send(to, message)
+    else:
+        _shard_outbox.append((to, message))
+
+# === журнал изменений пользователей ===
+# вместо полной перезаписи users_db.json на каждый спин дописываем в журнал только изменённые поля,
+# а снапшот пересобираем в фоне, когда журнал разрастётся
+JOURNAL_FILE = 'users_journal.jsonl'
+JOURNAL_COMPACT_MAX_BYTES = 8 * 1024 * 1024  # сворачиваем журнал, когда он больше 8 мб
+JOURNAL_COMPACT_INTERVAL = 600  # или раз в 10 минут, если в нём что-то есть
+JOURNAL_CHECK_INTERVAL = 30  # как часто компактор проверяет журнал
+JOURNAL_ARCHIVE_DIR = os.path.join('backup', 'journal')  # свёрнутые куски журнала для восстановления на момент времени
+USERS_META_KEY = '_meta'  # служебный ключ снапшота (версия схемы), пользователем не является
+
+_pending_mutations = []  # [(op, user_id, field, value, reason)] изменения, ещё не отданные хранилищу
+_pending_reasoned = 0  # сколько первых изменений уже помечены причиной
+_backup_changed = set()  # user_id, изменённые после последней резервной копии (для инкрементальных копий)
+_backup_full_needed = True  # следующая копия должна быть полной: старт бота или очистка базы
+
+def _record_mutation(op: str, user_id, field=None, value=None, reason=None):
+    """запоминает изменение пользователя до ближайшего сохранения"""
+    global _backup_full_needed
+    if op != 'reset' and not shard_owns(user_id):
+        # чужой игрок: у себя поменяли только копию, а в базу его запишет владелец
+        _shard_send(shard_of(user_id), {'t': 'op', 'op': op, 'uid': user_id, 'field': field, 'value': value})
+        return
+    _pending_mutations.append((op, user_id, field, value, reason))
+    if op == 'reset':
+        _backup_full_needed = True
+    else:
+        _backup_changed.add(user_id)
+
+def _tag_pending_mutations(reason: str):
+    """помечает причиной изменения, накопленные с прошлого save_users()"""
+    global _pending_reasoned
+    for i in range(_pending_reasoned, len(_pending_mutations)):
+        op, user_id, field, value, own_reason = _pending_mutations[i]
+        if own_reason is None:  # причину, указанную при изменении (леджер), не перетираем
+            _pending_mutations[i] = (op, user_id, field, value, reason)
+    _pending_reasoned = len(_pending_mutations)
+
+# === копирование при записи для фонового снапшота ===
+# пока поток пишет снапшот, обработчики продолжают менять users. перед первым изменением
+# пользователя во время снапшота сохраняем его прежнее состояние, и поток берёт его оттуда -
+# так снапшот соответствует моменту старта, а копируются только изменённые записи
+_snapshot_cow = None  # {user_id: прежняя запись или _SNAPSHOT_ABSENT}, None - снапшот не пишется
+_snapshot_lock = threading.Lock()
+_SNAPSHOT_ABSENT = object()
+
+def _cow_preserve(user_id, user_data):
+    """запоминает состояние пользователя на момент старта снапшота (только первый раз)"""
+    with _snapshot_lock:
+        if _snapshot_cow is not None and user_id not in _snapshot_cow:
+            _snapshot_cow[user_id] = dict(user_data) if user_data is not None else _SNAPSHOT_ABSENT
+
+def _begin_users_snapshot():
+    global _snapshot_cow
+    with _snapshot_lock:
+        _snapshot_cow = {}
+
+def _end_users_snapshot() -> int:
+    """выключает копирование при записи, возвращает сколько записей пришлось скопировать"""
+    global _snapshot_cow
+    with _snapshot_lock:
+        copied = len(_snapshot_cow or ())
+        _snapshot_cow = None
+    return copied
+
+def _snapshot_read(user_id, current: dict):
+    """читает пользователя в состоянии на момент старта снапшота (вызывается из потока записи)"""
+    with _snapshot_lock:
+        if _snapshot_cow is not None:
+            preserved = _snapshot_cow.get(user_id)
+            if preserved is not None:
+                return None if preserved is _SNAPSHOT_ABSENT else preserved
+        live = dict.get(current, user_id)
+        return dict(live) if live is not None else None
+
+# === компактная запись пользователя ===
+# словарь на ~35 ключей на каждого пользователя - это килобайты на человека. частые поля
+# лежат в слотах, а поля профиля, которые почти у всех равны значению по умолчанию
+# (телефон, почта, город, настройки...), хранятся только если отличаются от него -
+# в маленьком словаре _extra вместе с редкими полями вроде ban_reason.
+# снаружи запись ведёт себя как словарь, поэтому обработчики работают с ней как раньше
+USER_SLOT_FIELDS = (
+    'nick', 'tg_username', 'balance', 'bank_deposit', 'bank_deposit_time', 'last_bonus_time',
+    'warns', 'banned', 'referrals', 'referral_earnings', 'total_messages', 'login_count',
+    'language', 'registration_date', 'last_activity', 'last_login',
+)
+USER_SPARSE_DEFAULTS = {
+    'phone_number': None,
+    'email': None,
+    'age': None,
+    'city': None,
+    'country': None,
+    'device_info': None,
+    'ip_address': None,
+    'referral_source': 'direct',
+    'account_type': 'regular',
+    'verification_status': 'unverified',
+    'security_level': 'basic',
+    'premium_features': False,
+    'session_duration': 0,
+    'preferences': {
+        'notifications': True,
+        'privacy_mode': False,
+        'auto_save': True
+    },
+}
+_USER_SLOT_SET = frozenset(USER_SLOT_FIELDS)
+_MISSING = object()
+
+def _is_sparse_default(key, value) -> bool:
+    default = USER_SPARSE_DEFAULTS.get(key, _MISSING)
+    return default is not _MISSING and type(value) is type(default) and value == default
+
+def _sparse_default(key):
+    default = USER_SPARSE_DEFAULTS[key]
+    # изменяемое значение по умолчанию отдаём копией, чтобы его не испортили у всех сразу
+    return dict(default) if isinstance(default, dict) else default
+
+class UserRecord:
+    """запись пользователя со слотами вместо словаря; изменения уходят в журнал"""
+    __slots__ = ('uid', '_extra') + USER_SLOT_FIELDS
+
+    def __init__(self, uid: str, data=()):
+        self.uid = uid
+        self._extra = None
+        for key, value in (data.items() if hasattr(data, 'items') else data):
+            self._raw_set(key, value)
+
+    # --- запись без журнала (загрузка, накат журнала) ---
+    def _raw_set(self, key, value):
+        if key in _USER_SLOT_SET:
+            setattr(self, key, value)
+            return
+        extra = self._extra
+        if _is_sparse_default(key, value):
+            if extra is not None:
+                extra.pop(key, None)
+            return
+        if extra is None:
+            extra = self._extra = {}
+        extra[key] = value
+
+    def _raw_del(self, key) -> bool:
+        if key in _USER_SLOT_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                return False
+            return True
+        extra = self._extra
+        if extra is not None and key in extra:
+            del extra[key]
+            return True
+        # поле со значением по умолчанию удалить нельзя - оно просто остаётся по умолчанию
+        return key in USER_SPARSE_DEFAULTS
+
+    # --- словарный интерфейс ---
+    def __getitem__(self, key):
+        if key in _USER_SLOT_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        if key in USER_SPARSE_DEFAULTS:
+            return _sparse_default(key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in _USER_SLOT_SET:
+            return getattr(self, key, default)
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        if key in USER_SPARSE_DEFAULTS:
+            return _sparse_default(key)
+        return default
+
+    def __contains__(self, key):
+        if key in _USER_SLOT_SET:
+            return hasattr(self, key)
+        return key in USER_SPARSE_DEFAULTS or (self._extra is not None and key in self._extra)
+
+    def __setitem__(self, key, value):
+        if _snapshot_cow is not None:
+            _cow_preserve(self.uid, self)
+        if key in _USER_INDEXED_SET:
+            user_index.changed(self, key, self.get(key), value)
+        elif key == 'balance':
+            _notify_balance(self, self.get('balance', 0), value)
+        self._raw_set(key, value)
+        if key in _DEPOSIT_FIELDS:
+            deposit_index.changed(self)
+        _record_mutation('set', self.uid, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if _snapshot_cow is not None:
+            _cow_preserve(self.uid, self)
+        if key in _USER_INDEXED_SET:
+            user_index.changed(self, key, self.get(key), None)
+        elif key == 'balance':
+            _notify_balance(self, self.get('balance', 0), 0)
+        self._raw_del(key)
+        if key in _DEPOSIT_FIELDS:
+            deposit_index.changed(self)
+        _record_mutation('unset', self.uid, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def keys(self):
+        result = [key for key in USER_SLOT_FIELDS if hasattr(self, key)]
+        extra = self._extra
+        if extra is not None:
+            result.extend(extra)
+            result.extend(key for key in USER_SPARSE_DEFAULTS if key not in extra)
+        else:
+            result.extend(USER_SPARSE_DEFAULTS)
+        return result
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    copy = to_dict
+
+    def __eq__(self, other):
+        if isinstance(other, (UserRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'UserRecord({self.uid!r}, {self.to_dict()!r})'
+
+collections.abc.MutableMapping.register(UserRecord)
+
+class UsersTable(dict):
+    """словарь всех пользователей: оборачивает записи в UserRecord и журналирует добавления/удаления"""
+
+    @classmethod
+    def wrap(cls, data: dict) -> 'UsersTable':
+        """собирает таблицу из обычного словаря без записи в журнал"""
+        table = cls()
+        for user_id, user_data in data.items():
+            if not isinstance(user_data, UserRecord) or user_data.uid != user_id:
+                user_data = UserRecord(user_id, user_data)
+            dict.__setitem__(table, user_id, user_data)
+        return table
+
+    def __setitem__(self, user_id, user_data):
+        user_data = self._store(user_id, user_data)
+        _record_mutation('put', user_id, None, dict(user_data))
+
+    def __delitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._drop(user_id)
+        _record_mutation('del', user_id)
+
+    def pop(self, user_id, *default):
+        if user_id in self:
+            user_data = self._drop(user_id)
+            _record_mutation('del', user_id)
+            return user_data
+        return dict.pop(self, user_id, *default)
+
+    def clear(self):
+        self._clear()
+        _record_mutation('reset', None)
+
+    def replicate(self, user_id, user_data):
+        """обновляет копию чужого игрока по данным его шарда (None - удалён), без журнала"""
+        if user_data is None:
+            if user_id in self:
+                self._drop(user_id)
+        else:
+            self._store(user_id, user_data)
+        # резервные копии делает шард 0 - пусть и чужие изменения попадают в инкрементальную
+        _backup_changed.add(user_id)
+
+    # --- изменения без журнала: индексы и копирование при записи ---
+    def _store(self, user_id, user_data) -> UserRecord:
+        if not isinstance(user_data, UserRecord) or user_data.uid != user_id:
+            user_data = UserRecord(user_id, user_data)
+        if _snapshot_cow is not None:
+            _cow_preserve(user_id, dict.get(self, user_id))
+        if self is user_index.table:
+            user_index.remove_record(dict.get(self, user_id))
+            user_index.add_record(user_data)
+        dict.__setitem__(self, user_id, user_data)
+        if self is leaderboard.table:
+            # при замене записи порядок среди равных балансов сохраняется, как позиция ключа в dict
+            if user_id in leaderboard.keys:
+                leaderboard.changed(user_data, None, user_data.get('balance', 0))
+            else:
+                leaderboard.add_record(user_data)
+        if self is deposit_index.table:
+            deposit_index.add_record(user_data)
+        return user_data
+
+    def _drop(self, user_id):
+        if _snapshot_cow is not None:
+            _cow_preserve(user_id, dict.get(self, user_id))
+        if self is user_index.table:
+            user_index.remove_record(dict.get(self, user_id))
+        if self is leaderboard.table:
+            leaderboard.remove(user_id)
+        if self is deposit_index.table:
+            deposit_index.remove(user_id)
+        return dict.pop(self, user_id)
+
+    def _clear(self):
+        if _snapshot_cow is not None:
+            for user_id, user_data in dict.items(self):
+                _cow_preserve(user_id, user_data)
+        if self is user_index.table:
+            user_index.reset()
+        if self is leaderboard.table:
+            leaderboard.reset()
+        if self is deposit_index.table:
+            deposit_index.reset()
+        dict.clear(self)
+
+# === индексы пользователей по юзернейму и нику ===
+# переводы, админские команды и проверка занятости ника искали пользователя перебором
+# всей базы. теперь для живой таблицы users ведутся словари "юзернейм/ник без учёта
+# регистра -> user_id", которые обновляются при каждом изменении этих полей
+USER_INDEXED_FIELDS = ('tg_username', 'nick')
+_USER_INDEXED_SET = frozenset(USER_INDEXED_FIELDS)
+_USER_INDEX_PLACEHOLDERS = frozenset({'', 'без_юз'})  # заглушки вместо юзернейма не индексируем
+
+def _user_index_key(value) -> str | None:
+    if not isinstance(value, str):
+        return None
+    key = value.casefold()
+    return None if key in _USER_INDEX_PLACEHOLDERS else key
+
+class UserIndex:
+    """регистронезависимые индексы поле -> ключ -> user_id для таблицы users"""
+
+    def __init__(self):
+        self.table = None
+        self.maps = {field: {} for field in USER_INDEXED_FIELDS}
+        # один ключ у нескольких пользователей (старый юзернейм, дубль ника): остальные id здесь
+        self.dupes = {field: {} for field in USER_INDEXED_FIELDS}
+
+    def reset(self):
+        for field in USER_INDEXED_FIELDS:
+            self.maps[field].clear()
+            self.dupes[field].clear()
+
+    def rebuild(self, table: dict):
+        """привязывает индекс к таблице и строит его заново"""
+        self.table = table
+        self.reset()
+        # на старте это миллион записей: без вызова _add на каждую
+        placeholders = _USER_INDEX_PLACEHOLDERS
+        for field in USER_INDEXED_FIELDS:
+            index = self.maps[field]
+            dupes = self.dupes[field]
+            slot = getattr(UserRecord, field) if field in _USER_SLOT_SET else None
+            for user_id, user_data in dict.items(table):
+                try:
+                    value = slot.__get__(user_data) if slot is not None and type(user_data) is UserRecord else user_data.get(field)
+                except AttributeError:
+                    continue
+                if type(value) is not str:
+                    continue
+                key = value.casefold()
+                if key in placeholders:
+                    continue
+                owner = index.setdefault(key, user_id)
+                if owner != user_id:
+                    dupes.setdefault(key, set()).add(user_id)
+
+    def _registration_order(self, user_id: str):
+        """порядок регистрации - позиция в таблице, как у прежнего перебора (её помнит рейтинг)"""
+        if leaderboard.table is self.table:
+            key = leaderboard.keys.get(user_id)
+            if key is not None:
+                return (0, key[1], user_id)
+        # ещё не попал в рейтинг - значит, добавлен только что
+        return (1, 0, user_id)
+
+    def _add(self, field: str, user_id: str, value):
+        key = _user_index_key(value)
+        if key is None:
+            return
+        index = self.maps[field]
+        owner = index.get(key)
+        if owner is None:
+            index[key] = user_id
+        elif owner != user_id:
+            # ключ достаётся тому, кто зарегистрирован раньше, остальные ждут в дублях
+            if self._registration_order(user_id) < self._registration_order(owner):
+                index[key], user_id = user_id, owner
+            self.dupes[field].setdefault(key, set()).add(user_id)
+
+    def _remove(self, field: str, user_id: str, value):
+        key = _user_index_key(value)
+        if key is None:
+            return
+        index = self.maps[field]
+        dupes = self.dupes[field]
+        if index.get(key) == user_id:
+            others = dupes.get(key)
+            if others:
+                # ключ переходит к следующему по времени регистрации, как нашёл бы перебор
+                owner = min(others, key=self._registration_order)
+                others.discard(owner)
+                index[key] = owner
+                if not others:
+                    del dupes[key]
+            else:
+                del index[key]
+        elif key in dupes:
+            dupes[key].discard(user_id)
+            if not dupes[key]:
+                del dupes[key]
+
+    def add_record(self, user_data):
+        if user_data is None:
+            return
+        for field in USER_INDEXED_FIELDS:
+            self._add(field, user_data.uid, user_data.get(field))
+
+    def remove_record(self, user_data):
+        if user_data is None:
+            return
+        for field in USER_INDEXED_FIELDS:
+            self._remove(field, user_data.uid, user_data.get(field))
+
+    def changed(self, user_data, field: str, old_value, new_value):
+        """вызывается из UserRecord при изменении юзернейма или ника"""
+        table = self.table
+        # записи, которых уже нет в живой таблице, индекс не трогают
+        if table is None or dict.get(table, user_data.uid) is not user_data:
+            return
+        self._remove(field, user_data.uid, old_value)
+        self._add(field, user_data.uid, new_value)
+
+    def find(self, field: str, value) -> str | None:
+        key = _user_index_key(value)
+        if key is None:
+            return None
+        return self.maps[field].get(key)
+
+    def check(self) -> list[str]:
+        """сверяет индекс с таблицей, возвращает список расхождений"""
+        problems = []
+        table = self.table
+        if table is None:
+            return ['индекс не привязан к таблице']
+        for field in USER_INDEXED_FIELDS:
+            index = self.maps[field]
+            dupes = self.dupes[field]
+            # каждый пользователь с юзернеймом/ником должен находиться по своему ключу
+            for user_id, user_data in dict.items(table):
+                key = _user_index_key(user_data.get(field))
+                if key is not None and index.get(key) != user_id and user_id not in dupes.get(key, ()):
+                    problems.append(f'{field}: {user_id} ({key!r}) нет в индексе')
+            # и в индексе не должно остаться устаревших ключей
+            for key, user_id in itertools.chain(index.items(),
+                                                ((key, user_id) for key, others in dupes.items() for user_id in others)):
+                user_data = dict.get(table, user_id)
+                if user_data is None or _user_index_key(user_data.get(field)) != key:
+                    problems.append(f'{field}: устаревший ключ {key!r} -> {user_id}')
+            for key in dupes:
+                if key not in index:
+                    problems.append(f'{field}: {key!r} есть в дублях, но нет в индексе')
+        return problems
+
+user_index = UserIndex()
+
+def find_user_id(username: str | None = None, nick: str | None = None) -> str | None:
+    """находит пользователя по юзернейму (без @) или по нику без учёта регистра.
+
+    если подходят разные пользователи, побеждает совпадение по юзернейму
+    """
+    if username is not None:
+        user_id = user_index.find('tg_username', username)
+        if user_id is not None:
+            return user_id
+    if nick is not None:
+        return user_index.find('nick', nick)
+    return None
+
+# === рейтинг по балансу ===
+# топ, место игрока и "входит ли в топ-N" раньше каждый раз сортировали всю базу
+# (на 100к игроков это ~50 мс на каждую ставку в рулетке). теперь балансы живой
+# таблицы лежат в отсортированном списке из корзин: ключ ищется бисекцией, вставка
+# сдвигает только одну корзину, а дерево Фенвика над размерами корзин даёт точное
+# место за O(log n). при равных балансах порядок как у прежней стабильной сортировки -
+# в порядке добавления пользователей в базу
+LEADERBOARD_BUCKET = 512  # целевой размер корзины; при удвоении корзина делится пополам
+
+def _leaderboard_balance(value):
+    # в базе встречаются пустые и строковые балансы - в рейтинге они считаются нулём
+    return value if type(value) is int or type(value) is float else 0
+
+class Leaderboard:
+    """рейтинг пользователей по убыванию баланса с обновлением и поиском места за O(log n)"""
+
+    def __init__(self):
+        self.table = None
+        self.keys = {}       # user_id -> (-баланс, порядковый номер, user_id)
+        self._buckets = []   # отсортированные корзины ключей
+        self._maxes = []     # последний ключ каждой корзины
+        self._tree = []      # дерево Фенвика по размерам корзин
+        self._seq = 0
+
+    def reset(self):
+        self.keys.clear()
+        self._buckets = []
+        self._maxes = []
+        self._tree = []
+        self._seq = 0
+
+    def rebuild(self, table: dict):
+        """привязывает рейтинг к таблице и строит его заново"""
+        self.table = table
+        self.reset()
+        slot = UserRecord.balance
+        entries = []
+        for seq, (user_id, user_data) in enumerate(dict.items(table)):
+            try:
+                balance = slot.__get__(user_data) if type(user_data) is UserRecord else user_data.get('balance', 0)
+            except AttributeError:
+                balance = 0
+            entries.append((-_leaderboard_balance(balance), seq, user_id))
+        self._seq = len(entries)
+        self.keys = {key[2]: key for key in entries}
+        entries.sort()
+        size = LEADERBOARD_BUCKET
+        self._buckets = [entries[i:i + size] for i in range(0, len(entries), size)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._build_tree()
+
+    def _build_tree(self):
+        tree = [len(bucket) for bucket in self._buckets]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, pos: int, delta: int):
+        tree = self._tree
+        while pos < len(tree):
+            tree[pos] += delta
+            pos |= pos + 1
+
+    def _tree_prefix(self, pos: int) -> int:
+        """сколько ключей лежит в корзинах до pos (не включая её)"""
+        tree = self._tree
+        total = 0
+        pos -= 1
+        while pos >= 0:
+            total += tree[pos]
+            pos = (pos & (pos + 1)) - 1
+        return total
+
+    def _insert(self, key):
+        buckets = self._buckets
+        maxes = self._maxes
+        if not buckets:
+            buckets.append([key])
+            maxes.append(key)
+            self._build_tree()
+            return
+        pos = bisect.bisect_left(maxes, key)
+        if pos == len(maxes):
+            pos -= 1
+            buckets[pos].append(key)
+            maxes[pos] = key
+        else:
+            bisect.insort(buckets[pos], key)
+        bucket = buckets[pos]
+        if len(bucket) > 2 * LEADERBOARD_BUCKET:
+            half = len(bucket) >> 1
+            buckets.insert(pos + 1, bucket[half:])
+            del bucket[half:]
+            maxes[pos] = bucket[-1]
+            maxes.insert(pos + 1, buckets[pos + 1][-1])
+            self._build_tree()
+        else:
+            self._tree_add(pos, 1)
+
+    def _remove(self, key):
+        buckets = self._buckets
+        maxes = self._maxes
+        pos = bisect.bisect_left(maxes, key)
+        bucket = buckets[pos]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            maxes[pos] = bucket[-1]
+            self._tree_add(pos, -1)
+        else:
+            del buckets[pos]
+            del maxes[pos]
+            self._build_tree()
+
+    def add_record(self, user_data):
+        if user_data is None:
+            return
+        self.remove(user_data.uid)
+        key = (-_leaderboard_balance(user_data.get('balance', 0)), self._seq, user_data.uid)
+        self._seq += 1
+        self.keys[user_data.uid] = key
+        self._insert(key)
+
+    def remove(self, user_id: str):
+        key = self.keys.pop(user_id, None)
+        if key is not None:
+            self._remove(key)
+
+    def changed(self, user_data, old_balance, new_balance):
+        """слушатель изменения баланса (см. BALANCE_LISTENERS)"""
+        table = self.table
+        if table is None or dict.get(table, user_data.uid) is not user_data:
+            return
+        user_id = user_data.uid
+        old_key = self.keys.get(user_id)
+        new_value = -_leaderboard_balance(new_balance)
+        if old_key is None:
+            self.add_record(user_data)
+            return
+        if old_key[0] == new_value:
+            return
+        # порядковый номер сохраняется: при равенстве балансов место не зависит от истории ставок
+        new_key = (new_value, old_key[1], user_id)
+        self._remove(old_key)
+        self.keys[user_id] = new_key
+        self._insert(new_key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rank(self, user_id: str) -> int | None:
+        """точное место пользователя (с единицы) среди всех игроков"""
+        key = self.keys.get(user_id)
+        if key is None:
+            return None
+        pos = bisect.bisect_left(self._maxes, key)
+        return self._tree_prefix(pos) + bisect.bisect_left(self._buckets[pos], key) + 1
+
+    def in_top(self, user_id: str, limit: int) -> bool:
+        rank = self.rank(user_id)
+        return rank is not None and rank <= limit
+
+    def max_balance(self):
+        """самый большой баланс за O(1) - это первый ключ рейтинга"""
+        return -self._buckets[0][0][0] if self._buckets else 0
+
+    def top(self, limit: int) -> list[str]:
+        """id первых limit игроков по убыванию баланса"""
+        result = []
+        for bucket in self._buckets:
+            need = limit - len(result)
+            if need <= 0:
+                break
+            result.extend(key[2] for key in bucket[:need])
+        return result
+
+    def check(self) -> list[str]:
+        """сверяет рейтинг с полной сортировкой таблицы"""
+        table = self.table
+        if table is None:
+            return ['рейтинг не привязан к таблице']
+        problems = []
+        ordered = [key for bucket in self._buckets for key in bucket]
+        if ordered != sorted(ordered):
+            problems.append('рейтинг: нарушен порядок ключей')
+        if len(ordered) != len(self.keys) or sum(len(b) for b in self._buckets) != self._tree_prefix(len(self._buckets)):
+            problems.append('рейтинг: размеры корзин не сходятся')
+        for user_id, user_data in dict.items(table):
+            key = self.keys.get(user_id)
+            if key is None:
+                problems.append(f'рейтинг: {user_id} нет в рейтинге')
+            elif key[0] != -_leaderboard_balance(user_data.get('balance', 0)):
+                problems.append(f'рейтинг: у {user_id} устаревший баланс')
+        for user_id in self.keys:
+            if user_id not in table:
+                problems.append(f'рейтинг: {user_id} нет в базе')
+        return problems
+
+leaderboard = Leaderboard()
+
+# === леджер балансов ===
+# баланс меняли напрямую в десятках мест (прибавляя к полю balance), поэтому индексы,
+# журнал и пакетная запись зависели от того, не забыл ли обработчик нужный вызов.
+# теперь все движения денег идут через credit/debit/transfer/bulk_apply: одна функция
+# меняет баланс, оповещает индексы, пишет изменение в журнал с причиной и помечает
+# базу грязной. прямое присваивание баланса (восстановление, правки админом) тоже
+# оповещает индексы - через UserRecord.__setitem__
+BALANCE_LISTENERS = [leaderboard.changed]  # функции (запись, старый баланс, новый баланс)
+
+def _notify_balance(user_data, old_balance, new_balance):
+    # слушатели сами проверяют, что запись из живой таблицы users
+    for listener in BALANCE_LISTENERS:
+        listener(user_data, old_balance, new_balance)
+
+def _write_balance(user_id: str, delta, reason: str):
+    user_data = users[user_id]
+    old_balance = user_data.get('balance', 0)
+    new_balance = old_balance + delta
+    if type(user_data) is not UserRecord:
+        # база только что заменена обычным словарём - save_users() перепишет её целиком
+        user_data['balance'] = new_balance
+        return new_balance
+    if _snapshot_cow is not None:
+        _cow_preserve(user_id, user_data)
+    _notify_balance(user_data, old_balance, new_balance)
+    user_data._raw_set('balance', new_balance)
+    if not shard_owns(user_id):
+        # игрок другого шарда: владельцу уходит разница, а не итог - одновременные
+        # начисления с разных шардов складываются, а не перетирают друг друга
+        _shard_send(shard_of(user_id), {'t': 'delta', 'uid': user_id, 'delta': delta, 'reason': reason})
+        return new_balance
+    _record_mutation('set', user_id, 'balance', new_balance, reason)
+    return new_balance
+
+def _ledger_dirty():
+    if users_write_behind.running:
+        users_write_behind.mark_dirty()
+
+def credit(user_id: str, amount, reason: str | None = None):
+    """начисляет amount на баланс пользователя, возвращает новый баланс"""
+    if reason is None:
+        reason = sys._getframe(1).f_code.co_name
+    balance = _write_balance(user_id, amount, reason)
+    _ledger_dirty()
+    return balance
+
+def debit(user_id: str, amount, reason: str | None = None, floor=None):
+    """списывает amount с баланса, возвращает новый баланс.
+
+    хватает ли денег, проверяет вызывающий (как и раньше); floor - нижняя граница
+    баланса после списания (аннулирование не уводит в минус)
+    """
+    if reason is None:
+        reason = sys._getframe(1).f_code.co_name
+    if floor is not None:
+        amount = users[user_id].get('balance', 0) - max(floor, users[user_id].get('balance', 0) - amount)
+    balance = _write_balance(user_id, -amount, reason)
+    _ledger_dirty()
+    return balance
+
+def transfer(sender_id: str, receiver_id: str, amount, received=None, reason: str | None = None):
+    """переводит деньги между игроками; received - сколько дойдёт до получателя (за вычетом комиссии).
+
+    возвращает новые балансы отправителя и получателя
+    """
+    if reason is None:
+        reason = sys._getframe(1).f_code.co_name
+    sender_balance = _write_balance(sender_id, -amount, reason)
+    receiver_balance = _write_balance(receiver_id, amount if received is None else received, reason)
+    _ledger_dirty()
+    return sender_balance, receiver_balance
+
+def bulk_apply(changes, reason: str | None = None) -> dict:
+    """применяет пачку изменений [(user_id, изменение баланса)], возвращает {user_id: новый баланс}"""
+    if reason is None:
+        reason = sys._getframe(1).f_code.co_name
+    balances = {}
+    for user_id, delta in changes:
+        balances[user_id] = _write_balance(user_id, delta, reason)
+    if balances:
+        _ledger_dirty()
+    return balances
+
+STAKES_KEEP = 10000  # сколько последних ставок помнить по id
+_stakes = collections.OrderedDict()  # id ставки -> (игрок, сумма) или None - не списана и уже не спишется
+
+def _remember_stake(stake_id: str, taken):
+    _stakes[stake_id] = taken
+    _stakes.move_to_end(stake_id)
+    while len(_stakes) > STAKES_KEEP:
+        _stakes.popitem(last=False)
+
+def take_stake(user_id: str, amount, reason: str, stake_id: str | None = None) -> bool:
+    """списывает ставку, только если денег хватает; False - ставка не принята.
+
+    повтор с тем же stake_id отвечает как в первый раз и второй раз не списывает,
+    а после refund_stake ставка с этим id не списывается вовсе
+    """
+    if stake_id is not None and stake_id in _stakes:
+        return _stakes[stake_id] is not None
+    user_data = users.get(user_id)
+    if user_data is None or user_data.get('balance', 0) < amount:
+        if stake_id is not None:
+            _remember_stake(stake_id, None)
+        return False
+    debit(user_id, amount, reason)
+    save_users(reason)
+    if stake_id is not None:
+        _remember_stake(stake_id, (user_id, amount))
+    return True
+
+def refund_stake(stake_id: str, reason: str) -> bool:
+    """возвращает ставку, списанную take_stake с этим id; True - деньги вернулись"""
+    taken = _stakes.get(stake_id)
+    _remember_stake(stake_id, None)
+    if taken is None:
+        return False
+    user_id, amount = taken
+    credit(user_id, amount, reason)
+    save_users(reason)
+    return True
+
+async def take_stake_shared(user_id: str, amount, reason: str, stake_id: str | None = None) -> bool:
+    """ставка игрока там, где лежит его точный баланс: игрока другого шарда списывает его владелец"""
+    if shard_owns(user_id):
+        return take_stake(user_id, amount, reason, stake_id)
+    return await shard_link.call(shard_of(user_id), 'take_stake', [user_id, amount, reason, stake_id])
+
+def refund_stake_shared(user_id: str, stake_id: str, reason: str):
+    """отменяет ставку на шарде игрока, не дожидаясь ответа.
+
+    сообщения между двумя шардами приходят по порядку, поэтому отмена придёт после
+    списания (если оно было) и вернёт деньги, а если списания не было - не даст ему случиться
+    """
+    if shard_owns(user_id):
+        refund_stake(stake_id, reason)
+    else:
+        _shard_send(shard_of(user_id), {'t': 'refund', 'stake': stake_id, 'reason': reason})
+
+# === индекс активных вкладов ===
+# статистика банка, топы вкладов и массовое аннулирование перебирали всю базу в поисках
+# bank_deposit > 0, хотя вклад открыт у малой доли игроков. теперь вкладчики живой
+# таблицы лежат отдельно: по сумме (для топов) и по времени открытия (для сроков),
+# а сумма/количество/максимум обновляются при каждом изменении вклада.
+# упорядоченные списки - обычные list с bisect: вставка и удаление сдвигают хвост, то есть O(n)
+# по числу вкладчиков (не игроков). это сознательно: вкладчиков мало, а сдвиг - один memmove
+# (~28 мкс при 2k вкладчиков, ~0.3 мс даже при 300k). по одному удалять всех нельзя - это уже
+# O(n^2), поэтому массовое аннулирование сначала забирает их из индекса разом (take_all)
+BANK_DEPOSIT_TERM = 86400  # вклад можно забрать с процентами через 24 часа
+_DEPOSIT_FIELDS = frozenset({'bank_deposit', 'bank_deposit_time'})
+
+class DepositIndex:
+    """активные вклады: упорядочены по сумме и по времени открытия, итоги за O(1)"""
+
+    def __init__(self):
+        self.table = None
+        self.entries = {}     # user_id -> (сумма, время открытия)
+        self.by_amount = []   # (-сумма, user_id) по возрастанию = вклады по убыванию суммы
+        self.by_time = []     # (время открытия, user_id)
+        self.total = 0
+
+    def reset(self):
+        self.entries.clear()
+        self.by_amount = []
+        self.by_time = []
+        self.total = 0
+        deposit_scheduler.rebuild(self)
+
+    def rebuild(self, table: dict):
+        """привязывает индекс к таблице и строит его заново"""
+        self.table = table
+        self.reset()
+        slot = UserRecord.bank_deposit
+        for user_id, user_data in dict.items(table):
+            try:
+                amount = slot.__get__(user_data) if type(user_data) is UserRecord else user_data.get('bank_deposit', 0)
+            except AttributeError:
+                continue
+            if (type(amount) is int or type(amount) is float) and amount > 0:
+                self.entries[user_id] = (amount, user_data.get('bank_deposit_time', 0) or 0)
+        self.by_amount = sorted((-amount, user_id) for user_id, (amount, _) in self.entries.items())
+        self.by_time = sorted((started, user_id) for user_id, (_, started) in self.entries.items())
+        self.total = sum(amount for amount, _ in self.entries.values())
+        deposit_scheduler.rebuild(self)
+
+    def remove(self, user_id: str):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        amount, started = entry
+        del self.by_amount[bisect.bisect_left(self.by_amount, (-amount, user_id))]
+        del self.by_time[bisect.bisect_left(self.by_time, (started, user_id))]
+        self.total -= amount
+        deposit_scheduler.cancel(user_id)
+
+    def add_record(self, user_data):
+        if user_data is None:
+            return
+        user_id = user_data.uid
+        self.remove(user_id)
+        amount = user_data.get('bank_deposit', 0)
+        if not (type(amount) is int or type(amount) is float) or amount <= 0:
+            return
+        started = user_data.get('bank_deposit_time', 0) or 0
+        self.entries[user_id] = (amount, started)
+        bisect.insort(self.by_amount, (-amount, user_id))
+        bisect.insort(self.by_time, (started, user_id))
+        self.total += amount
+        if user_data.get('bank_deposit_notified') != started:
+            deposit_scheduler.schedule(user_id, started)
+
+    def take_all(self) -> list[str]:
+        """опустошает индекс и отдаёт id всех вкладчиков - перед тем как обнулить их вклады"""
+        user_ids = list(self.entries)
+        self.reset()
+        return user_ids
+
+    def changed(self, user_data):
+        """вызывается из UserRecord после изменения суммы или времени вклада"""
+        table = self.table
+        if table is None or dict.get(table, user_data.uid) is not user_data:
+            return
+        self.add_record(user_data)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def max_amount(self):
+        return -self.by_amount[0][0] if self.by_amount else 0
+
+    def top(self, limit: int) -> list[tuple[str, int]]:
+        """[(user_id, сумма)] самых крупных вкладов"""
+        return [(user_id, -amount) for amount, user_id in self.by_amount[:limit]]
+
+    def opened_before(self, timestamp: float) -> list[str]:
+        """id вкладчиков, открывших вклад раньше timestamp (по возрастанию времени)"""
+        end = bisect.bisect_left(self.by_time, (timestamp,))
+        return [user_id for _, user_id in self.by_time[:end]]
+
+    def check(self) -> list[str]:
+        """сверяет индекс вкладов с таблицей"""
+        table = self.table
+        if table is None:
+            return ['индекс вкладов не привязан к таблице']
+        problems = []
+        expected = {}
+        for user_id, user_data in dict.items(table):
+            amount = user_data.get('bank_deposit', 0)
+            if (type(amount) is int or type(amount) is float) and amount > 0:
+                expected[user_id] = (amount, user_data.get('bank_deposit_time', 0) or 0)
+        for user_id in expected.keys() | self.entries.keys():
+            if expected.get(user_id) != self.entries.get(user_id):
+                problems.append(f'вклады: у {user_id} в индексе {self.entries.get(user_id)}, в базе {expected.get(user_id)}')
+        if self.total != sum(amount for amount, _ in expected.values()):
+            problems.append('вклады: не сходится общая сумма')
+        if len(self.by_amount) != len(self.entries) or len(self.by_time) != len(self.entries):
+            problems.append('вклады: размеры упорядоченных списков не сходятся')
+        return problems
+
+deposit_index = DepositIndex()
+
+# === уведомления о созревших вкладах ===
+# раньше о том, что вклад можно забрать, игрок узнавал, только открыв банк, поэтому меню
+# банка открывали снова и снова. теперь сроки всех вкладов лежат в куче (срок, user_id,
+# время открытия): вклад добавляется и отменяется за O(log n), отменённые записи
+# выбрасываются при извлечении. очередь строится из индекса вкладов, так что переживает
+# перезапуск, а время уведомлённого вклада хранится в записи игрока (bank_deposit_notified) -
+# после перезапуска повторно не пишем. уведомления уходят через отправителя с ограничением
+# скорости, чтобы волна созревших вкладов не упёрлась во flood-лимит телеграма
+DEPOSIT_NOTIFY_RATE = float(os.getenv('DEPOSIT_NOTIFY_RATE', '20'))  # сообщений в секунду
+DEPOSIT_SCHEDULER_MAX_SLEEP = 60  # раз в минуту перепроверяем очередь, даже если срок далеко
+
+class RateLimitedSender:
+    """очередь исходящих сообщений не быстрее rate в секунду"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.queue = collections.deque()
+        self.task = None
+        self._wakeup = None
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, chat_id: int, text: str, **kwargs):
+        self.queue.append((chat_id, text, kwargs))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: dict):
+        if chat_id in dead_recipients:
+            self.failed += 1
+            return
+        try:
+            # общий лимит и retry_after держит планировщик исходящих
+            await bot.send_message(chat_id, text, **kwargs)
+            self.sent += 1
+            return
+        except Exception as e:
+            if not dead_recipients.record_failure(chat_id, e):
+                print(f"❌ Не удалось отправить уведомление {chat_id}: {e}")
+        self.failed += 1
+
+    async def run(self):
+        outbound_priority.set(PRIORITY_NOTIFY)
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            chat_id, text, kwargs = self.queue.popleft()
+            started = time.monotonic()
+            await self._deliver(chat_id, text, kwargs)
+            delay = self.interval - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self._wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+notify_sender = RateLimitedSender(DEPOSIT_NOTIFY_RATE)
+
+class DepositMaturityScheduler:
+    """сроки вкладов в куче с ленивым удалением"""
+
+    def __init__(self):
+        self.heap = []     # (срок, user_id, время открытия)
+        self.pending = {}  # user_id -> время открытия вклада, о котором ещё не сообщили
+        self.task = None
+        self._wakeup = None
+        self.notified = 0
+
+    def schedule(self, user_id: str, started):
+        if not shard_owns(user_id):
+            return  # о вкладе напомнит шард владельца
+        self.pending[user_id] = started
+        entry = (started + BANK_DEPOSIT_TERM, user_id, started)
+        heapq.heappush(self.heap, entry)
+        # новый срок раньше того, которого ждёт задача, - будим её
+        if self.heap[0] is entry and self._wakeup is not None:
+            self._wakeup.set()
+        self._maybe_compact()
+
+    def cancel(self, user_id: str):
+        if self.pending.pop(user_id, None) is not None:
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        # отменённых записей стало больше, чем живых, - пересобираем кучу
+        if len(self.heap) > 2 * len(self.pending) + 1024:
+            self.heap = [(started + BANK_DEPOSIT_TERM, user_id, started) for user_id, started in self.pending.items()]
+            heapq.heapify(self.heap)
+
+    def rebuild(self, index: DepositIndex):
+        """строит очередь заново по индексу вкладов (старт бота, замена базы)"""
+        table = index.table
+        self.pending = {
+            user_id: started for user_id, (_, started) in index.entries.items()
+            if (table is None or table[user_id].get('bank_deposit_notified') != started) and shard_owns(user_id)
+        }
+        self.heap = [(started + BANK_DEPOSIT_TERM, user_id, started) for user_id, started in self.pending.items()]
+        heapq.heapify(self.heap)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def next_due(self):
+        """срок ближайшего живого вклада или None"""
+        heap = self.heap
+        while heap and self.pending.get(heap[0][1]) != heap[0][2]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now: float) -> list[tuple[str, float]]:
+        """забирает из очереди вклады со сроком не позже now"""
+        due = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, user_id, started = heapq.heappop(heap)
+            if self.pending.get(user_id) == started:
+                del self.pending[user_id]
+                due.append((user_id, started))
+        return due
+
+    def notify(self, user_id: str, started):
+        user_data = users.get(user_id)
+        if user_data is None or user_data.get('bank_deposit', 0) <= 0 or user_data.get('bank_deposit_time') != started:
+            return
+        # отмечаем до отправки: после перезапуска этот вклад уже не попадёт в очередь
+        user_data['bank_deposit_notified'] = started
+        deposit = user_data['bank_deposit']
+        interest = int(deposit * 0.004167 * 24)
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text='💸 забрать деньги', callback_data='bank_withdraw')]
+        ])
+        notify_sender.send(
+            int(user_id),
+            f"🏦 <b>вклад созрел!</b>\n\n"
+            f"💰 <b>вклад:</b> ${format_money(deposit)}\n"
+            f"📈 <b>проценты:</b> ${format_money(interest)}\n\n"
+            f"деньги с процентами можно забрать в банке",
+            parse_mode='HTML',
+            reply_markup=markup
+        )
+        self.notified += 1
+
+    async def run(self):
+        while True:
+            due_at = self.next_due()
+            now = time.time()
+            if due_at is None or due_at > now:
+                timeout = DEPOSIT_SCHEDULER_MAX_SLEEP if due_at is None else min(due_at - now, DEPOSIT_SCHEDULER_MAX_SLEEP)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self.pop_due(now)
+            for user_id, started in due:
+                self.notify(user_id, started)
+            if due:
+                save_users('deposit_matured')
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self._wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+deposit_scheduler = DepositMaturityScheduler()
+
+def _apply_journal_record(data: dict, record: dict):
+    """применяет одну запись журнала к обычному словарю пользователей"""
+    op = record.get('op')
+    user_id = record.get('uid')
+    if op == 'set':
+        target = data.get(user_id)
+        if target is None:
+            target = data[user_id] = {}
+        if isinstance(target, UserRecord):
+            target._raw_set(record['f'], record.get('v'))
+        else:
+            target[record['f']] = record.get('v')
+    elif op == 'unset':
+        target = data.get(user_id)
+        if isinstance(target, UserRecord):
+            target._raw_del(record['f'])
+        elif target is not None:
+            target.pop(record['f'], None)
+    elif op == 'put':
+        data[user_id] = dict(record.get('v') or {})
+    elif op == 'del':
+        data.pop(user_id, None)
+    elif op == 'reset':
+        # служебные данные (версия схемы) очистка пользователей не трогает
+        meta = data.get(USERS_META_KEY)
+        data.clear()
+        if meta is not None:
+            data[USERS_META_KEY] = meta
+    elif op == 'meta':
+        data.setdefault(USERS_META_KEY, {})[record['f']] = record.get('v')
+
+def replay_journal(data: dict, journal_path: str = JOURNAL_FILE, since: float | None = None,
+                   until: float | None = None, user_id: str | None = None) -> int:
+    """накатывает журнал поверх снапшота, возвращает количество применённых записей.
+
+    since/until ограничивают записи по времени, user_id - одним пользователем
+    (плюс очистки базы); .gz-куски из архива журнала читаются так же
+    """
+    applied = 0
+    # строки чужих пользователей отсекаем по подстроке, не разбирая json
+    uid_marker = f'"uid": {json.dumps(user_id)}' if user_id is not None else None
+    opener = gzip.open if journal_path.endswith('.gz') else open
+    try:
+        with opener(journal_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if uid_marker is not None and uid_marker not in line and '"op": "reset"' not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # недописанная строка после падения - просто пропускаем
+                    continue
+                if since is not None or until is not None:
+                    ts = record.get('ts', 0)
+                    if since is not None and ts < since:
+                        continue
+                    if until is not None and ts > until:
+                        # записи идут по времени, дальше только более поздние
+                        break
+                _apply_journal_record(data, record)
+                applied += 1
+    except FileNotFoundError:
+        pass
+    return applied
+
+def _journal_records(mutations: list, reason: str) -> list[dict]:
+    """превращает накопленные изменения в записи журнала"""
+    now = time.time()
+    records = []
+    for op, user_id, field, value, mutation_reason in mutations:
+        record = {'ts': now, 'op': op, 'uid': user_id}
+        if field is not None:
+            record['f'] = field
+        if op in ('set', 'put'):
+            record['v'] = value
+        if mutation_reason or reason:
+            record['r'] = mutation_reason or reason
+        records.append(record)
+    return records
+
+def _archive_journal_segment(path: str):
+    """переносит свёрнутый кусок журнала в архив вместо удаления - из него восстанавливаются на момент времени"""
+    try:
+        if os.path.getsize(path) == 0:
+            os.remove(path)
+            return
+    except FileNotFoundError:
+        return
+    os.makedirs(JOURNAL_ARCHIVE_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    target = os.path.join(JOURNAL_ARCHIVE_DIR, f'users_journal_{stamp}.jsonl')
+    counter = 1
+    while os.path.exists(target) or os.path.exists(f'{target}.gz'):
+        # имена сортируются по времени, поэтому номер добавляем так, чтобы порядок сохранился
+        target = os.path.join(JOURNAL_ARCHIVE_DIR, f'users_journal_{stamp}_{counter:03d}.jsonl')
+        counter += 1
+    os.replace(path, target)
+
+def _fsync_dir(path: str):
+    """фиксирует на диске переименование файла внутри каталога (где это поддерживается)"""
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def _write_text_atomic(path: str, text: str):
+    """пишет текст во временный файл и атомарно подменяет им основной: после падения остаётся старый или новый файл целиком"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+def _write_json_atomic(path: str, data):
+    """пишет json во временный файл и атомарно подменяет им основной"""
+    _write_text_atomic(path, json.dumps(data, ensure_ascii=False, indent=2))
+
+# === хранилища пользователей ===
+# в памяти всегда живёт словарь users, хранилище только сохраняет накопленные изменения.
+# выбирается переменной окружения USERS_STORAGE: json (по умолчанию) или sqlite
+USERS_STORAGE = os.getenv('USERS_STORAGE', 'json').lower()
+SQLITE_DB_FILE = os.getenv('USERS_SQLITE_FILE', 'users_db.sqlite3')
+SQLITE_MUTATION_LOG = 'users_mutations.jsonl'
+SQLITE_BUSY_TIMEOUT = 30  # сколько ждать, пока другой шард допишет свою транзакцию
+SQLITE_APPLY_ATTEMPTS = 4  # попыток записать пачку, если база всё ещё занята
+SQLITE_APPLY_RETRY_DELAY = 0.05  # пауза перед повтором, удваивается с каждой попыткой
+
+def _sqlite_busy(error: Exception) -> bool:
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+if SHARD_WORKERS or SHARD_COUNT:
+    # шарды пишут в одну базу одновременно - это умеет только sqlite; журнал у каждого свой
+    USERS_STORAGE = 'sqlite'
+    if SHARD_COUNT:
+        SQLITE_MUTATION_LOG = f'users_mutations.shard{SHARD_INDEX}.jsonl'
+
+class UserStorage:
+    """общий интерфейс хранилища пользователей"""
+    name = 'base'
+
+    def load_all(self) -> dict:
+        """возвращает всех пользователей обычным словарём {user_id: {...}}"""
+        raise NotImplementedError
+
+    def get(self, user_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def put(self, user_id: str, user_data: dict):
+        raise NotImplementedError
+
+    def update_field(self, user_id: str, field: str, value):
+        raise NotImplementedError
+
+    def delete(self, user_id: str):
+        raise NotImplementedError
+
+    def iterate(self):
+        """перебирает пары (user_id, данные) без загрузки всех сразу, где это возможно"""
+        raise NotImplementedError
+
+    def query(self, field: str | None = None, value=None, order_by: str | None = None,
+              descending: bool = False, limit: int | None = None) -> list[tuple[str, dict]]:
+        """ищет пользователей по полю (ник и юзернейм без учёта регистра) и сортирует по полю"""
+        result = []
+        for user_id, user_data in self.iterate():
+            if field is not None and not _user_field_matches(user_data, field, value):
+                continue
+            result.append((user_id, user_data))
+        if order_by is not None:
+            result.sort(key=lambda item: item[1].get(order_by, 0) or 0, reverse=descending)
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+    def apply(self, mutations: list, reason: str, current: dict):
+        """сохраняет порцию изменений; current - актуальный словарь пользователей в памяти"""
+        raise NotImplementedError
+
+    def replace_all(self, current: dict):
+        """полностью перезаписывает хранилище содержимым current"""
+        raise NotImplementedError
+
+    def compact(self, current: dict, force: bool = False) -> bool:
+        """фоновое обслуживание хранилища (сворачивание журнала, чекпоинт и т.п.)"""
+        return False
+
+    @property
+    def schema_version(self) -> int:
+        """версия схемы записей пользователей, сохранённая вместе с данными"""
+        raise NotImplementedError
+
+    def set_schema_version(self, version: int):
+        raise NotImplementedError
+
+    async def compact_async(self, current: dict, force: bool = False) -> bool:
+        """то же обслуживание из цикла событий; тяжёлую работу хранилище уносит в поток"""
+        return self.compact(current, force)
+
+    def backup_sources(self) -> list:
+        """фиксирует состояние для резервной копии: [(имя в архиве, открывашка)].
+
+        вызывается в цикле событий; открывашка вызывается уже в потоке резервного
+        копирования и возвращает (файл, сколько байт из него взять)
+        """
+        raise NotImplementedError
+
+    def journal_paths(self) -> list[str]:
+        """живые (ещё не в архиве) файлы журнала изменений от старых к новым"""
+        return []
+
+    def close(self):
+        pass
+
+def _user_field_matches(user_data: dict, field: str, value) -> bool:
+    current = user_data.get(field)
+    if field in ('nick', 'tg_username') and isinstance(current, str) and isinstance(value, str):
+        return current.lower() == value.lower()
+    return current == value
+
+# === бинарный снапшот пользователей ===
+# разбор красивого json на старте - самое долгое при перезапуске. в бинарном снапшоте каждое
+# поле лежит отдельной колонкой: числа - массивами int64/double, повторяющиеся значения
+# (язык, тип аккаунта, None в пустых полях профиля) - словарём различных значений и массивом
+# номеров. записи собираются через zip без разбора имён полей у каждого пользователя.
+# пользователи с нестандартным набором полей лежат отдельно обычным json.
+#
+# формат (little-endian):
+#   заголовок: magic b'KSUB' | версия u16 | флаги u16 | число пользователей u32 | число секций u16
+#   секция:    тег 4 байта | сжатие u8 (0 - нет, 1 - zlib) | длина u64 | данные
+#   секции:    IDS_ (id через \n), KEYS (json со списком полей колонок),
+#              C000..Cnnn (колонки по порядку KEYS), EXTR (json {номер: запись} для остальных),
+#              META (json служебных данных, например версии схемы; может отсутствовать)
+USERS_SNAPSHOT_FORMAT = os.getenv('USERS_SNAPSHOT_FORMAT', 'json').lower()  # json или binary
+BINARY_DB_FILE = 'users_db.bin'
+BINARY_SNAPSHOT_MAGIC = b'KSUB'
+BINARY_SNAPSHOT_VERSION = 1
+_BINARY_HEADER = struct.Struct('<4sHHIH')
+_BINARY_SECTION = struct.Struct('<4sBQ')
+_BINARY_COMPRESS_MIN = 64 * 1024  # секции больше этого сжимаем zlib
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+def _encode_column(values: list) -> bytes:
+    """кодирует колонку одного поля в самый компактный из подходящих видов"""
+    if all(type(value) is int and _INT64_MIN <= value <= _INT64_MAX for value in values):
+        return b'q' + array.array('q', values).tobytes()
+    if all(type(value) is float for value in values):
+        return b'd' + array.array('d', values).tobytes()
+    if all(type(value) in _SCALAR_TYPES for value in values):
+        # словарное кодирование: ключ с типом, чтобы True и 1 не склеились
+        distinct = {}
+        indexes = array.array('I')
+        for value in values:
+            key = (type(value), value)
+            index = distinct.get(key)
+            if index is None:
+                index = distinct[key] = len(distinct)
+            indexes.append(index)
+        if len(distinct) * 4 <= len(values):
+            table = json.dumps([value for _, value in distinct], ensure_ascii=False).encode('utf-8')
+            return b'E' + struct.pack('<I', len(table)) + table + indexes.tobytes()
+    # балансы больше 2^63, уникальные строки, вложенные словари - точный json-массив
+    return b'J' + json.dumps(values, ensure_ascii=False, default=str).encode('utf-8')
+
+def _decode_column(data: bytes) -> list:
+    kind = data[:1]
+    if kind == b'q' or kind == b'd':
+        column = array.array(kind.decode('ascii'))
+        column.frombytes(data[1:])
+        return column.tolist()
+    if kind == b'E':
+        table_len = struct.unpack_from('<I', data, 1)[0]
+        table = json.loads(data[5:5 + table_len])
+        indexes = array.array('I')
+        indexes.frombytes(data[5 + table_len:])
+        return [table[i] for i in indexes]
+    return json.loads(data[1:])
+
+def _encode_binary_snapshot(records, meta: dict | None = None) -> bytes:
+    """собирает бинарный снапшот из пар (user_id, запись)"""
+    user_ids = []
+    records_list = []
+    shape_counts = {}
+    for user_id, user_data in records:
+        user_ids.append(str(user_id))
+        records_list.append(user_data)
+        shape = tuple(user_data)
+        shape_counts[shape] = shape_counts.get(shape, 0) + 1
+    # колонками кладём самый частый набор полей, остальные записи - отдельно
+    keys = max(shape_counts, key=shape_counts.get) if shape_counts else ()
+    keys_set = set(keys)
+    columns = [[] for _ in keys]
+    extra = {}
+    for i, user_data in enumerate(records_list):
+        if len(user_data) == len(keys) and keys_set.issuperset(user_data):
+            for column, key in zip(columns, keys):
+                column.append(user_data[key])
+        else:
+            extra[i] = user_data
+            for column in columns:
+                column.append(None)
     
-    # Пропускаем записи с неправильными никами
-                if 'nick' in user_data and user_data['nick'].startswith('/'):
+    sections = [
+        (b'IDS_', '\n'.join(user_ids).encode('utf-8')),
+        (b'KEYS', json.dumps(list(keys), ensure_ascii=False).encode('utf-8')),
+    ]
+    for number, column in enumerate(columns):
+        sections.append((f'C{number:03d}'.encode('ascii'), _encode_column(column)))
+    sections.append((b'EXTR', json.dumps(extra, ensure_ascii=False, default=str).encode('utf-8')))
+    if meta:
+        sections.append((b'META', json.dumps(meta, ensure_ascii=False).encode('utf-8')))
+    
+    parts = [_BINARY_HEADER.pack(BINARY_SNAPSHOT_MAGIC, BINARY_SNAPSHOT_VERSION, 0, len(user_ids), len(sections))]
+    for tag, payload in sections:
+        codec = 0
+        if len(payload) >= _BINARY_COMPRESS_MIN:
+            payload = zlib.compress(payload, 1)
+            codec = 1
+        parts.append(_BINARY_SECTION.pack(tag, codec, len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+def _records_from_columns(user_ids: list, keys: list, columns: list) -> dict:
+    """собирает UserRecord прямо из колонок, не создавая промежуточных словарей"""
+    records = [object.__new__(UserRecord) for _ in user_ids]
+    consume = collections.deque(maxlen=0).extend  # прогоняет map() без цикла на питоне
+    consume(map(UserRecord.uid.__set__, records, user_ids))
+    consume(map(UserRecord._extra.__set__, records, itertools.repeat(None)))
+    for key, column in zip(keys, columns):
+        if key in _USER_SLOT_SET:
+            consume(map(getattr(UserRecord, key).__set__, records, column))
+            continue
+        default = USER_SPARSE_DEFAULTS.get(key, _MISSING)
+        for record, value in zip(records, column):
+            # значения по умолчанию не храним вовсе
+            if default is not _MISSING and type(value) is type(default) and value == default:
+                continue
+            if record._extra is None:
+                record._extra = {}
+            record._extra[key] = value
+    return dict(zip(user_ids, records))
+
+def _decode_binary_snapshot(data: bytes, as_records: bool = False) -> dict:
+    """разбирает бинарный снапшот в словарь {user_id: {...}} (или сразу в UserRecord)"""
+    magic, version, _flags, count, section_count = _BINARY_HEADER.unpack_from(data, 0)
+    if magic != BINARY_SNAPSHOT_MAGIC:
+        raise ValueError('это не бинарный снапшот пользователей')
+    if version != BINARY_SNAPSHOT_VERSION:
+        raise ValueError(f'неподдерживаемая версия бинарного снапшота: {version}')
+    offset = _BINARY_HEADER.size
+    sections = {}
+    for _ in range(section_count):
+        tag, codec, length = _BINARY_SECTION.unpack_from(data, offset)
+        offset += _BINARY_SECTION.size
+        payload = data[offset:offset + length]
+        offset += length
+        sections[tag] = zlib.decompress(payload) if codec == 1 else payload
+    
+    user_ids = sections[b'IDS_'].decode('utf-8').split('\n') if count else []
+    keys = json.loads(sections[b'KEYS'])
+    columns = [_decode_column(sections[f'C{number:03d}'.encode('ascii')]) for number in range(len(keys))]
+    if as_records:
+        result = _records_from_columns(user_ids, keys, columns)
+    elif columns:
+        result = {user_id: dict(zip(keys, row)) for user_id, row in zip(user_ids, zip(*columns))}
+    else:
+        result = {user_id: {} for user_id in user_ids}
+    for index, user_data in json.loads(sections[b'EXTR']).items():
+        user_id = user_ids[int(index)]
+        result[user_id] = UserRecord(user_id, user_data) if as_records else user_data
+    if b'META' in sections:
+        result[USERS_META_KEY] = json.loads(sections[b'META'])
+    return result
+
+def _read_snapshot_file(path: str, as_records: bool = False) -> dict:
+    """читает снапшот любого формата: бинарный узнаём по сигнатуре"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] == BINARY_SNAPSHOT_MAGIC:
+        return _decode_binary_snapshot(data, as_records)
+    return json.loads(data.decode('utf-8'))
+
+def convert_snapshot_to_binary(json_path: str = DB_FILE, binary_path: str = BINARY_DB_FILE) -> int:
+    """переводит снапшот users_db.json в бинарный формат, возвращает число пользователей"""
+    data = _read_snapshot_file(json_path)
+    meta = data.pop(USERS_META_KEY, None)
+    tmp_path = f'{binary_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_encode_binary_snapshot(data.items(), meta))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, binary_path)
+    print(f"✅ {json_path} -> {binary_path}: {len(data)} пользователей")
+    return len(data)
+
+def convert_snapshot_to_json(binary_path: str = BINARY_DB_FILE, json_path: str = DB_FILE) -> int:
+    """переводит бинарный снапшот обратно в users_db.json, возвращает число пользователей"""
+    data = _read_snapshot_file(binary_path)
+    _write_json_atomic(json_path, data)
+    count = len(data) - (USERS_META_KEY in data)
+    print(f"✅ {binary_path} -> {json_path}: {count} пользователей")
+    return count
+
+class JsonUserStorage(UserStorage):
+    """снапшот users_db.json плюс журнал изменений users_journal.jsonl.
+
+    снапшот пишется в отдельном потоке: журнал на момент старта откладывается
+    в users_journal.jsonl.compacting, новые изменения идут в свежий журнал,
+    а после атомарной подмены снапшота отложенный кусок удаляется
+    """
+    name = 'json'
+
+    def __init__(self, snapshot_path: str | None = None, journal_path: str = JOURNAL_FILE,
+                 snapshot_format: str = USERS_SNAPSHOT_FORMAT):
+        self.snapshot_format = 'binary' if snapshot_format == 'binary' else 'json'
+        self.name = self.snapshot_format
+        if snapshot_path is None:
+            snapshot_path = BINARY_DB_FILE if self.snapshot_format == 'binary' else DB_FILE
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compacting_path = f'{journal_path}.compacting'
+        self._journal_file = None
+        self._last_compaction_time = time.time()
+        self._snapshot_running = False
+        self._generation = 0  # растёт при каждой полной перезаписи, чтобы старый снапшот не затёр новый
+        self.last_snapshot_ms = 0.0
+        self.last_snapshot_copied = 0
+        self.meta = {}  # служебные данные, которые лежат в снапшоте рядом с пользователями
+
+    def load_all(self) -> dict:
+        data, self.meta = self._read_all()
+        return data
+
+    def _read_all(self) -> tuple[dict, dict]:
+        """читает снапшот и журнал, возвращает (пользователи, служебные данные)"""
+        # при смене формата первый запуск читает снапшот старого формата, следующий снапшот будет уже в новом
+        fallback_path = DB_FILE if self.snapshot_format == 'binary' else BINARY_DB_FILE
+        data = None
+        for path in (self.snapshot_path, fallback_path):
+            try:
+                # бинарный снапшот сразу собирается в UserRecord - это самый быстрый путь
+                data = _read_snapshot_file(path, as_records=True)
+                break
+            except FileNotFoundError:
+                continue
+        if data is None:
+            print(f"Файл {self.snapshot_path} не найден, создаём новую базу данных")
+            data = {}
+        # если упали посреди записи снапшота - сначала отложенный кусок журнала, потом свежий
+        replayed = replay_journal(data, self.compacting_path)
+        replayed += replay_journal(data, self.journal_path)
+        if replayed:
+            print(f"Из журнала применено {replayed} изменений")
+        meta = data.pop(USERS_META_KEY, None)
+        return data, (dict(meta) if isinstance(meta, dict) else {})
+
+    @property
+    def schema_version(self) -> int:
+        return int(self.meta.get('schema_version', 0))
+
+    def set_schema_version(self, version: int):
+        # до следующего снапшота версия живёт в журнале, потом переезжает в снапшот
+        self.meta['schema_version'] = version
+        self._append([{'ts': time.time(), 'op': 'meta', 'f': 'schema_version', 'v': version}])
+
+    def get(self, user_id: str) -> dict | None:
+        return self._read_all()[0].get(user_id)
+
+    def put(self, user_id: str, user_data: dict):
+        self._append([{'ts': time.time(), 'op': 'put', 'uid': user_id, 'v': user_data}])
+
+    def update_field(self, user_id: str, field: str, value):
+        self._append([{'ts': time.time(), 'op': 'set', 'uid': user_id, 'f': field, 'v': value}])
+
+    def delete(self, user_id: str):
+        self._append([{'ts': time.time(), 'op': 'del', 'uid': user_id}])
+
+    def iterate(self):
+        return iter(self._read_all()[0].items())
+
+    def _append(self, records: list[dict]):
+        if self._journal_file is None or self._journal_file.closed:
+            self._journal_file = open(self.journal_path, 'a', encoding='utf-8')
+        lines = [json.dumps(record, ensure_ascii=False, default=str) for record in records]
+        start = self._journal_file.tell()
+        try:
+            self._journal_file.write('\n'.join(lines) + '\n')
+            self._journal_file.flush()
+        except Exception:
+            # недописанная строка склеилась бы со следующей пачкой - обрезаем журнал до её начала,
+            # саму пачку flush_user_changes оставит в очереди и запишет ещё раз
+            journal_file, self._journal_file = self._journal_file, None
+            with contextlib.suppress(Exception):
+                journal_file.close()
+            with contextlib.suppress(OSError):
+                os.truncate(self.journal_path, start)
+            raise
+
+    def _close_journal(self):
+        if self._journal_file is not None and not self._journal_file.closed:
+            self._journal_file.close()
+        self._journal_file = None
+
+    def apply(self, mutations: list, reason: str, current: dict):
+        self._append(_journal_records(mutations, reason))
+
+    def _write_snapshot_file(self, current: dict, user_ids: list, generation: int) -> bool:
+        """пишет снапшот (json - по пользователю на строку), затем fsync и атомарная подмена"""
+        tmp_path = f'{self.snapshot_path}.tmp'
+        meta = dict(self.meta)
+        if self.snapshot_format == 'binary':
+            records = ((user_id, user_data) for user_id in user_ids
+                       if (user_data := _snapshot_read(user_id, current)) is not None)
+            with open(tmp_path, 'wb') as f:
+                f.write(_encode_binary_snapshot(records, meta))
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            self._write_json_lines(tmp_path, current, user_ids, meta)
+        if generation != self._generation:
+            # пока писали, базу перезаписали целиком - наш снапшот уже устарел
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, self.snapshot_path)
+        _fsync_dir(self.snapshot_path)
+        return True
+
+    @staticmethod
+    def _write_json_lines(tmp_path: str, current: dict, user_ids: list, meta: dict | None = None):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{')
+            separator = '\n'
+            if meta:
+                f.write(separator)
+                f.write(json.dumps(USERS_META_KEY))
+                f.write(': ')
+                f.write(json.dumps(meta, ensure_ascii=False))
+                separator = ',\n'
+            for user_id in user_ids:
+                user_data = _snapshot_read(user_id, current)
+                if user_data is None:
                     continue
-                
-                # Если пользователь уже есть, оставляем более полную запись
-                if user_id_str in fixed_data:
-                    # Сравниваем записи и оставляем ту, у которой больше полей
-                    if len(user_data) > len(fixed_data[user_id_str]):
-                        fixed_data[user_id_str] = user_data
+                f.write(separator)
+                f.write(json.dumps(str(user_id), ensure_ascii=False))
+                f.write(': ')
+                f.write(json.dumps(user_data, ensure_ascii=False, default=str))
+                separator = ',\n'
+            f.write('\n}\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rotate_journal(self):
+        """откладывает текущий журнал до конца записи снапшота и начинает новый"""
+        self._close_journal()
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.compacting_path):
+                # хвост прошлой неудачной попытки: склеиваем, порядок записей сохраняется
+                with open(self.compacting_path, 'a', encoding='utf-8') as target, \
+                        open(self.journal_path, 'r', encoding='utf-8') as source:
+                    for line in source:
+                        target.write(line)
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.compacting_path)
+
+    def _finish_compaction(self):
+        _archive_journal_segment(self.compacting_path)
+        self._last_compaction_time = time.time()
+
+    def replace_all(self, current: dict):
+        """синхронная полная перезапись (база заменена целиком, скрипты)"""
+        self._generation += 1
+        self._close_journal()
+        self._write_snapshot_file(current, list(current.keys()), self._generation)
+        # журнал убираем в архив только после того, как снапшот на диске
+        self._finish_compaction()
+        _archive_journal_segment(self.journal_path)
+
+    async def write_snapshot(self, current: dict) -> bool:
+        """пишет снапшот в отдельном потоке, не останавливая обработчики"""
+        if self._snapshot_running:
+            return False
+        self._snapshot_running = True
+        started = time.perf_counter()
+        generation = self._generation
+        try:
+            # всё до этого момента уже в журнале; с этого момента журнал пишется в новый файл
+            self._rotate_journal()
+            user_ids = list(current.keys())
+            _begin_users_snapshot()
+            try:
+                written = await asyncio.to_thread(self._write_snapshot_file, current, user_ids, generation)
+            finally:
+                self.last_snapshot_copied = _end_users_snapshot()
+            if written:
+                self._finish_compaction()
+            self.last_snapshot_ms = (time.perf_counter() - started) * 1000
+            return written
+        finally:
+            self._snapshot_running = False
+
+    def _needs_compaction(self, force: bool) -> bool:
+        if force:
+            return True
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except OSError:
+            journal_size = 0
+        if journal_size == 0:
+            return False
+        journal_age = time.time() - self._last_compaction_time
+        return journal_size >= JOURNAL_COMPACT_MAX_BYTES or journal_age >= JOURNAL_COMPACT_INTERVAL
+
+    def compact(self, current: dict, force: bool = False) -> bool:
+        """сворачивает журнал в свежий снапшот синхронно (для скриптов без цикла событий)"""
+        if not self._needs_compaction(force):
+            return False
+        self.replace_all(current)
+        return True
+
+    async def compact_async(self, current: dict, force: bool = False) -> bool:
+        """сворачивает журнал в свежий снапшот в фоне, если он разросся или давно не сворачивался"""
+        if self._snapshot_running or not self._needs_compaction(force):
+            return False
+        written = await self.write_snapshot(current)
+        if written:
+            print(f"🗜️ Журнал свёрнут в снапшот за {self.last_snapshot_ms:.0f} мс "
+                  f"(скопировано при записи: {self.last_snapshot_copied})")
+        return written
+
+    def backup_sources(self) -> list:
+        # файлы открываем сразу: снапшот могут подменить, а отложенный журнал удалить,
+        # но открытые дескрипторы продолжают видеть данные на момент копии. размер тоже
+        # фиксируем сейчас - то, что допишут в журнал позже, в эту копию не попадёт
+        sources = []
+        for path in (self.snapshot_path, self.compacting_path, self.journal_path):
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            size = os.fstat(f.fileno()).st_size
+            sources.append((os.path.basename(path), lambda f=f, size=size: (f, size)))
+        return sources
+
+    def journal_paths(self) -> list[str]:
+        return [self.compacting_path, self.journal_path]
+
+    def close(self):
+        self._close_journal()
+
+# сортируемое представление: знак, длина числа (4 цифры) и сами цифры. у отрицательных
+# длина и цифры дополнены до 9, чтобы большее по модулю шло раньше. раньше число
+# дополнялось нулями до 64 цифр и ломалось на значениях от 10^64
+_SORTABLE_INT_LENGTH = 4
+_SORTABLE_INT_MAX_LENGTH = 10 ** _SORTABLE_INT_LENGTH - 1
+_SORTABLE_INT_COMPLEMENT = str.maketrans('0123456789', '9876543210')
+SQLITE_SORTABLE_FORMAT = '2'  # 1 - прежние 64 цифры
+
+def _encode_sortable_int(value) -> str | None:
+    """кодирует целое любой длины в строку, которая сортируется так же, как число"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    value = int(value)
+    digits = str(abs(value))
+    if len(digits) > _SORTABLE_INT_MAX_LENGTH:
+        raise ValueError(f'число из {len(digits)} цифр не помещается в сортируемое представление')
+    if value >= 0:
+        return f'p{len(digits):0{_SORTABLE_INT_LENGTH}d}{digits}'
+    length = _SORTABLE_INT_MAX_LENGTH - len(digits)
+    return f'n{length:0{_SORTABLE_INT_LENGTH}d}{digits.translate(_SORTABLE_INT_COMPLEMENT)}'
+
+def _decode_sortable_int(text: str) -> int:
+    digits = text[1 + _SORTABLE_INT_LENGTH:]
+    if text[0] == 'p':
+        return int(digits)
+    return -int(digits.translate(_SORTABLE_INT_COMPLEMENT))
+
+class SqliteUserStorage(UserStorage):
+    """sqlite в режиме WAL: одна строка на пользователя, пишутся только изменённые строки.
+
+    полная запись лежит в колонке data (json, целые любой длины сохраняются точно),
+    а balance/bank_deposit/nick/tg_username продублированы в индексируемые колонки.
+    числа хранятся текстом в сортируемом виде, потому что балансы вылезают за 2^63
+    """
+    name = 'sqlite'
+    _INDEXED_COLUMNS = {'balance': 'balance', 'bank_deposit': 'bank_deposit', 'nick': 'nick', 'tg_username': 'tg_username'}
+
+    def __init__(self, db_path: str = SQLITE_DB_FILE, log_path: str = SQLITE_MUTATION_LOG):
+        import sqlite3
+        self.db_path = db_path
+        # sqlite хранит только текущее состояние, поэтому изменения дополнительно пишутся
+        # в журнал того же формата - он нужен для восстановления на момент времени
+        self.log_path = log_path
+        self._log_file = None
+        self._last_log_rotation = time.time()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                uid TEXT PRIMARY KEY,
+                nick TEXT COLLATE NOCASE,
+                tg_username TEXT COLLATE NOCASE,
+                balance TEXT,
+                bank_deposit TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance);
+            CREATE INDEX IF NOT EXISTS idx_users_bank_deposit ON users(bank_deposit);
+            CREATE INDEX IF NOT EXISTS idx_users_nick ON users(nick);
+            CREATE INDEX IF NOT EXISTS idx_users_tg_username ON users(tg_username);
+            CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self.conn.commit()
+        self._upgrade_sortable_columns()
+
+    def _upgrade_sortable_columns(self):
+        """перекодирует balance/bank_deposit, записанные прежним форматом, из полной записи"""
+        row = self.conn.execute("SELECT value FROM storage_meta WHERE key = 'sortable_int'").fetchone()
+        if row is not None and row[0] == SQLITE_SORTABLE_FORMAT:
+            return
+        updates = []
+        for user_id, data in self.conn.execute('SELECT uid, data FROM users'):
+            user_data = json.loads(data)
+            updates.append((_encode_sortable_int(user_data.get('balance', 0)),
+                            _encode_sortable_int(user_data.get('bank_deposit', 0)), user_id))
+        with self.conn:
+            self.conn.executemany('UPDATE users SET balance = ?, bank_deposit = ? WHERE uid = ?', updates)
+            self.conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('sortable_int', ?)",
+                              (SQLITE_SORTABLE_FORMAT,))
+        if updates:
+            print(f"🔢 Сортируемые колонки пересчитаны в новом формате: {len(updates)} пользователей")
+
+    @staticmethod
+    def _row(user_id: str, user_data: dict) -> tuple:
+        nick = user_data.get('nick')
+        tg_username = user_data.get('tg_username')
+        return (
+            user_id,
+            nick if isinstance(nick, str) else None,
+            tg_username if isinstance(tg_username, str) else None,
+            _encode_sortable_int(user_data.get('balance', 0)),
+            _encode_sortable_int(user_data.get('bank_deposit', 0)),
+            json.dumps(dict(user_data), ensure_ascii=False, default=str),
+        )
+
+    def _upsert_many(self, rows: list[tuple]):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO users (uid, nick, tg_username, balance, bank_deposit, data) VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+
+    def count(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def load_all(self) -> dict:
+        return {user_id: json.loads(data) for user_id, data in self.conn.execute('SELECT uid, data FROM users')}
+
+    def get(self, user_id: str) -> dict | None:
+        row = self.conn.execute('SELECT data FROM users WHERE uid = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, user_id: str, user_data: dict):
+        with self.conn:
+            self._upsert_many([self._row(user_id, user_data)])
+
+    def update_field(self, user_id: str, field: str, value):
+        user_data = self.get(user_id) or {}
+        user_data[field] = value
+        self.put(user_id, user_data)
+
+    def delete(self, user_id: str):
+        with self.conn:
+            self.conn.execute('DELETE FROM users WHERE uid = ?', (user_id,))
+
+    def iterate(self):
+        for user_id, data in self.conn.execute('SELECT uid, data FROM users'):
+            yield user_id, json.loads(data)
+
+    def query(self, field: str | None = None, value=None, order_by: str | None = None,
+              descending: bool = False, limit: int | None = None) -> list[tuple[str, dict]]:
+        # по индексируемым колонкам отдаём работу sqlite, остальное - общим перебором
+        if (field is not None and field not in self._INDEXED_COLUMNS) or \
+                (order_by is not None and order_by not in self._INDEXED_COLUMNS):
+            return super().query(field, value, order_by, descending, limit)
+        sql = 'SELECT uid, data FROM users'
+        params = []
+        if field is not None:
+            column = self._INDEXED_COLUMNS[field]
+            sql += f' WHERE {column} = ?'
+            params.append(_encode_sortable_int(value) if field in ('balance', 'bank_deposit') else value)
+        if order_by is not None:
+            sql += f" ORDER BY {self._INDEXED_COLUMNS[order_by]} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        return [(user_id, json.loads(data)) for user_id, data in self.conn.execute(sql, params)]
+
+    def apply(self, mutations: list, reason: str, current: dict):
+        # база занята другим писателем (шард, чекпоинт WAL) дольше busy timeout - повторяем
+        # с паузой; если так и не вышло, ошибка уходит наверх и пачка остаётся в очереди
+        import sqlite3
+        for attempt in range(SQLITE_APPLY_ATTEMPTS):
+            try:
+                self._apply_rows(mutations, current)
+                break
+            except sqlite3.OperationalError as e:
+                if attempt == SQLITE_APPLY_ATTEMPTS - 1 or not _sqlite_busy(e):
+                    raise
+                print(f"⚠️ База sqlite занята ({e}), повтор записи пачки {attempt + 2}/{SQLITE_APPLY_ATTEMPTS}")
+                time.sleep(SQLITE_APPLY_RETRY_DELAY * 2 ** attempt)
+        self._append_log(_journal_records(mutations, reason))
+
+    def _apply_rows(self, mutations: list, current: dict):
+        # из пачки изменений нужны только затронутые пользователи: их актуальное состояние берём из памяти
+        touched = {}
+        with self.conn:
+            for op, user_id, *_ in mutations:
+                if op == 'reset':
+                    self.conn.execute('DELETE FROM users')
+                    touched.clear()
+                    continue
+                touched[user_id] = None
+            rows = []
+            deleted = []
+            for user_id in touched:
+                user_data = current.get(user_id)
+                if user_data is None:
+                    deleted.append((user_id,))
                 else:
-                    fixed_data[user_id_str] = user_data
-            
-            # Убеждаемся что все пользователи имеют все необходимые поля
-            for user_id, user_data in fixed_data.items():
-                if 'warns' not in user_data:
-                    user_data['warns'] = 0
-                if 'banned' not in user_data:
-                    user_data['banned'] = False
-                if 'referral_earnings' not in user_data:
-                    user_data['referral_earnings'] = 0
-                if 'referrals' not in user_data:
-                    user_data['referrals'] = 0
-                if 'balance' not in user_data:
-                    user_data['balance'] = 0  # 0 по умолчанию
+                    rows.append(self._row(user_id, user_data))
+            if deleted:
+                self.conn.executemany('DELETE FROM users WHERE uid = ?', deleted)
+            if rows:
+                self._upsert_many(rows)
+
+    def _append_log(self, records: list[dict]):
+        if self._log_file is None or self._log_file.closed:
+            self._log_file = open(self.log_path, 'a', encoding='utf-8')
+        lines = [json.dumps(record, ensure_ascii=False, default=str) for record in records]
+        start = self._log_file.tell()
+        try:
+            self._log_file.write('\n'.join(lines) + '\n')
+            self._log_file.flush()
+        except Exception:
+            # строки в базе уже записаны, пачка пойдёт повторно - в журнале её обрывка быть не должно
+            log_file, self._log_file = self._log_file, None
+            with contextlib.suppress(Exception):
+                log_file.close()
+            with contextlib.suppress(OSError):
+                os.truncate(self.log_path, start)
+            raise
+
+    def _rotate_log(self):
+        if self._log_file is not None and not self._log_file.closed:
+            self._log_file.close()
+        self._log_file = None
+        _archive_journal_segment(self.log_path)
+        self._last_log_rotation = time.time()
+
+    def replace_all(self, current: dict):
+        with self.conn:
+            self.conn.execute('DELETE FROM users')
+            self._upsert_many([self._row(user_id, user_data) for user_id, user_data in current.items()])
+        self._rotate_log()
+
+    @property
+    def schema_version(self) -> int:
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, version: int):
+        # версию схемы sqlite хранит прямо в заголовке файла базы
+        self.conn.execute(f'PRAGMA user_version = {int(version)}')
+        self.conn.commit()
+
+    def compact(self, current: dict, force: bool = False) -> bool:
+        # не даём WAL-файлу расти бесконечно
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        # журнал изменений уходит в архив по тем же порогам, что и журнал json-хранилища
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except OSError:
+            log_size = 0
+        if log_size and (force or log_size >= JOURNAL_COMPACT_MAX_BYTES
+                         or time.time() - self._last_log_rotation >= JOURNAL_COMPACT_INTERVAL):
+            self._rotate_log()
+        return True
+
+    def backup_sources(self) -> list:
+        def open_copy():
+            # sqlite сам делает согласованную копию; отдельное соединение - чтобы не мешать циклу событий
+            import sqlite3
+            tmp = tempfile.TemporaryFile()
+            tmp_path = f'{self.db_path}.backup.tmp'
+            source = sqlite3.connect(self.db_path)
+            target = sqlite3.connect(tmp_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+            try:
+                with open(tmp_path, 'rb') as copy:
+                    shutil.copyfileobj(copy, tmp)
+            finally:
+                os.remove(tmp_path)
+            size = tmp.tell()
+            tmp.seek(0)
+            return tmp, size
+        return [(os.path.basename(self.db_path), open_copy)]
+
+    def journal_paths(self) -> list[str]:
+        return [self.log_path]
+
+    def close(self):
+        if self._log_file is not None and not self._log_file.closed:
+            self._log_file.close()
+        self.conn.close()
+
+def migrate_json_to_sqlite(json_path: str = DB_FILE, db_path: str = SQLITE_DB_FILE,
+                           journal_path: str = JOURNAL_FILE, force: bool = False) -> int:
+    """разово переносит users_db.json (вместе с журналом) в sqlite, возвращает число перенесённых"""
+    target = SqliteUserStorage(db_path)
+    try:
+        if target.count() > 0 and not force:
+            print(f"⚠️ В {db_path} уже есть пользователи, миграция пропущена")
+            return 0
+        source = JsonUserStorage(json_path, journal_path)
+        data = source.load_all()
+        target.replace_all({str(user_id): user_data for user_id, user_data in data.items()})
+        target.set_schema_version(source.schema_version)
+        print(f"✅ Перенесено {len(data)} пользователей из {json_path} в {db_path}")
+        return len(data)
+    finally:
+        target.close()
+
+def create_user_storage(kind: str = USERS_STORAGE) -> UserStorage:
+    """создаёт хранилище пользователей по его имени"""
+    if kind == 'sqlite':
+        # при первом запуске на sqlite сами подтягиваем старую json-базу
+        if not os.path.exists(SQLITE_DB_FILE) and os.path.exists(DB_FILE):
+            migrate_json_to_sqlite()
+        return SqliteUserStorage()
+    return JsonUserStorage()
+
+user_storage = None  # хранилище открывает open_users() при запуске, а не импорт модуля
+
+def flush_user_changes(reason: str = '') -> int:
+    """отдаёт хранилищу накопленные изменения одной порцией.
+
+    пачка убирается из очереди только после успешной записи: если хранилище упало
+    (нет места, база занята), изменения остаются и уйдут следующим сбросом
+    """
+    global _pending_reasoned
+    if not _pending_mutations:
+        return 0
+    batch = _pending_mutations[:]
+    user_storage.apply(batch, reason, users)
+    _pending_mutations.clear()
+    _pending_reasoned = 0
+    if SHARD_COUNT:
+        _publish_replicas(batch)
+    return len(batch)
+
+def _publish_replicas(batch: list):
+    """рассылает остальным шардам свежие записи своих игроков из сохранённой пачки"""
+    if any(op == 'reset' for op, *_ in batch):
+        # база очищена целиком - остальные перечитают её из хранилища
+        _shard_send('*', {'t': 'reload'})
+        return
+    touched = {}
+    for _, user_id, *_ in batch:
+        if user_id not in touched:
+            user_data = users.get(user_id)
+            touched[user_id] = dict(user_data) if user_data is not None else None
+    _shard_send('*', {'t': 'replica', 'users': touched})
+
+# === отложенная запись пользователей ===
+# обработчики только помечают базу грязной, а одна фоновая задача сбрасывает изменения
+# не чаще раза в USERS_FLUSH_INTERVAL_MS, поэтому пачка спинов превращается в одну запись
+USERS_FLUSH_INTERVAL_MS = int(os.getenv('USERS_FLUSH_INTERVAL_MS', '250'))
+USERS_FLUSH_RETRY_DELAY = 1.0  # пауза перед повтором, если хранилище не приняло пачку
+
+class UsersWriteBehind:
+    """фоновый сброс изменений пользователей с объединением частых save_users()"""
+
+    def __init__(self, interval_ms: int = USERS_FLUSH_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.dirty_since = None  # когда появилось самое старое несохранённое изменение
+        self.pending_marks = 0
+        self.task = None
+        self._wakeup = None
+        # счётчики
+        self.marks = 0
+        self.flushes = 0
+        self.coalesced = 0  # сколько save_users() не стали отдельной записью
+        self.records = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.max_staleness_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def mark_dirty(self):
+        """запоминает, что есть что сохранять; сама запись будет в фоне"""
+        self.marks += 1
+        self.pending_marks += 1
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+            self._wakeup.set()
+
+    def flush_now(self, reason: str = '') -> int:
+        """сразу сбрасывает все накопленные изменения"""
+        started = time.monotonic()
+        written = flush_user_changes(reason)
+        finished = time.monotonic()
+        if self.dirty_since is not None or written:
+            self.flushes += 1
+            self.records += written
+            self.coalesced += max(self.pending_marks - 1, 0)
+            flush_ms = (finished - started) * 1000
+            self.last_flush_ms = flush_ms
+            self.max_flush_ms = max(self.max_flush_ms, flush_ms)
+            self.total_flush_ms += flush_ms
+            if self.dirty_since is not None:
+                self.max_staleness_ms = max(self.max_staleness_ms, (finished - self.dirty_since) * 1000)
+        self.dirty_since = None
+        self.pending_marks = 0
+        return written
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # даём набежать остальным изменениям, но не дольше интервала
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush_now('write-behind')
+            except Exception as e:
+                print(f"❌ Ошибка фоновой записи пользователей: {e}")
+                # изменения остались в очереди - повторяем сами, новых отметок может и не быть
+                await asyncio.sleep(USERS_FLUSH_RETRY_DELAY)
+                self._wakeup.set()
+
+    def start(self):
+        if self.running:
+            return self.task
+        self._wakeup = asyncio.Event()
+        if self.dirty_since is not None:
+            self._wakeup.set()
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def drain(self):
+        """останавливает фоновую задачу и дописывает всё, что осталось (для выключения бота)"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.flush_now('shutdown')
+
+    def stats(self) -> dict:
+        return {
+            'marks': self.marks,
+            'flushes': self.flushes,
+            'coalesced': self.coalesced,
+            'records': self.records,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms,
+            'avg_flush_ms': self.total_flush_ms / self.flushes if self.flushes else 0.0,
+            'max_staleness_ms': self.max_staleness_ms,
+            'staleness_ms': (time.monotonic() - self.dirty_since) * 1000 if self.dirty_since else 0.0,
+        }
+
+users_write_behind = UsersWriteBehind()
+
+async def start_journal_compactor():
+    """фоновая задача: дописывает хвост изменений и обслуживает хранилище по порогу размера или времени"""
+    print("🗜️ Запускаем компактор хранилища пользователей...")
+    while True:
+        try:
+            await asyncio.sleep(JOURNAL_CHECK_INTERVAL)
+            # изменения без save_users() (активность и т.п.) тоже не должны висеть в памяти
+            users_write_behind.flush_now('background')
+            if not _backup_running:  # пока резервная копия читает файлы хранилища, их не подменяем
+                await user_storage.compact_async(users)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка компактора хранилища: {e}")
+
+# === миграции схемы пользователей ===
+# раньше недостающие поля дописывались каждому пользователю при каждой загрузке и каждом
+# сохранении. теперь версия схемы хранится вместе с данными, а шаги миграции выполняются
+# по порядку ровно один раз: новые поля - это новый шаг с следующим номером версии
+USER_MIGRATIONS = []  # [(версия, функция(user_data))] по возрастанию версии
+
+def user_migration(version: int):
+    """регистрирует шаг миграции, который приводит запись пользователя к версии version"""
+    def decorator(func):
+        if USER_MIGRATIONS and USER_MIGRATIONS[-1][0] >= version:
+            raise ValueError(f'миграции должны идти по возрастанию версии: {version}')
+        USER_MIGRATIONS.append((version, func))
+        return func
+    return decorator
+
+def _migration_default(user_data, field: str, value):
+    """дописывает поле, если его нет; миграция пишет мимо журнала - база потом сохраняется целиком"""
+    if field in user_data:
+        return 0
+    if isinstance(user_data, UserRecord):
+        user_data._raw_set(field, value)
+    else:
+        user_data[field] = value
+    return 1
+
+@user_migration(1)
+def _migrate_core_fields(user_data) -> int:
+    """поля модерации и баланса (раньше дописывались в load_users и save_users)"""
+    migrated = 0
+    for field, value in (('warns', 0), ('banned', False), ('referral_earnings', 0),
+                         ('referrals', 0), ('balance', 0)):
+        migrated += _migration_default(user_data, field, value)
+    return migrated
+
+@user_migration(2)
+def _migrate_profile_fields(user_data) -> int:
+    """поля профиля, активности и банка (раньше - migrate_existing_users на каждом старте)"""
+    now = str(datetime.datetime.now())
+    migrated = 0
+    for field, value in (
+        ('registration_date', now),
+        ('last_activity', now),
+        ('total_messages', 0),
+        ('language', 'ru'),
+        ('last_login', now),
+        ('login_count', 1),
+        ('last_bonus_time', 0),
+        ('bank_deposit', 0),
+        ('bank_deposit_time', 0),
+    ):
+        migrated += _migration_default(user_data, field, value)
+    # остальные поля профиля (телефон, почта, настройки...) в UserRecord есть всегда со значением по умолчанию
+    for field in USER_SPARSE_DEFAULTS:
+        migrated += _migration_default(user_data, field, _sparse_default(field))
+    return migrated
+
+USERS_SCHEMA_VERSION = USER_MIGRATIONS[-1][0]
+
+def run_user_migrations(data: dict, from_version: int) -> int:
+    """прогоняет шаги новее from_version по всем пользователям, возвращает число дописанных полей"""
+    migrated = 0
+    for version, migration in USER_MIGRATIONS:
+        if version <= from_version:
+            continue
+        for user_data in data.values():
+            migrated += migration(user_data)
+        print(f"🧬 Схема пользователей: применена миграция до версии {version}")
+    return migrated
+
+def new_user_record(fields: dict | None = None) -> dict:
+    """запись нового пользователя: все поля текущей версии схемы, поверх них - fields.
+
+    миграции теперь идут только при загрузке, поэтому запись, созданная обработчиком,
+    должна сразу получить поля всех версий схемы
+    """
+    user_data = dict(fields or ())
+    for _, migration in USER_MIGRATIONS:
+        migration(user_data)
+    return user_data
+
+def load_users():
+    """Загружает пользователей из хранилища (снапшот + журнал или sqlite)"""
+    # пока создаются сотни тысяч записей, сборщик мусора только мешает
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        data = user_storage.load_all()
+        
+        # Исправляем базу данных: убираем дубликаты и неправильные записи
+        fixed_data = {}
+        
+        for user_id, user_data in data.items():
+            # Конвертируем user_id в строку для единообразия
+            user_id_str = str(user_id)
+
+            # Пропускаем записи с неправильными никами
+            if 'nick' in user_data and user_data['nick'].startswith('/'):
+                continue
             
-            print(f"Загружено {len(fixed_data)} пользователей из БД")
-            return fixed_data
-    except FileNotFoundError:
-        print(f"Файл {DB_FILE} не найден, создаём новую базу данных")
-        return {}
+            # Если пользователь уже есть, оставляем более полную запись
+            if user_id_str in fixed_data:
+                # Сравниваем записи и оставляем ту, у которой больше полей
+                if len(user_data) > len(fixed_data[user_id_str]):
+                    fixed_data[user_id_str] = user_data
+            else:
+                fixed_data[user_id_str] = user_data
+        
+        # недостающие поля дописывает migrate_existing_users() один раз на версию схемы
+        print(f"Загружено {len(fixed_data)} пользователей из БД ({user_storage.name})")
+        return UsersTable.wrap(fixed_data)
     except json.JSONDecodeError as e:
         print(f"Ошибка чтения JSON файла: {e}")
         print("Создаём новую базу данных")
-        return {}
+        return UsersTable()
     except Exception as e:
         print(f"Неожиданная ошибка при загрузке базы данных: {e}")
-        return {}
+        return UsersTable()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+        # загруженная база живёт до конца работы: убираем её из обходов сборщика мусора
+        gc.freeze()
 
-def save_users():
-    """сохраняет пользователей в json файл"""
+def save_users(reason: str | None = None, critical: bool = False):
+    """сохраняет изменения пользователей.
+
+    при запущенной фоновой записи только помечает базу грязной; critical=True
+    (массовые админские действия) пишет сразу, не дожидаясь фоновой задачи
+    """
+    global users, _backup_full_needed
     try:
-        # убеждаемся что все пользователи имеют все необходимые поля перед сохранением
-        for user_id, user_data in users.items():
-            if 'warns' not in user_data:
-                user_data['warns'] = 0
-            if 'banned' not in user_data:
-                user_data['banned'] = False
-            if 'referral_earnings' not in user_data:
-                user_data['referral_earnings'] = 0
-        
-        # проверяем и автоматически расширяем лимит сокращений
-        auto_extend_k_limit()
+        if reason is None:
+            # по умолчанию причина - имя обработчика, который вызвал сохранение
+            reason = sys._getframe(1).f_code.co_name
+        
+        # базу заменили целиком (очистка/исправление) - пишем её полностью
+        if not isinstance(users, UsersTable):
+            users = UsersTable.wrap(users)
+            user_index.rebuild(users)
+            leaderboard.rebuild(users)
+            deposit_index.rebuild(users)
+            _pending_mutations.clear()
+            user_storage.replace_all(users)
+            if SHARD_COUNT:
+                _shard_send('*', {'t': 'reload'})
+            # такая замена не попадает в журнал, поэтому следующая резервная копия - полная
+            _backup_full_needed = True
+            return
         
-        with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        _tag_pending_mutations(reason)
+        if critical or not users_write_behind.running:
+            users_write_behind.flush_now(reason)
+        else:
+            users_write_behind.mark_dirty()
 
     except Exception as e:
         print(f"ошибка сохранения базы данных: {e}")
 
+# === побочные хранилища (промокоды, налоги, чаты) ===
+# раньше каждый save_* переписывал свой json на месте прямо в обработчике - падение посреди
+# записи оставляло обрезанный файл, а каждая активация промокода переписывала его целиком.
+# теперь всеми файлами владеет одна фоновая задача: save_* только отмечают изменение,
+# задача объединяет частые изменения одного файла и пишет его атомарно (временный файл +
+# fsync + rename). кому нужна гарантия записи на диск - ждёт await side_stores.flush(...)
+SIDE_STORES_FLUSH_INTERVAL_MS = int(os.getenv('SIDE_STORES_FLUSH_INTERVAL_MS', '200'))
+SHARD_LOCAL_STORES = {'file_ids', 'dead_recipients'}  # у каждого шарда свои
+
+class SideStoreActor:
+    """единственный писатель побочных json-файлов"""
+
+    def __init__(self, interval_ms: int = SIDE_STORES_FLUSH_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.stores = {}  # имя -> (путь, функция, возвращающая данные для записи)
+        self.versions = {}  # имя -> номер последнего изменения
+        self.written = {}  # имя -> номер изменения, которое уже на диске
+        self.errors = {}  # имя -> последняя ошибка записи
+        self.readonly = set()  # хранилища, которые на этом шарде только читаются
+        self.task = None
+        self._wakeup = None
+        self._urgent = None
+        self._batch_done = None
+        # счётчики
+        self.marks = 0
+        self.writes = 0
+        self.failures = 0
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def register(self, name: str, path: str, get_data):
+        if SHARD_COUNT and SHARD_INDEX:
+            # локальные кэши каждый шард пишет в свой файл, общие файлы пишет только шард 0
+            if name in SHARD_LOCAL_STORES:
+                path = shard_local_path(path)
+            else:
+                self.readonly.add(name)
+        self.stores[name] = (path, get_data)
+        self.versions.setdefault(name, 0)
+        self.written.setdefault(name, 0)
+
+    def mark(self, name: str):
+        """отмечает, что хранилище изменилось; пока задача не запущена - пишет сразу"""
+        if name in self.readonly:
+            return
+        self.marks += 1
+        self.versions[name] += 1
+        if self.running:
+            self._wakeup.set()
+        else:
+            self._write_now(name)
+
+    def _serialize(self, name: str) -> tuple[int, str, str]:
+        # снимок данных делаем в цикле событий, чтобы обработчики не поменяли их посреди записи
+        path, get_data = self.stores[name]
+        return self.versions[name], path, json.dumps(get_data(), ensure_ascii=False, indent=2)
+
+    def _write_now(self, name: str):
+        try:
+            version, path, text = self._serialize(name)
+            _write_text_atomic(path, text)
+            self._written(name, version)
+        except Exception as e:
+            self._failed(name, e)
+
+    def _written(self, name: str, version: int):
+        self.writes += 1
+        self.written[name] = max(self.written[name], version)
+        self.errors.pop(name, None)
+
+    def _failed(self, name: str, error: Exception):
+        self.failures += 1
+        self.errors[name] = error
+        print(f"❌ Ошибка сохранения {self.stores[name][0]}: {error}")
+
+    def _dirty(self) -> list[str]:
+        return [name for name in self.stores if self.versions[name] > self.written[name]]
+
+    async def _write_batch(self):
+        for name in self._dirty():
+            try:
+                version, path, text = self._serialize(name)
+                # сама запись и fsync - в потоке, цикл событий не ждёт диск
+                await asyncio.to_thread(_write_text_atomic, path, text)
+                self._written(name, version)
+            except Exception as e:
+                self._failed(name, e)
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # даём набежать остальным изменениям, если никто не ждёт записи
+            if not self._urgent.is_set():
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._urgent.clear()
+            await self._write_batch()
+            batch_done, self._batch_done = self._batch_done, asyncio.Event()
+            batch_done.set()
+
+    async def flush(self, name: str | None = None):
+        """ждёт, пока все изменения, отмеченные до вызова, окажутся на диске"""
+        names = [name] if name is not None else list(self.stores)
+        targets = {store: self.versions[store] for store in names}
+        if not self.running:
+            for store in names:
+                if self.written[store] < targets[store]:
+                    self._write_now(store)
+        while any(self.written[store] < targets[store] for store in names):
+            if not self.running:
+                raise RuntimeError('запись побочных хранилищ остановлена')
+            batch_done = self._batch_done
+            self._urgent.set()
+            self._wakeup.set()
+            await batch_done.wait()
+            failed = [store for store in names if store in self.errors and self.written[store] < targets[store]]
+            if failed:
+                raise OSError(f"не удалось сохранить {', '.join(failed)}: {self.errors[failed[0]]}")
+
+    def start(self):
+        if self.running:
+            return self.task
+        self._wakeup = asyncio.Event()
+        self._urgent = asyncio.Event()
+        self._batch_done = asyncio.Event()
+        if self._dirty():
+            self._wakeup.set()
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def drain(self):
+        """останавливает задачу и дописывает всё, что осталось (для выключения бота)"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for name in self._dirty():
+            self._write_now(name)
+
+    def stats(self) -> dict:
+        return {
+            'marks': self.marks,
+            'writes': self.writes,
+            'failures': self.failures,
+            'dirty': self._dirty(),
+        }
+
+def _tax_settings_data() -> dict:
+    return {
+        'wealth_tax_percent': WEALTH_TAX_PERCENT,
+        'transfer_commission_top20': TRANSFER_COMMISSION_TOP20,
+        'last_updated': datetime.datetime.now().isoformat()
+    }
+
+side_stores = SideStoreActor()
+side_stores.register('promo_codes', PROMO_CODES_FILE, lambda: promo_codes)
+side_stores.register('tax_settings', TAX_SETTINGS_FILE, _tax_settings_data)
+side_stores.register('bot_chats', CHATS_FILE, lambda: bot_chats)
+
 def save_promo_codes():
-    """сохраняет промокоды в JSON файл"""
-    try:
-        with open('promo_codes.json', 'w', encoding='utf-8') as f:
-            json.dump(promo_codes, f, ensure_ascii=False, indent=2)
-        print(f"✅ Промокоды сохранены: {len(promo_codes)} шт.")
-    except Exception as e:
-        print(f"❌ Ошибка сохранения промокодов: {e}")
+    """отмечает изменение промокодов; файл запишет side_stores"""
+    side_stores.mark('promo_codes')
 
 def load_promo_codes():
     """загружает промокоды из JSON файла"""
     global promo_codes
     try:
-        with open('promo_codes.json', 'r', encoding='utf-8') as f:
+        with open(PROMO_CODES_FILE, 'r', encoding='utf-8') as f:
             promo_codes = json.load(f)
         print(f"✅ Промокоды загружены: {len(promo_codes)} шт.")
     except FileNotFoundError:
@@ -289,14 +3027,20 @@ def activate_promo(promo_code: str, user_id: str) -> tuple[bool, str, int]:
     
     return True, "промокод активирован!", promo['reward']
 
+async def activate_promo_shared(promo_code: str, user_id: str) -> tuple[bool, str, int]:
+    """активирует промокод там, где лежат промокоды: с другого шарда спрашивает шард 0"""
+    if SHARD_COUNT and SHARD_INDEX:
+        return tuple(await shard_link.call(0, 'activate_promo', [promo_code, user_id]))
+    return activate_promo(promo_code, user_id)
+
 async def activate_promo_from_link(message: types.Message, user_id_str: str, promo_code: str):
     """активирует промокод по ссылке и показывает результат"""
     # Активируем промокод
-    success, message_text, reward = activate_promo(promo_code, user_id_str)
+    success, message_text, reward = await activate_promo_shared(promo_code, user_id_str)
     
     if success:
         # начисляем награду
-        users[user_id_str]['balance'] += reward
+        credit(user_id_str, reward, 'promo_link')
         save_users()
         
         # показываем успешное сообщение
@@ -344,74 +3088,497 @@ def load_tax_settings():
 
 def save_tax_settings():
     
-    """Сохраняет настройки налога в JSON файл"""
+    """отмечает изменение настроек налога; файл запишет side_stores"""
+    side_stores.mark('tax_settings')
+
+# === кэш file_id картинок ===
+# меню, старт, справка рулетки и баскетбол загружали одни и те же файлы с диска при каждом
+# показе (а меню ещё и перебирало несколько путей, включая пути с рабочего стола windows).
+# теперь каждая картинка загружается в телеграм один раз: полученный file_id запоминается
+# по хэшу содержимого и сохраняется в file_ids.json, а дальше отправляется только id.
+# если телеграм перестал узнавать id (сменили токен бота и т.п.) - загружаем файл заново
+FILE_IDS_FILE = 'file_ids.json'
+PLAYER_IMAGE_PATHS = (
+    'img/plyer_default.jpg',
+    './img/plyer_default.jpg',
+    'img/player_default.jpg',
+    './img/player_default.jpg',
+    'C:/Users/User/Desktop/dodeper bot/img/plyer_default.jpg',
+    'C:/Users/User/Desktop/dodeper bot/img/player_default.jpg',
+)
+
+class PhotoAsset:
+    """картинка в памяти вместе с хэшем содержимого, по которому ищется её file_id"""
+    __slots__ = ('data', 'filename', 'digest')
+
+    def __init__(self, data: bytes, filename: str):
+        self.data = data
+        self.filename = filename
+        self.digest = hashlib.sha256(data).hexdigest()
+
+def load_file_ids() -> dict:
     try:
-        data = {
-            'wealth_tax_percent': WEALTH_TAX_PERCENT,
-            'transfer_commission_top20': TRANSFER_COMMISSION_TOP20,
-            'last_updated': datetime.datetime.now().isoformat()
-        }
-        with open(TAX_SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"✅ Настройки налога сохранены: {WEALTH_TAX_PERCENT}%")
+        with open(FILE_IDS_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            if isinstance(data, dict):
+                return data
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        print(f"❌ Ошибка сохранения настроек налога: {e}")
+        safe_print(f"не удалось загрузить кэш file_id: {e}")
+    return {}
 
-def create_backup():
-    """Создает резервную копию базы данных"""
+file_ids: dict[str, str] = load_file_ids()  # sha256 содержимого -> file_id
+side_stores.register('file_ids', FILE_IDS_FILE, lambda: file_ids)
+
+_static_assets = {}  # пути-кандидаты -> PhotoAsset или None, если файла нет
+
+def static_photo(*paths: str) -> PhotoAsset | None:
+    """картинка с диска: первый существующий из путей читается один раз за запуск"""
+    if paths in _static_assets:
+        return _static_assets[paths]
+    asset = None
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                asset = PhotoAsset(f.read(), os.path.basename(path))
+            break
+        except OSError:
+            continue
+    _static_assets[paths] = asset
+    return asset
+
+def _is_stale_file_id_error(error: Exception) -> bool:
+    return isinstance(error, TelegramBadRequest) and 'file' in str(error).lower()
+
+async def send_photo_asset(chat_id, asset: PhotoAsset, **kwargs) -> types.Message:
+    """отправляет картинку по сохранённому file_id, а если его нет или он устарел - загружает"""
+    file_id = file_ids.get(asset.digest)
+    if file_id is not None:
+        try:
+            return await bot.send_photo(chat_id, file_id, **kwargs)
+        except Exception as e:
+            if not _is_stale_file_id_error(e):
+                raise
+            print(f"⚠️ file_id для {asset.filename} больше не принимается, загружаем заново: {e}")
+            file_ids.pop(asset.digest, None)
+            side_stores.mark('file_ids')
+    message = await bot.send_photo(chat_id, types.BufferedInputFile(asset.data, filename=asset.filename), **kwargs)
+    if message.photo:
+        file_ids[asset.digest] = message.photo[-1].file_id
+        side_stores.mark('file_ids')
+    return message
+
+# === резервные копии ===
+# полная копия - это снапшот и журнал хранилища, потоково сжатые в tar.gz в отдельном потоке.
+# между полными пишутся дельты: gzip-json только с пользователями, изменёнными после прошлой
+# копии. точки копий и их sha256 лежат в backup/manifest.json, старые точки чистятся по
+# уровням (почасовые, ежедневные, еженедельные), а restore_backup собирает любую точку
+BACKUP_DIR = 'backup'
+BACKUP_MANIFEST_FILE = os.path.join(BACKUP_DIR, 'manifest.json')
+BACKUP_INTERVAL = 1800  # копия раз в 30 минут
+BACKUP_FULL_INTERVAL = 6 * 3600  # полная копия не реже раза в 6 часов, между ними - дельты
+BACKUP_RETENTION = (  # (длина интервала в секундах, сколько последних интервалов хранить)
+    (3600, 48),  # по копии на каждый час за двое суток
+    (86400, 14),  # по копии на день за две недели
+    (7 * 86400, 8),  # по копии на неделю за два месяца
+)
+_backup_running = False
+
+def _load_backup_manifest() -> dict:
     try:
-        # Создаем папку backup если её нет
-        if not os.path.exists('backup'):
-            os.makedirs('backup')
-        
-        # Генерируем имя файла с текущей датой и временем
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_filename = f'backup/users_backup_{timestamp}.json'
-        
-        # Копируем текущую базу данных
-        with open(DB_FILE, 'r', encoding='utf-8') as source:
-            data = json.load(source)
+        with open(BACKUP_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {'points': []}
+    manifest.setdefault('points', [])
+    return manifest
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _backup_point_name(kind: str, created: float, extension: str) -> str:
+    timestamp = datetime.datetime.fromtimestamp(created).strftime('%Y%m%d_%H%M%S')
+    name = f'users_{kind}_{timestamp}{extension}'
+    counter = 1
+    while os.path.exists(os.path.join(BACKUP_DIR, name)):
+        name = f'users_{kind}_{timestamp}_{counter}{extension}'
+        counter += 1
+    return name
+
+def _write_full_backup(path: str, sources: list):
+    """потоково сжимает файлы хранилища в tar.gz (вызывается в потоке)"""
+    tmp_path = f'{path}.tmp'
+    with tarfile.open(tmp_path, 'w:gz', compresslevel=6) as archive:
+        for arcname, open_source in sources:
+            f, size = open_source()
+            try:
+                info = tarfile.TarInfo(arcname)
+                info.size = size
+                info.mtime = int(time.time())
+                archive.addfile(info, f)
+            finally:
+                f.close()
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _write_delta_backup(path: str, delta: dict):
+    """сжимает дельту в gzip-json (вызывается в потоке)"""
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(delta, f, ensure_ascii=False, default=str)
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+async def create_backup(force_full: bool = False) -> bool:
+    """Создает резервную копию базы данных: полную или дельту с прошлой копии"""
+    global _backup_running, _backup_full_needed
+    if _backup_running:
+        print("⚠️ Резервная копия уже создаётся, пропускаем")
+        return False
+    _backup_running = True
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        manifest = _load_backup_manifest()
+        points = manifest['points']
+        last_full = next((point for point in reversed(points) if point['kind'] == 'full'), None)
+        created = time.time()
+        
+        # всё, что уже изменено, сначала уходит в хранилище - копия видит актуальное состояние
+        users_write_behind.flush_now('backup')
+        full = (force_full or _backup_full_needed or last_full is None or not points
+                or created - last_full['created'] >= BACKUP_FULL_INTERVAL
+                or len(_backup_changed) * 2 >= len(users))
+        
+        if full:
+            sources = user_storage.backup_sources()
+            name = _backup_point_name('full', created, '.tar.gz')
+            point = {'name': name, 'kind': 'full', 'base': name, 'prev': None}
+            job = lambda: _write_full_backup(os.path.join(BACKUP_DIR, name), sources)
+        else:
+            changed = {}
+            deleted = []
+            for user_id in _backup_changed:
+                user_data = users.get(user_id)
+                if user_data is None:
+                    deleted.append(user_id)
+                else:
+                    changed[user_id] = dict(user_data)
+            name = _backup_point_name('delta', created, '.json.gz')
+            point = {'name': name, 'kind': 'delta', 'base': last_full['name'], 'prev': points[-1]['name']}
+            delta = {'base': point['base'], 'prev': point['prev'], 'created': created,
+                     'changed': changed, 'deleted': deleted}
+            job = lambda: _write_delta_backup(os.path.join(BACKUP_DIR, name), delta)
+            sources = []
+        # с этого момента изменения копятся уже для следующей копии
+        changed_count = len(_backup_changed)
+        _backup_changed.clear()
+        _backup_full_needed = False
+        point.update({'created': created, 'users': len(users), 'changed': changed_count})
         
-        with open(backup_filename, 'w', encoding='utf-8') as target:
-            json.dump(data, target, ensure_ascii=False, indent=2)
+        try:
+            await asyncio.to_thread(job)
+            point['sha256'] = await asyncio.to_thread(_sha256_file, os.path.join(BACKUP_DIR, name))
+        except Exception:
+            # точка не записалась - следующая копия должна быть полной, иначе в цепочке будет дыра
+            _backup_full_needed = True
+            raise
+        point['bytes'] = os.path.getsize(os.path.join(BACKUP_DIR, name))
+        points.append(point)
+        _write_json_atomic(BACKUP_MANIFEST_FILE, manifest)
         
-        print(f"✅ Резервная копия создана: {backup_filename}")
+        print(f"✅ Резервная копия создана: {os.path.join(BACKUP_DIR, name)} "
+              f"({'полная' if full else f'дельта, изменено {changed_count}'}, {point['bytes'] // 1024} кб)")
         
-        # Удаляем старые резервные копии (оставляем только последние 10)
-        cleanup_old_backups()
+        # Удаляем старые резервные копии по уровням хранения
+        await asyncio.to_thread(cleanup_old_backups)
         
         return True
     except Exception as e:
         print(f"❌ Ошибка создания резервной копии: {e}")
         return False
+    finally:
+        _backup_running = False
+
+def _backup_points_to_keep(points: list, now: float) -> set:
+    """выбирает точки по уровням хранения и добавляет всё, без чего их не восстановить"""
+    by_name = {point['name']: point for point in points}
+    keep = set()
+    if points:
+        keep.add(points[-1]['name'])
+    for bucket_seconds, bucket_count in BACKUP_RETENTION:
+        newest_in_bucket = {}
+        for point in points:
+            bucket = int((now - point['created']) // bucket_seconds)
+            if 0 <= bucket < bucket_count:
+                newest_in_bucket[bucket] = point['name']  # точки идут по времени, остаётся самая свежая
+        keep.update(newest_in_bucket.values())
+    # дельте нужны её полная копия и все предыдущие дельты цепочки
+    for name in list(keep):
+        point = by_name[name]
+        while point is not None and point['kind'] == 'delta':
+            keep.add(point['base'])
+            point = by_name.get(point['prev'])
+            if point is not None:
+                keep.add(point['name'])
+    return keep
+
+def _maintain_journal_archive(oldest_point_time: float | None):
+    """сжимает свёрнутые куски журнала и удаляет те, что старше самой старой резервной копии"""
+    try:
+        names = sorted(os.listdir(JOURNAL_ARCHIVE_DIR))
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(JOURNAL_ARCHIVE_DIR, name)
+        modified = os.path.getmtime(path)
+        if oldest_point_time is not None and modified < oldest_point_time - RESTORE_JOURNAL_OVERLAP:
+            # ни одна оставшаяся копия не доберётся до этих записей
+            os.remove(path)
+            continue
+        if name.endswith('.jsonl'):
+            with open(path, 'rb') as source, gzip.open(f'{path}.gz.tmp', 'wb', compresslevel=6) as target:
+                shutil.copyfileobj(source, target)
+            # время изменения сохраняем: по нему восстановление решает, какие куски читать
+            os.utime(f'{path}.gz.tmp', (modified, modified))
+            os.replace(f'{path}.gz.tmp', f'{path}.gz')
+            os.remove(path)
 
 def cleanup_old_backups():
-    """Удаляет старые резервные копии, оставляя только последние 10"""
+    """Удаляет резервные копии, которые не нужны ни одному уровню хранения"""
     try:
-        if not os.path.exists('backup'):
+        manifest = _load_backup_manifest()
+        keep = _backup_points_to_keep(manifest['points'], time.time())
+        removed = [point for point in manifest['points'] if point['name'] not in keep]
+        kept_times = [point['created'] for point in manifest['points'] if point['name'] in keep]
+        _maintain_journal_archive(min(kept_times) if kept_times else None)
+        if not removed:
             return
         
-        # Получаем список всех файлов резервных копий
-        backup_files = []
-        for filename in os.listdir('backup'):
-            if filename.startswith('users_backup_') and filename.endswith('.json'):
-                file_path = os.path.join('backup', filename)
-                backup_files.append((file_path, os.path.getmtime(file_path)))
-        
-        # Сортируем по времени создания (новые первыми)
-        backup_files.sort(key=lambda x: x[1], reverse=True)
-        # Удаляем старые файлы, оставляя только последние 10
-        if len(backup_files) > 10:
-            for file_path, _ in backup_files[10:]:
-                try:
-                    os.remove(file_path)
-                    print(f"🗑️ Удалена старая резервная копия: {file_path}")
-                except Exception as e:
-                    print(f"❌ Ошибка удаления файла {file_path}: {e}")
+        manifest['points'] = [point for point in manifest['points'] if point['name'] in keep]
+        _write_json_atomic(BACKUP_MANIFEST_FILE, manifest)
+        for point in removed:
+            file_path = os.path.join(BACKUP_DIR, point['name'])
+            try:
+                os.remove(file_path)
+                print(f"🗑️ Удалена старая резервная копия: {file_path}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"❌ Ошибка удаления файла {file_path}: {e}")
                     
     except Exception as e:
         print(f"❌ Ошибка очистки старых резервных копий: {e}")
 
+def _verify_backup_point(point: dict):
+    path = os.path.join(BACKUP_DIR, point['name'])
+    actual = _sha256_file(path)
+    if actual != point.get('sha256'):
+        raise ValueError(f"контрольная сумма {point['name']} не совпадает: {actual} != {point.get('sha256')}")
+
+def _read_full_backup(path: str) -> tuple[dict, dict]:
+    """распаковывает полную копию во временную папку и читает её как хранилище"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with tarfile.open(path, 'r:gz') as archive:
+            names = archive.getnames()
+            for member in archive.getmembers():
+                # в архиве только плоские файлы хранилища, ничего за пределы папки не распаковываем
+                if not member.isfile() or os.path.basename(member.name) != member.name:
+                    raise ValueError(f'неожиданный файл в резервной копии: {member.name}')
+                archive.extract(member, tmp_dir)
+        sqlite_names = [name for name in names if name.endswith(('.sqlite3', '.sqlite', '.db'))]
+        if sqlite_names:
+            import sqlite3
+            conn = sqlite3.connect(os.path.join(tmp_dir, sqlite_names[0]))
+            try:
+                data = {user_id: json.loads(raw) for user_id, raw in conn.execute('SELECT uid, data FROM users')}
+                meta = {'schema_version': conn.execute('PRAGMA user_version').fetchone()[0]}
+            finally:
+                conn.close()
+            return data, meta
+        data = {}
+        for name in names:
+            if not name.endswith(('.jsonl', '.compacting')):
+                data = _read_snapshot_file(os.path.join(tmp_dir, name))
+                break
+        # как при загрузке: сначала отложенный кусок журнала, потом свежий
+        for name in sorted((name for name in names if name.endswith(('.jsonl', '.compacting'))),
+                           key=lambda name: not name.endswith('.compacting')):
+            replay_journal(data, os.path.join(tmp_dir, name))
+        meta = data.pop(USERS_META_KEY, None)
+        return data, (meta if isinstance(meta, dict) else {})
+
+def _rebuild_backup_point(point: dict, by_name: dict) -> tuple[dict, dict]:
+    """собирает состояние точки: полная копия плюс дельты цепочки, с проверкой sha256 каждого файла"""
+    chain = []
+    current = point
+    while current['kind'] == 'delta':
+        chain.append(current)
+        current = by_name.get(current['prev'])
+        if current is None:
+            raise ValueError(f"цепочка {point['name']} неполная: нет предыдущей точки")
+    chain.append(current)
+    chain.reverse()
+    for item in chain:
+        _verify_backup_point(item)
+    
+    data, meta = _read_full_backup(os.path.join(BACKUP_DIR, chain[0]['name']))
+    for item in chain[1:]:
+        with gzip.open(os.path.join(BACKUP_DIR, item['name']), 'rt', encoding='utf-8') as f:
+            delta = json.load(f)
+        data.update(delta['changed'])
+        for user_id in delta['deleted']:
+            data.pop(user_id, None)
+    if len(data) != point['users']:
+        # sqlite копируется чуть позже момента точки, так что небольшое расхождение возможно
+        print(f"⚠️ После восстановления {len(data)} пользователей, а в точке копии {point['users']}")
+    return data, meta
+
+def restore_backup(point_name: str | None = None, target_path: str = 'restored_users_db.json') -> int:
+    """собирает состояние на момент точки копии (полная + дельты) в отдельный json-снапшот"""
+    points = _load_backup_manifest()['points']
+    if not points:
+        raise ValueError('резервных копий нет')
+    by_name = {point['name']: point for point in points}
+    point = by_name.get(point_name) if point_name else points[-1]
+    if point is None:
+        raise ValueError(f'точка {point_name} не найдена в {BACKUP_MANIFEST_FILE}')
+    
+    data, meta = _rebuild_backup_point(point, by_name)
+    if meta:
+        data = {USERS_META_KEY: meta, **data}
+    _write_json_atomic(target_path, data)
+    count = len(data) - (USERS_META_KEY in data)
+    print(f"✅ Точка {point['name']} восстановлена в {target_path}: {count} пользователей "
+          f"(контрольные суммы сошлись)")
+    return count
+
+# === восстановление на момент времени ===
+# ближайшая резервная копия не позже нужного момента плюс журнал изменений от неё до этого
+# момента. свёрнутые куски журнала лежат в backup/journal, живые - у хранилища. записи журнала
+# задают итоговое значение поля, поэтому небольшой нахлёст журнала с копией безопасен
+RESTORE_JOURNAL_OVERLAP = 5  # секунд журнала до точки копии, которые накатываем повторно
+
+def parse_restore_time(text: str) -> float:
+    """понимает unix-время и 'ГГГГ-ММ-ДД ЧЧ:ММ[:СС]' по местному времени"""
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M'):
+        try:
+            return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f'не понял время: {text} (нужно ГГГГ-ММ-ДД ЧЧ:ММ[:СС] или unix-время)')
+
+def _journal_segments_since(since: float) -> list[str]:
+    """куски журнала, в которых могут быть записи новее since, от старых к новым"""
+    segments = []
+    try:
+        names = sorted(os.listdir(JOURNAL_ARCHIVE_DIR))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith(('.jsonl', '.jsonl.gz')):
+            continue
+        path = os.path.join(JOURNAL_ARCHIVE_DIR, name)
+        # кусок уходит в архив после своей последней записи: старый кусок можно не открывать
+        if os.path.getmtime(path) < since:
+            continue
+        segments.append(path)
+    segments.extend(path for path in user_storage.journal_paths() if os.path.exists(path))
+    return segments
+
+def restore_point_in_time(target_time: float, user_id: str | None = None) -> tuple[dict, dict]:
+    """восстанавливает пользователей (или одного) на момент target_time.
+
+    возвращает (пользователи, сведения о восстановлении). тяжёлое чтение файлов -
+    из бота вызывать через asyncio.to_thread
+    """
+    points = _load_backup_manifest()['points']
+    by_name = {point['name']: point for point in points}
+    candidates = [point for point in points if point['created'] <= target_time]
+    if not candidates:
+        raise ValueError('нет резервной копии раньше этого момента')
+    point = candidates[-1]
+    
+    started = time.perf_counter()
+    data, _meta = _rebuild_backup_point(point, by_name)
+    if user_id is not None:
+        data = {user_id: data[user_id]} if user_id in data else {}
+    since = point['created'] - RESTORE_JOURNAL_OVERLAP
+    replayed = 0
+    segments = _journal_segments_since(since)
+    for path in segments:
+        replayed += replay_journal(data, path, since=since, until=target_time, user_id=user_id)
+    data.pop(USERS_META_KEY, None)
+    if user_id is not None:
+        # очистка базы в журнале сбрасывает всех - оставляем только нужного пользователя
+        data = {user_id: data[user_id]} if user_id in data else {}
+    info = {
+        'point': point['name'],
+        'point_time': point['created'],
+        'segments': len(segments),
+        'replayed': replayed,
+        'seconds': time.perf_counter() - started,
+    }
+    return data, info
+
+def diff_users(current: dict, restored: dict, user_id: str | None = None) -> list[str]:
+    """построчная разница между текущими и восстановленными пользователями"""
+    user_ids = [user_id] if user_id is not None else sorted(set(current) | set(restored))
+    lines = []
+    for uid in user_ids:
+        before = current.get(uid)
+        after = restored.get(uid)
+        if before == after:
+            continue
+        if after is None:
+            lines.append(f"{uid}: будет удалён ({before.get('nick', 'без ника')})")
+            continue
+        if before is None:
+            lines.append(f"{uid}: будет возвращён ({after.get('nick', 'без ника')})")
+            continue
+        before = dict(before)
+        for field in sorted(set(before) | set(after)):
+            if before.get(field) != after.get(field):
+                lines.append(f"{uid}: {field}: {before.get(field)!r} -> {after.get(field)!r}")
+    return lines
+
+def apply_restored_users(restored: dict, user_id: str | None = None) -> int:
+    """записывает восстановленных пользователей в живую базу через обычный журнал, возвращает число изменённых"""
+    user_ids = [user_id] if user_id is not None else list(set(users) | set(restored))
+    changed = 0
+    for uid in user_ids:
+        before = users.get(uid)
+        after = restored.get(uid)
+        if before == after:
+            continue
+        if after is None:
+            del users[uid]
+        elif before is None:
+            users[uid] = after
+        else:
+            # в журнал уходят только отличающиеся поля, а не запись целиком
+            current = dict(before)
+            for field, value in after.items():
+                if field not in current or current[field] != value:
+                    before[field] = value
+            for field in current.keys() - after.keys():
+                del before[field]
+        changed += 1
+    if changed:
+        save_users('restore_point_in_time', critical=True)
+    return changed
+
 async def start_backup_scheduler():
     """Запускает планировщик резервного копирования каждые 30 минут"""
     print("💾 Запускаем планировщик резервного копирования...")
@@ -426,8 +3593,8 @@ async def start_backup_scheduler():
     try:
         while True:
             try:
-                # Создаем резервную копию
-                success = create_backup()
+                # Создаем резервную копию (полную или дельту - решает create_backup)
+                success = await create_backup()
                 
                 if success:
                     print(f"💾 Резервная копия создана в {datetime.datetime.now().strftime('%H:%M:%S')}")
@@ -435,7 +3602,7 @@ async def start_backup_scheduler():
                     print(f"❌ Ошибка создания резервной копии в {datetime.datetime.now().strftime('%H:%M:%S')}")
                 
                 # Ждем 30 минут (1800 секунд)
-                await asyncio.sleep(1800)
+                await asyncio.sleep(BACKUP_INTERVAL)
                 
             except Exception as e:
                 print(f"❌ Ошибка в планировщике резервного копирования: {e}")
@@ -448,123 +3615,45 @@ def is_top20_player(user_id: str) -> bool:
     
     """Проверяет, является ли игрок топ-20"""
     try:
-        top_20_players = get_top_players()[:20]
-        return user_id in [str(uid) for uid, _ in top_20_players]
+        return leaderboard.in_top(str(user_id), 20)
     except Exception as e:
         print(f"❌ Ошибка при проверке топ-20 игрока {user_id}: {e}")
         return False
 
 def migrate_existing_users():
-    """Мигрирует существующих пользователей, добавляя новые поля"""
-    migrated_count = 0
-    
-    for user_id, user_data in users.items():
-        # Добавляем недостающие поля
-        if 'registration_date' not in user_data:
-            user_data['registration_date'] = str(datetime.datetime.now())
-            migrated_count += 1
-        
-        if 'last_activity' not in user_data:
-            user_data['last_activity'] = str(datetime.datetime.now())
-            migrated_count += 1
-        
-        if 'total_messages' not in user_data:
-            user_data['total_messages'] = 0
-            migrated_count += 1
-        
-        if 'phone_number' not in user_data:
-            user_data['phone_number'] = None
-            migrated_count += 1
-        
-        if 'email' not in user_data:
-            user_data['email'] = None
-            migrated_count += 1
-        
-        if 'age' not in user_data:
-            user_data['age'] = None
-            migrated_count += 1
-        
-        if 'city' not in user_data:
-            user_data['city'] = None
-            migrated_count += 1
-        
-        if 'country' not in user_data:
-            user_data['country'] = None
-            migrated_count += 1
-        
-        if 'language' not in user_data:
-            user_data['language'] = 'ru'
-            migrated_count += 1
-        
-        if 'device_info' not in user_data:
-            user_data['device_info'] = None
-            migrated_count += 1
-        
-        if 'ip_address' not in user_data:
-            user_data['ip_address'] = None
-            migrated_count += 1
-        
-        if 'referral_source' not in user_data:
-            user_data['referral_source'] = 'direct'
-            migrated_count += 1
-        
-        if 'account_type' not in user_data:
-            user_data['account_type'] = 'regular'
-            migrated_count += 1
-        
-        if 'verification_status' not in user_data:
-            user_data['verification_status'] = 'unverified'
-            migrated_count += 1
-        
-        if 'security_level' not in user_data:
-            user_data['security_level'] = 'basic'
-            migrated_count += 1
-        
-        if 'premium_features' not in user_data:
-            user_data['premium_features'] = False
-            migrated_count += 1
-        
-        if 'last_login' not in user_data:
-            user_data['last_login'] = str(datetime.datetime.now())
-            migrated_count += 1
-        
-        if 'login_count' not in user_data:
-            user_data['login_count'] = 1
-            migrated_count += 1
-        
-        if 'session_duration' not in user_data:
-            user_data['session_duration'] = 0
-            migrated_count += 1
-        
-        if 'last_bonus_time' not in user_data:
-            user_data['last_bonus_time'] = 0
-            migrated_count += 1
-        
-        if 'preferences' not in user_data:
-            user_data['preferences'] = {
-                'notifications': True,
-                'privacy_mode': False,
-                'auto_save': True
-            }
-            migrated_count += 1
-        
-        if 'bank_deposit' not in user_data:
-            user_data['bank_deposit'] = 0
-            migrated_count += 1
-        
-        if 'bank_deposit_time' not in user_data:
-            user_data['bank_deposit_time'] = 0
-            migrated_count += 1
-    
-    if migrated_count > 0:
-        print(f"Мигрировано {migrated_count} полей для существующих пользователей")
-        save_users()
-    
+    """доводит базу до текущей версии схемы; если она уже актуальна - ничего не перебирает"""
+    current_version = user_storage.schema_version
+    if current_version > USERS_SCHEMA_VERSION:
+        print(f"⚠️ Версия схемы пользователей в хранилище ({current_version}) новее кода ({USERS_SCHEMA_VERSION})")
+        return 0
+    if current_version == USERS_SCHEMA_VERSION:
+        return 0
+    
+    migrated_count = run_user_migrations(users, current_version)
+    print(f"Мигрировано {migrated_count} полей для существующих пользователей")
+    try:
+        # всё, что накопилось до миграции, уходит первым; затем база целиком и только потом версия -
+        # если упадём посередине, миграция просто повторится на следующем старте
+        flush_user_changes('migrate_existing_users')
+        user_storage.replace_all(users)
+        user_storage.set_schema_version(USERS_SCHEMA_VERSION)
+    except Exception as e:
+        print(f"❌ Ошибка сохранения миграции схемы пользователей: {e}")
     return migrated_count
 
-# Загружаем пользователей при запуске
-users = load_users()
-safe_print("загружены пользователи")
+# пользователей загружает open_users() при запуске (main, фронт шардов, cli-команды):
+# импорт модуля не открывает базу и ничего в ней не меняет
+users = UsersTable()
+
+def open_users():
+    """открывает хранилище и загружает из него пользователей вместе с индексами"""
+    global user_storage, users
+    user_storage = create_user_storage()
+    users = load_users()
+    user_index.rebuild(users)
+    leaderboard.rebuild(users)
+    deposit_index.rebuild(users)
+    safe_print("загружены пользователи")
 
 
 
@@ -583,11 +3672,8 @@ def load_bot_chats() -> list[int]:
     return []
 
 def save_bot_chats(chats: list[int]):
-    try:
-        with open(CHATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(chats, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        safe_print(f"не удалось сохранить список чатов: {e}")
+    # пишется всегда глобальный bot_chats (его и передают), файл запишет side_stores
+    side_stores.mark('bot_chats')
 
 bot_chats: list[int] = load_bot_chats()
 @dp.callback_query(lambda c: c.data in ['bc_target_dm','bc_target_chats','bc_target_chats_ex_main','bc_cancel'])
@@ -633,6 +3719,10 @@ async def on_my_chat_member(update: types.ChatMemberUpdated):
     try:
         chat_id = update.chat.id
         status = update.new_chat_member.status
+        if status in ('member', 'administrator'):
+            dead_recipients.revive(chat_id)
+        elif status == 'kicked':  # в лс это значит, что бота заблокировали
+            dead_recipients.mark(chat_id, 'blocked' if update.chat.type == 'private' else 'kicked')
         if status in ('member', 'administrator'):  # бот добавлен/есть доступ
             if chat_id not in bot_chats:
                 bot_chats.append(chat_id)
@@ -644,8 +3734,12 @@ async def on_my_chat_member(update: types.ChatMemberUpdated):
     except Exception as e:
         safe_print(f"ошибка обновления списка чатов: {e}")
 
-# Мигрируем существующих пользователей
-migrate_existing_users()
+# подписки на канал: приходят, только если бот в нём админ
+@dp.chat_member()
+async def on_channel_member(update: types.ChatMemberUpdated):
+    if (update.chat.username or '').lower() != SUBSCRIPTION_CHANNEL:
+        return
+    subscription_cache.update(update.new_chat_member.user.id, update.new_chat_member.status not in ('left', 'kicked'))
 
 class RegisterState(StatesGroup):
     waiting_for_nick = State()
@@ -721,6 +3815,9 @@ def update_user_activity(user_id: str):
 
 def collect_user_info(message: types.Message, user_id: str):
     """Собирает дополнительную информацию о пользователе"""
+    # написал боту в лс - значит, снова его не блокирует
+    if message.chat.type == 'private' and int(user_id) in dead_recipients.entries:
+        dead_recipients.revive(user_id)
     if user_id in users:
         user_data = users[user_id]
     
@@ -731,6 +3828,11 @@ def collect_user_info(message: types.Message, user_id: str):
         if hasattr(message.from_user, 'language_code'):
             user_data['language'] = message.from_user.language_code or 'ru'
         
+        # Обновляем юзернейм, если пользователь его сменил (индекс обновится сам)
+        username = message.from_user.username
+        if username and 'nick' in user_data and user_data.get('tg_username') != username:
+            user_data['tg_username'] = username
+        
         # Обновляем счетчик сообщений
         user_data['total_messages'] = user_data.get('total_messages', 0) + 1
         
@@ -802,13 +3904,8 @@ def parse_amount(text):
 
 def auto_extend_k_limit():
     """автоматически расширяет лимит сокращений на основе максимального баланса игроков"""
-    max_balance = 0
-    
-    # находим максимальный баланс среди всех игроков
-    for user_data in users.values():
-        balance = user_data.get('balance', 0)
-        if balance > max_balance:
-            max_balance = balance
+    # максимальный баланс берём из рейтинга, он обновляется при каждом изменении баланса
+    max_balance = leaderboard.max_balance()
     
     # если максимальный баланс больше 10^15 (1кккк), добавляем еще одну "к"
     if max_balance > 10**15:
@@ -836,9 +3933,7 @@ def extract_username(text: str) -> str:
 
 async def generate_referral_link(user_id: int) -> str:
     """Генерирует реферальную ссылку"""
-    bot_info = await bot.get_me()
-    
-    bot_username = bot_info.username
+    bot_username = telegram_metadata.bot_username or (await telegram_metadata.get_me()).username
     return f"https://t.me/{bot_username}?start=ref{user_id}"
 
 def get_random_referral_bonus() -> int:
@@ -934,29 +4029,22 @@ async def show_menu(message: types.Message, user_id: int, state: FSMContext = No
         
         # пробуем отправить картинку с приветствием
         try:
-            image_paths = [
-    
-    'img/plyer_default.jpg',
-                './img/plyer_default.jpg',
-                'C:/Users/User/Desktop/dodeper bot/img/plyer_default.jpg'
-            ]
+            image = static_photo(*PLAYER_IMAGE_PATHS)
             
             image_sent = False
             
-            for image_path in image_paths:
+            if image is not None:
                 try:
-                    if os.path.exists(image_path):
-                        await bot.send_photo(
-                            message.chat.id,
-                            types.FSInputFile(image_path),
-                            caption=menu_text,
-                            parse_mode='HTML',
-                            reply_markup=markup
-                        )
-                        image_sent = True
-                        break
+                    await send_photo_asset(
+                        message.chat.id,
+                        image,
+                        caption=menu_text,
+                        parse_mode='HTML',
+                        reply_markup=markup
+                    )
+                    image_sent = True
                 except Exception as e:
-                    continue
+                    pass
             
             if not image_sent:
                 await message.answer(menu_text, parse_mode='HTML', reply_markup=markup)
@@ -966,35 +4054,23 @@ async def show_menu(message: types.Message, user_id: int, state: FSMContext = No
     else:
         # в чатах тоже пробуем картинку
         try:
-            image_paths = [
-    
-    'img/plyer_default.jpg',
-                './img/plyer_default.jpg',
-                'C:/Users/User/Desktop/dodeper bot/img/plyer_default.jpg'
-            ]
+            image = static_photo(*PLAYER_IMAGE_PATHS)
             
-            print(f"🔍 Пытаюсь отправить картинку в чат для пользователя {user_id}")
             image_sent = False
             
-            for image_path in image_paths:
+            if image is not None:
                 try:
-                    print(f"📁 Проверяю путь в чате: {image_path}")
-                    if os.path.exists(image_path):
-                        print(f"✅ Файл найден в чате: {image_path}")
-                        await bot.send_photo(
-                            message.chat.id,
-                            types.FSInputFile(image_path),
-                            caption=menu_text,
-                            parse_mode='HTML'
-                        )
-                        print(f"📸 Картинка в чате отправлена успешно!")
-                        image_sent = True
-                        break
-                    else:
-                        print(f"❌ Файл не найден в чате: {image_path}")
+                    await send_photo_asset(
+                        message.chat.id,
+                        image,
+                        caption=menu_text,
+                        parse_mode='HTML'
+                    )
+                    image_sent = True
                 except Exception as e:
-                    print(f"⚠️ Ошибка при отправке картинки в чате {image_path}: {e}")
-                    continue
+                    print(f"⚠️ Ошибка при отправке картинки в чате {image.filename}: {e}")
+            else:
+                print(f"❌ Картинка меню не найдена ни по одному пути")
             
             if not image_sent:
                 print(f"📝 Картинка в чате не отправлена, отправляю только текст")
@@ -1400,7 +4476,7 @@ async def complete_cargo_delivery(chat_id: int, user_id_str: str):
     
     # обновляем баланс пользователя
     if user_id_str in users:
-        users[user_id_str]['balance'] += payment
+        credit(user_id_str, payment, 'cargo_delivery')
         save_users()
     
     # удаляем сообщение о переносе
@@ -1826,7 +4902,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     # сохраняем реферала временно
     if referral_id and str(referral_id) in users:
         if user_id_str not in users:
-            users[user_id_str] = {}
+            users[user_id_str] = new_user_record()
         users[user_id_str]['temp_referrer'] = referral_id
         users[user_id_str]['temp_referral_date'] = str(datetime.datetime.now())
         save_users()
@@ -1834,30 +4910,21 @@ async def cmd_start(message: types.Message, state: FSMContext):
     if message.chat.type == 'private':
         markup = ReplyKeyboardMarkup(resize_keyboard=True, keyboard=[[KeyboardButton(text='зарегистрироваться ✅')]])
         try:
-            # пробуем разные пути к картинке
-            image_paths = [
-                'img/plyer_default.jpg',
-                './img/plyer_default.jpg',
-                'img/player_default.jpg',
-                './img/player_default.jpg',
-                'C:/Users/User/Desktop/dodeper bot/img/plyer_default.jpg',
-                'C:/Users/User/Desktop/dodeper bot/img/player_default.jpg'
-            ]
+            # картинка ищется по нескольким путям один раз за запуск
+            image = static_photo(*PLAYER_IMAGE_PATHS)
             image_sent = False
-            for image_path in image_paths:
+            if image is not None:
                 try:
-                    if os.path.exists(image_path):
-                        await bot.send_photo(
-                            message.chat.id,
-                            types.FSInputFile(image_path),
-                            caption='<b>привет</b>\nвижу, что у тебя нету аккаунта в боте, давай зарегистрируемся',
-                            parse_mode='HTML',
-                            reply_markup=markup
-                        )
-                        image_sent = True
-                        break
+                    await send_photo_asset(
+                        message.chat.id,
+                        image,
+                        caption='<b>привет</b>\nвижу, что у тебя нету аккаунта в боте, давай зарегистрируемся',
+                        parse_mode='HTML',
+                        reply_markup=markup
+                    )
+                    image_sent = True
                 except Exception:
-                    continue
+                    pass
             if not image_sent:
                 await message.answer(
                     '<b>привет</b>\nвижу, что у тебя нету аккаунта в боте, давай зарегистрируемся',
@@ -2556,11 +5623,11 @@ async def handle_promo_input(message: types.Message, state: FSMContext):
         return
     
     # активируем промокод
-    success, message_text, reward = activate_promo(promo_code, user_id_str)
+    success, message_text, reward = await activate_promo_shared(promo_code, user_id_str)
     
     if success:
         # начисляем награду
-        users[user_id_str]['balance'] += reward
+        credit(user_id_str, reward, 'promo')
         save_users()
         
         # показываем успешное сообщение
@@ -2934,10 +6001,9 @@ async def process_nick(message: types.Message, state: FSMContext):
         return
     
     # Проверяем, не занят ли ник
-    for existing_user in users.values():
-        if 'nick' in existing_user and existing_user['nick'].lower() == nick.lower():
-            await message.answer('этот ник уже занят, выбери другой')
-            return
+    if find_user_id(nick=nick) is not None:
+        await message.answer('этот ник уже занят, выбери другой')
+        return
     
     # Проверяем, есть ли реферер в базе данных
     temp_referrer = None
@@ -2946,7 +6012,7 @@ async def process_nick(message: types.Message, state: FSMContext):
         temp_referrer = users[user_id_str]['temp_referrer']
     
     # Регистрируем пользователя
-    users[user_id_str] = {
+    users[user_id_str] = new_user_record({
         'nick': nick,
         'tg_username': message.from_user.username or 'без_юз',
         'balance': 0,  # 0 начальный баланс
@@ -2981,7 +6047,7 @@ async def process_nick(message: types.Message, state: FSMContext):
         },
         'bank_deposit': 0,
         'bank_deposit_time': 0
-    }
+    })
     
     # Если пользователь пришёл по реферальной ссылке
     if temp_referrer and str(temp_referrer) in users:
@@ -2993,13 +6059,13 @@ async def process_nick(message: types.Message, state: FSMContext):
         
         # Выдаём случайный бонус
         bonus = get_random_referral_bonus()
-        users[user_id_str]['balance'] += bonus
+        credit(user_id_str, bonus, 'referral_bonus')
         referrer_data['referral_earnings'] = referrer_data.get('referral_earnings', 0) + bonus
         
         # Проверяем достижения
         milestone_bonus = get_milestone_bonus(referrer_data['referrals'])
         if milestone_bonus > 0:
-            referrer_data['balance'] += milestone_bonus
+            credit(referrer_id_str, milestone_bonus, 'referral_milestone')
             referrer_data['referral_earnings'] += milestone_bonus
         
         # Сохраняем изменения
@@ -3110,13 +6176,7 @@ async def process_transfer(message: types.Message, text: str, user_id: int):
     username = extract_username(target_username)
     
     # Ищем пользователя по username или нику
-    target_user_id = None
-    
-    for uid, user_data in users.items():
-        if (user_data.get('tg_username', '').lower() == username.lower() or 
-            user_data.get('nick', '').lower() == target_username.lower()):
-            target_user_id = uid
-            break
+    target_user_id = find_user_id(username=username, nick=target_username)
     
     if not target_user_id:
         await message.answer('пользователь не найден')
@@ -3191,8 +6251,7 @@ async def execute_transfer(sender_user_id: str, target_user_id: str, amount: int
         amount_to_receiver = amount - commission_amount
     
     # Выполняем перевод
-    users[sender_user_id]['balance'] -= amount
-    users[target_user_id]['balance'] += amount_to_receiver
+    transfer(sender_user_id, target_user_id, amount, amount_to_receiver, 'transfer')
     
     # Сохраняем изменения в базу данных
     save_users()
@@ -3649,12 +6708,9 @@ async def admin_target_selected(message: types.Message, state: FSMContext):
     target_user_id = None
     
     target_nick = None
-    for uid, user_data in users.items():
-        if (user_data.get('tg_username', '').lower() == username.lower() or 
-            user_data.get('nick', '').lower() == target_text.lower()):
-            target_user_id = uid
-            target_nick = user_data.get('nick', 'неизвестно')
-            break
+    target_user_id = find_user_id(username=username, nick=target_text)
+    if target_user_id is not None:
+        target_nick = users[target_user_id].get('nick', 'неизвестно')
     if not target_user_id:
         await message.answer('пользователь не найден или не зарегистрирован')
         await state.clear()
@@ -3797,7 +6853,7 @@ async def view_database(message: types.Message):
     total_balance = sum(user.get('balance', 0) for user in users.values())
     total_referrals = sum(user.get('referrals', 0) for user in users.values())
     
-    max_balance = max((user.get('balance', 0) for user in users.values()), default=0)
+    max_balance = leaderboard.max_balance()
     max_k_count = get_max_k_count()
     
     # дополнительная статистика
@@ -3884,22 +6940,10 @@ async def admin_bank_stats_button(message: types.Message):
         await message.answer('у тебя нет доступа к этой команде')
         return
     
-    # собираем статистику вкладов
-    total_deposits = 0
-    
-    users_with_deposits = 0
-    max_deposit = 0
-    
-    deposits_list = []
-    
-    for user_id_key, user_data in users.items():
-        deposit = user_data.get('bank_deposit', 0)
-    if deposit > 0:
-            total_deposits += deposit
-            users_with_deposits += 1
-            deposits_list.append(deposit)
-            if deposit > max_deposit:
-                max_deposit = deposit
+    # статистика вкладов берётся из индекса вкладчиков
+    total_deposits = deposit_index.total
+    users_with_deposits = len(deposit_index)
+    max_deposit = deposit_index.max_amount()
     
     total_users = len(users)
     percentage_with_deposits = (users_with_deposits / total_users * 100) if total_users > 0 else 0
@@ -3934,26 +6978,18 @@ async def admin_bank_top_button(message: types.Message):
         await message.answer('у тебя нет доступа к этой команде')
         return
     
-    # собираем данные о вкладах
-    deposits_data = []
-    
-    total_deposits = 0
-    users_with_deposits = 0
-    
-    for user_id_key, user_data in users.items():
-        deposit = user_data.get('bank_deposit', 0)
-    if deposit > 0:
-            deposits_data.append({
-                'user_id': user_id_key,
-                'nick': user_data.get('nick', 'игрок'),
-                'tg_username': user_data.get('tg_username', ''),
-                'deposit': deposit
-            })
-            total_deposits += deposit
-            users_with_deposits += 1
-    
-    # сортируем по размеру вклада (убывание)
-    deposits_data.sort(key=lambda x: x['deposit'], reverse=True)
+    # топ-10 вкладов уже упорядочен в индексе вкладчиков
+    deposits_data = [
+        {
+            'user_id': user_id_key,
+            'nick': users[user_id_key].get('nick', 'игрок'),
+            'tg_username': users[user_id_key].get('tg_username', ''),
+            'deposit': deposit
+        }
+        for user_id_key, deposit in deposit_index.top(10)
+    ]
+    total_deposits = deposit_index.total
+    users_with_deposits = len(deposit_index)
     
     top_text = f'🏆 <b>топ-10 по вкладам:</b>\n\n'
     
@@ -3981,7 +7017,678 @@ async def admin_bank_top_button(message: types.Message):
 
 # Обработчики состояний админки
 
+# === исходящие сообщения ===
+# раньше каждый обработчик сам решал, сколько спать перед отправкой (0.5 с перед картинкой
+# рулетки, 0.4 с перед кубиком), а рассылка, налог и уведомления о вкладах делили лимит
+# телеграма, ничего не зная друг о друге. теперь каждый send/copy/forward/edit/delete идёт
+# через планировщик (middleware сессии бота): общий лимит OUTBOUND_RATE в секунду, лимит на
+# чат (раз в секунду в лс, 20 в минуту в группе, с небольшим запасом на всплеск) и очередь
+# по приоритету - ответы игрокам идут раньше уведомлений, уведомления раньше рассылки.
+# приоритет действует и внутри чата: ответ игроку занимает ближайшее окно чата раньше
+# уведомлений и рассылки, которые ждут в том же чате, но лимит чата соблюдает тоже.
+# flood-ошибку планировщик пережидает сам: тот же запрос повторяется не раньше retry_after,
+# а чат до этого момента закрыт для всех запросов любого класса, так что вызывающий просто
+# ждёт доставки. класс трафика задаётся через outbound_priority (по умолчанию - ответ игроку)
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', '30'))  # сообщений в секунду на весь бот
+OUTBOUND_CHAT_INTERVAL = 1.0  # в один личный чат - не чаще раза в секунду
+OUTBOUND_GROUP_INTERVAL = 3.0  # в группу - не чаще 20 сообщений в минуту
+OUTBOUND_CHAT_BURST = 3  # столько сообщений подряд в чат можно отправить без паузы
+OUTBOUND_MAX_ATTEMPTS = 5
+OUTBOUND_MAX_RETRY_WAIT = 60  # дольше ответ игроку не ждём - отдаём ошибку
+OUTBOUND_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PRIORITY_INTERACTIVE = 0  # ответы игрокам: результаты игр, меню
+PRIORITY_NOTIFY = 1       # уведомления: налог, созревшие вклады
+PRIORITY_BULK = 2         # рассылки и перепроверки
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'ответы', PRIORITY_NOTIFY: 'уведомления', PRIORITY_BULK: 'рассылки'}
+
+outbound_priority = contextvars.ContextVar('outbound_priority', default=PRIORITY_INTERACTIVE)
+
+@contextlib.contextmanager
+def outbound_class(priority: int):
+    """отправки внутри блока идут с указанным приоритетом"""
+    token = outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+class LatencyHistogram:
+    """гистограмма задержек по фиксированным корзинам"""
+
+    def __init__(self):
+        self.counts = [0] * (len(OUTBOUND_LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(OUTBOUND_LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> float:
+        """верхняя граница корзины, в которую попадает q-й процентиль"""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(OUTBOUND_LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def describe(self) -> str:
+        def fmt(seconds):
+            if seconds == float('inf'):
+                return f'>{OUTBOUND_LATENCY_BUCKETS[-1]}с'
+            return f'{seconds * 1000:.0f}мс' if seconds < 1 else f'{seconds:g}с'
+        if not self.count:
+            return 'нет данных'
+        return (f"p50 ≤{fmt(self.percentile(50))}, p95 ≤{fmt(self.percentile(95))}, "
+                f"p99 ≤{fmt(self.percentile(99))}, ср {fmt(self.total / self.count)}")
+
+class OutboundStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.wait = LatencyHistogram()   # ожидание очереди и лимитов
+        self.latency = LatencyHistogram()  # от вызова до ответа телеграма
+
+class OutboundScheduler:
+    """общий лимит исходящих запросов с лимитом на чат и приоритетами"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate / 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self.waiting = []  # куча (приоритет, номер, future) ждущих общего лимита
+        self._seq = itertools.count()
+        self.chats = {}  # chat_id -> теоретическое время следующего сообщения (monotonic)
+        self.chat_waiting = {}  # chat_id -> куча (приоритет, номер, future) ждущих окна чата
+        self.chat_tasks = set()
+        self.chat_paused_until = {}  # chat_id -> до какого момента чат закрыт после flood-ошибки
+        self.stats = {priority: OutboundStats() for priority in PRIORITY_NAMES}
+        self.task = None
+        self._wakeup = None
+
+    # --- общий лимит ---
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def _acquire(self, priority: int):
+        now = time.monotonic()
+        if not self.waiting and now >= self.paused_until[priority]:
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self._seq), future))
+        self._ensure_running()
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # слот уже выдали, а отправку отменили - возвращаем его
+                self.tokens = min(self.capacity, self.tokens + 1)
+            raise
+
+    async def run(self):
+        waiting = self.waiting
+        while True:
+            while waiting and waiting[0][2].done():
+                heapq.heappop(waiting)
+            if not waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            self._refill(now)
+            priority = waiting[0][0]
+            if now < self.paused_until[priority]:
+                delay = self.paused_until[priority] - now
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                heapq.heappop(waiting)[2].set_result(None)
+                continue
+            else:
+                delay = (1 - self.tokens) / self.rate
+            # ждём токен, но просыпаемся, если пришёл запрос важнее
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _ensure_running(self):
+        if self.task is None or self.task.done():
+            self._wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        for task in list(self.chat_tasks):
+            task.cancel()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # --- лимит на чат ---
+    async def _wait_chat_pause(self, chat_id: int):
+        """ждёт, пока чат снова откроется после flood-ошибки (пауза может продлиться, пока ждём)"""
+        while True:
+            delay = self.chat_paused_until.get(chat_id, 0.0) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def _chat_slot_delay(self, chat_id: int) -> float:
+        """GCRA: OUTBOUND_CHAT_BURST сообщений сразу, дальше не чаще раза в interval.
+
+        0 - окно свободно и уже занято вызывающим, иначе через сколько оно откроется
+        """
+        interval = OUTBOUND_GROUP_INTERVAL if chat_id < 0 else OUTBOUND_CHAT_INTERVAL
+        now = time.monotonic()
+        due = max(self.chats.get(chat_id, now), now)
+        allowed_at = due - interval * (OUTBOUND_CHAT_BURST - 1)
+        if allowed_at > now:
+            return allowed_at - now
+        self.chats[chat_id] = due + interval
+        if len(self.chats) > 10000:
+            # давно прошедшие чаты больше не нужны
+            self.chats = {chat: at for chat, at in self.chats.items() if at > now or chat in self.chat_waiting}
+        return 0.0
+
+    async def _acquire_chat(self, chat_id: int, priority: int):
+        if chat_id not in self.chat_waiting and not self._chat_slot_delay(chat_id):
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiting = self.chat_waiting.get(chat_id)
+        if waiting is None:
+            waiting = self.chat_waiting[chat_id] = []
+            task = asyncio.create_task(self._run_chat(chat_id, waiting))
+            self.chat_tasks.add(task)
+            task.add_done_callback(self.chat_tasks.discard)
+        heapq.heappush(waiting, (priority, next(self._seq), future))
+        await future
+
+    async def _run_chat(self, chat_id: int, waiting: list):
+        """раздаёт окна чата ждущим по приоритету, пока очередь чата не опустеет"""
+        try:
+            while True:
+                while waiting and waiting[0][2].done():
+                    heapq.heappop(waiting)
+                if not waiting:
+                    return
+                delay = self._chat_slot_delay(chat_id)
+                if delay:
+                    # кто получит окно, решаем, когда оно откроется: ответ игроку успеет встать первым
+                    await asyncio.sleep(delay)
+                    continue
+                heapq.heappop(waiting)[2].set_result(None)
+        finally:
+            del self.chat_waiting[chat_id]
+            for _, _, future in waiting:
+                if not future.done():
+                    future.cancel()
+
+    def pause(self, priority: int, chat_id, seconds: float):
+        now = time.monotonic()
+        if isinstance(chat_id, int):
+            # чат закрыт для всех: отправки, правки и удаления любого класса ждут конца паузы
+            self.chat_paused_until[chat_id] = max(self.chat_paused_until.get(chat_id, 0.0), now + seconds)
+            if len(self.chat_paused_until) > 10000:
+                self.chat_paused_until = {chat: at for chat, at in self.chat_paused_until.items() if at > now}
+            interval = OUTBOUND_GROUP_INTERVAL if chat_id < 0 else OUTBOUND_CHAT_INTERVAL
+            self.chats[chat_id] = max(self.chats.get(chat_id, now), now + seconds + interval * (OUTBOUND_CHAT_BURST - 1))
+        if priority != PRIORITY_INTERACTIVE:
+            # flood-ошибка фонового трафика - притормаживаем его весь, ответы игрокам идут дальше
+            for other in self.paused_until:
+                if other >= priority:
+                    self.paused_until[other] = max(self.paused_until[other], now + seconds)
+
+    # --- отправка ---
+    async def deliver(self, make_request, bot, method):
+        priority = outbound_priority.get()
+        stats = self.stats[priority]
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(chat_id, int):
+            chat_id = None  # @username канала или запрос без чата (ответ на нажатие кнопки)
+        name = method.__api_method__
+        per_chat = chat_id is not None and name.startswith(('send', 'copy', 'forward')) and name != 'sendChatAction'
+        # ответы на нажатия кнопок не входят в лимит сообщений, им нужен только повтор после flood-ошибки
+        counted = not name.startswith('answer')
+        started = time.monotonic()
+        retry_at = 0.0
+        for attempt in range(1, OUTBOUND_MAX_ATTEMPTS + 1):
+            delay = retry_at - time.monotonic()
+            if delay > 0:
+                # тот же запрос повторяем не раньше, чем разрешил телеграм
+                await asyncio.sleep(delay)
+            if chat_id is not None:
+                await self._wait_chat_pause(chat_id)
+            if per_chat:
+                await self._acquire_chat(chat_id, priority)
+            if counted:
+                await self._acquire(priority)
+            if attempt == 1:
+                stats.wait.record(time.monotonic() - started)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                stats.retries += 1
+                self.pause(priority, chat_id, e.retry_after)
+                if attempt == OUTBOUND_MAX_ATTEMPTS or (priority == PRIORITY_INTERACTIVE and e.retry_after > OUTBOUND_MAX_RETRY_WAIT):
+                    stats.failed += 1
+                    raise
+                retry_at = time.monotonic() + e.retry_after
+                continue
+            except Exception:
+                stats.failed += 1
+                raise
+            stats.sent += 1
+            stats.latency.record(time.monotonic() - started)
+            return response
+
+    def queued(self) -> dict[int, int]:
+        counts = collections.Counter(priority for priority, _, future in self.waiting if not future.done())
+        return {priority: counts.get(priority, 0) for priority in PRIORITY_NAMES}
+
+OUTBOUND_METHOD_PREFIXES = ('send', 'copy', 'forward', 'edit', 'delete', 'stop', 'answer')
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """пропускает отправки, правки, удаления сообщений и ответы на нажатия через планировщик"""
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__.startswith(OUTBOUND_METHOD_PREFIXES):
+            return await self.scheduler.deliver(make_request, bot, method)
+        return await make_request(bot, method)
+
+outbound = OutboundScheduler(OUTBOUND_RATE)
+bot.session.middleware(OutboundMiddleware(outbound))
+
 # === рассылка ===
+# раньше рассылка шла по одному получателю с паузой 0.5 с на каждые 25 сообщений, не
+# учитывала retry_after и начиналась заново после перезапуска - рассылка в лс на 100к
+# игроков шла часами. теперь её ведёт движок: несколько параллельных отправителей с
+# низшим приоритетом в планировщике исходящих (он держит общий лимит, лимит на чат и
+# ждёт retry_after при flood-ошибке). задание (текст, кнопка, список получателей)
+# пишется на диск один раз, а позиция - по ходу рассылки, так что после перезапуска она
+# продолжается с места остановки (последние несколько сообщений перед падением могут
+# уйти повторно). прогресс админу показывается по счётчикам движка раз в несколько секунд
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_PROGRESS_INTERVAL = 10  # как часто обновлять сообщение с прогрессом, секунд
+BROADCAST_JOB_FILE = 'broadcast_job.json'
+BROADCAST_PROGRESS_FILE = 'broadcast_progress.json'
+
+# === недоступные получатели ===
+# каждая рассылка и каждое уведомление о налоге снова и снова стучались к тем, кто давно
+# заблокировал бота или удалил аккаунт, и каждая такая попытка стоила запроса к телеграму.
+# теперь постоянные ошибки (бот заблокирован, выгнан из чата, аккаунт удалён, чат не найден)
+# записываются по chat_id со временем, и такие получатели пропускаются при рассылках и
+# уведомлениях. раз в DEAD_RECHECK_INTERVAL секунд один давно проверенный получатель
+# проверяется заново действием "печатает", а игрок, написавший боту в лс, снова доступен сразу
+DEAD_RECIPIENTS_FILE = 'dead_recipients.json'
+DEAD_RECHECK_AFTER = 7 * 86400  # перепроверяем получателя не раньше, чем через неделю
+DEAD_RECHECK_INTERVAL = 30  # не чаще одной перепроверки в 30 секунд
+
+def classify_send_error(error: Exception) -> str | None:
+    """причина, по которой получателю слать бесполезно, или None для временной ошибки"""
+    text = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        if 'deactivated' in text:
+            return 'deactivated'
+        if 'kicked' in text or 'not a member' in text:
+            return 'kicked'
+        if 'blocked' in text:
+            return 'blocked'
+        return 'forbidden'
+    if isinstance(error, (TelegramBadRequest, TelegramNotFound)):
+        if 'chat not found' in text or 'user not found' in text or 'peer_id_invalid' in text:
+            return 'chat_not_found'
+    return None
+
+class DeadRecipients:
+    """получатели, до которых сообщения не доходят, с причиной и временем"""
+
+    REASONS = {
+        'blocked': 'заблокировали бота',
+        'deactivated': 'удалили аккаунт',
+        'kicked': 'бота выгнали из чата',
+        'forbidden': 'нет прав писать',
+        'chat_not_found': 'чат не найден',
+    }
+
+    def __init__(self, entries: dict | None = None):
+        self.entries = entries if entries is not None else {}  # chat_id -> {'reason', 'since', 'checked'}
+        self.task = None
+        self.revived = 0
+        self.rechecked = 0
+
+    def __contains__(self, chat_id) -> bool:
+        return int(chat_id) in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def mark(self, chat_id: int, reason: str):
+        chat_id = int(chat_id)
+        now = time.time()
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            self.entries[chat_id] = {'reason': reason, 'since': now, 'checked': now}
+        else:
+            entry['reason'] = reason
+            entry['checked'] = now
+        side_stores.mark('dead_recipients')
+
+    def revive(self, chat_id) -> bool:
+        if self.entries.pop(int(chat_id), None) is None:
+            return False
+        self.revived += 1
+        side_stores.mark('dead_recipients')
+        return True
+
+    def record_failure(self, chat_id: int, error: Exception) -> bool:
+        """запоминает получателя, если ошибка постоянная; True - слать ему больше не нужно"""
+        reason = classify_send_error(error)
+        if reason is None:
+            return False
+        self.mark(chat_id, reason)
+        return True
+
+    def reachable(self, recipients) -> list[int]:
+        entries = self.entries
+        return [chat_id for chat_id in recipients if int(chat_id) not in entries]
+
+    def by_reason(self, recipients=None) -> dict[str, int]:
+        counts = collections.Counter()
+        if recipients is None:
+            counts.update(entry['reason'] for entry in self.entries.values())
+        else:
+            entries = self.entries
+            for chat_id in recipients:
+                entry = entries.get(int(chat_id))
+                if entry is not None:
+                    counts[entry['reason']] += 1
+        return dict(counts)
+
+    def _data(self) -> dict:
+        return {str(chat_id): entry for chat_id, entry in self.entries.items()}
+
+    async def recheck_one(self) -> bool:
+        """перепроверяет получателя, которого дольше всех не проверяли"""
+        if not self.entries:
+            return False
+        chat_id, entry = min(self.entries.items(), key=lambda item: item[1]['checked'])
+        if time.time() - entry['checked'] < DEAD_RECHECK_AFTER:
+            return False
+        self.rechecked += 1
+        try:
+            await bot.send_chat_action(chat_id, 'typing')
+        except TelegramRetryAfter:
+            return False
+        except Exception as e:
+            if not self.record_failure(chat_id, e):
+                # временная ошибка - попробуем в следующий раз
+                entry['checked'] = time.time()
+                side_stores.mark('dead_recipients')
+            return True
+        self.revive(chat_id)
+        print(f"📬 Получатель {chat_id} снова доступен")
+        return True
+
+    async def run(self):
+        outbound_priority.set(PRIORITY_BULK)
+        while True:
+            await asyncio.sleep(DEAD_RECHECK_INTERVAL)
+            try:
+                await self.recheck_one()
+            except Exception as e:
+                print(f"❌ Ошибка перепроверки получателей: {e}")
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+def load_dead_recipients() -> DeadRecipients:
+    try:
+        with open(DEAD_RECIPIENTS_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return DeadRecipients({int(chat_id): entry for chat_id, entry in data.items()})
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"❌ Ошибка загрузки недоступных получателей: {e}")
+    return DeadRecipients()
+
+dead_recipients = load_dead_recipients()
+side_stores.register('dead_recipients', DEAD_RECIPIENTS_FILE, dead_recipients._data)
+
+class BroadcastEngine:
+    """рассылка с общим лимитом, пулом отправителей и продолжением после перезапуска"""
+
+    def __init__(self):
+        self.job = None  # текущее задание (см. start)
+        self.task = None
+        self.sent = 0
+        self.failed = 0
+        self.started_at = None
+        self._cursor = 0  # следующий индекс для отправителей
+        self._done_above = {}  # индекс -> доставлено ли, для завершённых дальше job['position']
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def _job_data(self) -> dict:
+        job = self.job
+        if job is None or job.get('finished'):
+            return {}
+        return {key: value for key, value in job.items() if key not in ('position', 'sent', 'failed')}
+
+    def _progress_data(self) -> dict:
+        job = self.job
+        if job is None:
+            return {}
+        return {'id': job['id'], 'position': job['position'], 'sent': job['sent'], 'failed': job['failed'],
+                'finished': job.get('finished')}
+
+    def start(self, recipients: list[int], text: str, photo_id: str | None, button: dict | None,
+              report_chat_id: int, report_message_id: int | None):
+        self.job = {
+            'id': f"{int(time.time())}-{random.randint(1000, 9999)}",
+            'created': time.time(),
+            'recipients': recipients,
+            'text': text,
+            'photo_id': photo_id,
+            'button': button,
+            'report_chat_id': report_chat_id,
+            'report_message_id': report_message_id,
+            'position': 0,
+            'sent': 0,
+            'failed': 0,
+        }
+        side_stores.mark('broadcast_job')
+        side_stores.mark('broadcast_progress')
+        self._launch()
+
+    def resume(self) -> bool:
+        """продолжает рассылку, прерванную перезапуском"""
+        try:
+            with open(BROADCAST_JOB_FILE, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"❌ Не удалось прочитать задание рассылки: {e}")
+            return False
+        if not job or 'recipients' not in job:
+            return False
+        progress = {}
+        try:
+            with open(BROADCAST_PROGRESS_FILE, 'r', encoding='utf-8') as f:
+                progress = json.load(f) or {}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать прогресс рассылки, начинаем её сначала: {e}")
+        if progress.get('id') != job['id']:
+            progress = {}
+        if progress.get('finished'):
+            return False
+        job['position'] = progress.get('position', 0)
+        job['sent'] = progress.get('sent', 0)
+        job['failed'] = progress.get('failed', 0)
+        self.job = job
+        print(f"📣 Продолжаем рассылку {job['id']} с {job['position']}/{len(job['recipients'])}")
+        self._launch()
+        return True
+
+    def _launch(self):
+        self.sent = self.failed = 0
+        self.started_at = time.monotonic()
+        self._cursor = self.job['position']
+        self._done_above = {}
+        self.task = asyncio.create_task(self.run())
+
+    def _markup(self):
+        button = self.job.get('button')
+        if not button:
+            return None
+        return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=button['text'], url=button['url'])]])
+
+    async def _deliver(self, chat_id: int, markup) -> bool:
+        job = self.job
+        try:
+            # лимиты и повтор после flood-ошибки - в планировщике исходящих
+            if job.get('photo_id'):
+                await bot.send_photo(chat_id, job['photo_id'], caption=job['text'], parse_mode='HTML', reply_markup=markup)
+            else:
+                await bot.send_message(chat_id, job['text'], parse_mode='HTML', reply_markup=markup,
+                                       link_preview_options=types.LinkPreviewOptions(is_disabled=True))
+            return True
+        except Exception as e:
+            dead_recipients.record_failure(chat_id, e)
+            return False
+
+    def _complete(self, index: int, delivered: bool):
+        job = self.job
+        if delivered:
+            self.sent += 1
+        else:
+            self.failed += 1
+        # позиция и счётчики двигаются только по сплошному префиксу: всё до неё точно обработано,
+        # поэтому после перезапуска повторно отправленные сообщения не считаются дважды
+        self._done_above[index] = delivered
+        while job['position'] in self._done_above:
+            job['sent' if self._done_above.pop(job['position']) else 'failed'] += 1
+            job['position'] += 1
+        side_stores.mark('broadcast_progress')
+
+    async def _worker(self, markup):
+        recipients = self.job['recipients']
+        while self._cursor < len(recipients):
+            index = self._cursor
+            self._cursor += 1
+            chat_id = int(recipients[index])
+            # после перезапуска в задании могут остаться те, кто с тех пор стал недоступен
+            delivered = chat_id not in dead_recipients.entries and await self._deliver(chat_id, markup)
+            self._complete(index, delivered)
+
+    def progress_text(self) -> str:
+        job = self.job
+        if job is None:
+            return 'рассылок ещё не было'
+        total = len(job['recipients'])
+        done = job['position'] + len(self._done_above)
+        failed = job['failed'] + sum(1 for delivered in self._done_above.values() if not delivered)
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        speed = (self.sent + self.failed) / elapsed
+        left = total - job['position']
+        text = f"{'готово' if job.get('finished') else 'отправляю'}... {done}/{total}, ошибок: {failed}"
+        if not job.get('finished'):
+            text += f"\nскорость: {speed:.1f} сообщ/с"
+            if speed > 0:
+                text += f", осталось ~{int(left / speed // 60)} мин"
+            retries = outbound.stats[PRIORITY_BULK].retries
+            if retries:
+                text += f"\nпауз по flood-лимиту: {retries}"
+        return text
+
+    async def _report(self, final: bool = False):
+        job = self.job
+        text = self.progress_text()
+        if final:
+            text = f"готово. отправлено: {job['sent']}/{len(job['recipients'])}, не доставлено: {job['failed']}"
+        try:
+            if job.get('report_message_id'):
+                await bot.edit_message_text(text, chat_id=job['report_chat_id'], message_id=job['report_message_id'])
+                return
+        except Exception:
+            if not final:
+                return
+        if final:
+            try:
+                await bot.send_message(job['report_chat_id'], text)
+            except Exception as e:
+                print(f"❌ Не удалось отправить итог рассылки: {e}")
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._report()
+
+    async def run(self):
+        outbound_priority.set(PRIORITY_BULK)
+        markup = self._markup()
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(*(self._worker(markup) for _ in range(BROADCAST_WORKERS)))
+        finally:
+            reporter.cancel()
+        self.job['finished'] = time.time()
+        side_stores.mark('broadcast_job')
+        side_stores.mark('broadcast_progress')
+        print(f"📣 Рассылка {self.job['id']} завершена: {self.job['sent']} отправлено, {self.job['failed']} ошибок")
+        await self._report(final=True)
+
+    async def stop(self):
+        """останавливает рассылку при выключении бота; позиция остаётся на диске"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+broadcast_engine = BroadcastEngine()
+side_stores.register('broadcast_job', BROADCAST_JOB_FILE, broadcast_engine._job_data)
+side_stores.register('broadcast_progress', BROADCAST_PROGRESS_FILE, broadcast_engine._progress_data)
+
 @dp.message(F.text.lower() == 'рассылка 📣')
 async def start_broadcast(message: types.Message, state: FSMContext):
     # только в личке и только админы
@@ -4176,6 +7883,9 @@ async def broadcast_confirm(callback: types.CallbackQuery, state: FSMContext):
     if user_id not in ADMIN_IDS:
         await callback.answer()
         return
+    if broadcast_engine.running:
+        await callback.answer('предыдущая рассылка ещё идёт', show_alert=True)
+        return
     data = await state.get_data()
     
     text = data.get('broadcast_text', '')
@@ -4218,50 +7928,142 @@ async def broadcast_confirm(callback: types.CallbackQuery, state: FSMContext):
     
     # исключаем основной чат, если выбрано "кроме основного"
         if chosen_target == 'bc_target_chats_ex_main':
-            global MAIN_CHAT_ID
-            try:
-                if MAIN_CHAT_ID is None and MAIN_CHAT_USERNAME:
-                    chat = await bot.get_chat(f"@{MAIN_CHAT_USERNAME}")
-                    MAIN_CHAT_ID = int(chat.id)
-            except Exception:
-                pass
-            if MAIN_CHAT_ID is not None:
-                recipients = [cid for cid in recipients if int(cid) != int(MAIN_CHAT_ID)]
-    total = len(recipients)
+            main_chat_id = MAIN_CHAT_ID
+            if main_chat_id is None and MAIN_CHAT_USERNAME:
+                main_chat_id = await telegram_metadata.resolve_chat(MAIN_CHAT_USERNAME)
+            if main_chat_id is not None:
+                recipients = [cid for cid in recipients if int(cid) != int(main_chat_id)]
+    
+    # недоступных пропускаем сразу, не тратя на них запросы
+    skipped = len(recipients)
+    recipients = dead_recipients.reachable(int(uid) for uid in recipients)
+    skipped -= len(recipients)
+    if skipped:
+        print(f"📣 Пропускаем {skipped} недоступных получателей")
+    
+    # дальше рассылку ведёт движок; итог он сам напишет в это же сообщение
+    broadcast_engine.start(
+        recipients,
+        text,
+        data.get('broadcast_photo_id'),
+        button,
+        callback.message.chat.id,
+        callback.message.message_id
+    )
+    await state.clear()
+
+@dp.message(Command('broadcast_status'))
+async def broadcast_status_command(message: types.Message):
+    """Команда для просмотра прогресса рассылки"""
+    user_id = message.from_user.id
+    
+    user_id_str = str(user_id)
+    
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
     
-    sent = 0
-    failed = 0
+    # Проверяем, является ли пользователь администратором
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
+    
+    await message.answer(f"📣 {broadcast_engine.progress_text()}")
+
+@dp.message(Command('audience'))
+async def audience_command(message: types.Message):
+    """Команда для просмотра доступной аудитории рассылок"""
+    user_id = message.from_user.id
+    
+    user_id_str = str(user_id)
+    
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
+    
+    # Проверяем, является ли пользователь администратором
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
+    
+    dm_dead = dead_recipients.by_reason(users.keys())
+    chats_dead = dead_recipients.by_reason(bot_chats)
+    dm_reachable = len(users) - sum(dm_dead.values())
+    chats_reachable = len(bot_chats) - sum(chats_dead.values())
+    text = (
+        f"📬 <b>аудитория рассылок</b>\n\n"
+        f"👤 лс: <b>{dm_reachable}</b> из {len(users)} доступны\n"
+        f"💬 чаты: <b>{chats_reachable}</b> из {len(bot_chats)} доступны\n"
+    )
+    if dm_dead or chats_dead:
+        text += "\n<b>недоступны:</b>\n"
+        for reason, title in DeadRecipients.REASONS.items():
+            if dm_dead.get(reason) or chats_dead.get(reason):
+                text += f"• {title}: {dm_dead.get(reason, 0)} в лс, {chats_dead.get(reason, 0)} чатов\n"
+    text += (
+        f"\n🔁 перепроверено: {dead_recipients.rechecked}, вернулись: {dead_recipients.revived}\n"
+        f"<i>перепроверка — раз в {DEAD_RECHECK_INTERVAL} с, не раньше чем через "
+        f"{DEAD_RECHECK_AFTER // 86400} дн после прошлой</i>"
+    )
+    await message.answer(text, parse_mode='HTML')
+
+@dp.message(Command('outbound_stats'))
+async def outbound_stats_command(message: types.Message):
+    """Команда для просмотра очереди исходящих сообщений"""
+    user_id = message.from_user.id
+    
+    user_id_str = str(user_id)
+    
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
+    
+    # Проверяем, является ли пользователь администратором
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
+    
+    queued = outbound.queued()
+    text = f"📤 <b>исходящие сообщения</b> (лимит {OUTBOUND_RATE:g}/с)\n"
+    for priority, name in PRIORITY_NAMES.items():
+        stats = outbound.stats[priority]
+        text += (
+            f"\n<b>{name}</b>: отправлено {stats.sent}, ошибок {stats.failed}, "
+            f"flood-повторов {stats.retries}, в очереди {queued[priority]}\n"
+            f"⏳ ожидание: {stats.wait.describe()}\n"
+            f"📨 доставка: {stats.latency.describe()}\n"
+        )
+    await message.answer(text, parse_mode='HTML')
+
+@dp.message(Command('cache_stats'))
+async def cache_stats_command(message: types.Message):
+    """Команда для просмотра попаданий в кэши запросов к телеграму"""
+    user_id = message.from_user.id
     
-    kb = None
-    if button:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=button['text'], url=button['url'])]])
+    user_id_str = str(user_id)
     
-    # шлём пачками, чтобы не словить лимиты
-    for idx, uid in enumerate(recipients):
-        try:
-            photo_id = data.get('broadcast_photo_id')
-            if photo_id:
-                await bot.send_photo(int(uid), photo_id, caption=text, parse_mode='HTML', reply_markup=kb)
-            else:
-                await bot.send_message(int(uid), text, parse_mode='HTML', reply_markup=kb, link_preview_options=types.LinkPreviewOptions(is_disabled=True))
-            sent += 1
-        except Exception:
-            failed += 1
-        # лёгкая пауза каждые 25 сообщений
-        if (idx + 1) % 25 == 0:
-            try:
-                await callback.message.edit_text(f'отправляю... {sent}/{total}, ошибок: {failed}')
-            except Exception:
-                pass
-            await asyncio.sleep(0.5)
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
     
-    summary = f'готово. отправлено: {sent}/{total}, не доставлено: {failed}'
+    # Проверяем, является ли пользователь администратором
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
     
-    try:
-        await callback.message.edit_text(summary)
-    except Exception:
-        await bot.send_message(user_id, summary)
-    await state.clear()
+    cache = subscription_cache
+    lookups = cache.hits + cache.misses + cache.coalesced
+    hit_rate = (cache.hits + cache.coalesced) / lookups * 100 if lookups else 0
+    text = (
+        f"🗂 <b>кэши запросов к телеграму</b>\n\n"
+        f"<b>подписка на @{SUBSCRIPTION_CHANNEL}</b> (ttl {SUBSCRIPTION_TTL:g} с, отказ {SUBSCRIPTION_NEGATIVE_TTL:g} с)\n"
+        f"попаданий: {cache.hits}, промахов: {cache.misses}, слито в один запрос: {cache.coalesced}\n"
+        f"без запроса: {hit_rate:.1f}%, записей: {len(cache.entries)}, обновлений из канала: {cache.updates}\n"
+    )
+    meta = telegram_metadata
+    text += (
+        f"\n<b>данные бота и чатов</b> (id чата живёт {CHAT_ID_TTL // 3600} ч)\n"
+        f"попаданий: {meta.hits}, запросов: {meta.misses}, слито в один запрос: {meta.coalesced}\n"
+        f"бот: @{meta.bot_username or '?'}, чатов в кэше: {len(meta.chats)}\n"
+    )
+    await message.answer(text, parse_mode='HTML')
+
 @dp.message(AdminState.waiting_for_warn_reason)
 async def warn_reason_entered(message: types.Message, state: FSMContext):
     # Проверяем, что это личное сообщение
@@ -4733,14 +8535,14 @@ async def annul_balance(target_user_id: int, amount: int):
     current_balance = user_data.get('balance', 0)
     
     if amount == -1:  # аннулировать весь баланс
-        user_data['balance'] = 0
+        debit(target_user_id, current_balance, 'annul_balance')
         annuled_amount = current_balance
     
     else:
-        user_data['balance'] = max(0, current_balance - amount)
+        debit(target_user_id, amount, 'annul_balance', floor=0)
         annuled_amount = min(amount, current_balance)
     
-    save_users()
+    save_users(critical=True)
     
     # Отправляем уведомление пользователю
     try:
@@ -4941,8 +8743,8 @@ async def annul_balance_simple(target_user_id: int):
     
     current_balance = user_data.get('balance', 0)
     
-    user_data['balance'] = 0
-    save_users()
+    debit(target_user_id, current_balance, 'annul_balance')
+    save_users(critical=True)
     
     # Уведомляем пользователя
     try:
@@ -4970,7 +8772,7 @@ async def annul_balance_simple(target_user_id: int):
 # === тестовая команда для проверки изображений рулетки ===
 @dp.message(Command('test_roulette'))
 async def test_roulette_images(message: types.Message):
-    """тестирует создание изображений рулетки"""
+    """тестирует изображения рулетки"""
     user_id = message.from_user.id
     
     user_id_str = str(user_id)    # Проверяем, является ли пользователь администратором
@@ -4982,41 +8784,38 @@ async def test_roulette_images(message: types.Message):
     
     try:
         # Тестируем создание изображения для красного числа
-        red_image = create_roulette_result_image(7, 'red', 'красное', 1000, True, 2, 2000)
+        red_image = get_roulette_image(7)
         
-        if red_image and os.path.exists(red_image):
-            await bot.send_photo(
+        if red_image is not None:
+            await send_photo_asset(
                 message.chat.id,
-                types.FSInputFile(red_image),
+                red_image,
                 caption="✅ Тест красного числа (7)"
             )
-            os.remove(red_image)
         else:
             await message.answer('❌ Ошибка создания изображения для красного числа')
         
         # Тестируем создание изображения для черного числа
-        black_image = create_roulette_result_image(8, 'black', 'черное', 1000, True, 2, 2000)
+        black_image = get_roulette_image(8)
         
-        if black_image and os.path.exists(black_image):
-            await bot.send_photo(
+        if black_image is not None:
+            await send_photo_asset(
                 message.chat.id,
-                types.FSInputFile(black_image),
+                black_image,
                 caption="✅ Тест черного числа (8)"
             )
-            os.remove(black_image)
         else:
             await message.answer('❌ Ошибка создания изображения для черного числа')
         
         # Тестируем создание изображения для зеро
-        zero_image = create_roulette_result_image(0, 'green', 'зеро', 1000, True, 36, 36000)
+        zero_image = get_roulette_image(0)
         
-        if zero_image and os.path.exists(zero_image):
-            await bot.send_photo(
+        if zero_image is not None:
+            await send_photo_asset(
                 message.chat.id,
-                types.FSInputFile(zero_image),
+                zero_image,
                 caption="✅ Тест зеро (0)"
             )
-            os.remove(zero_image)
         else:
             await message.answer('❌ Ошибка создания изображения для зеро')
         
@@ -5354,13 +9153,664 @@ async def show_settings_menu(message: types.Message, user_id_str: str):
     
     await message.edit_text(settings_text, parse_mode='HTML', reply_markup=markup)
 
-async def main():
-    # Удаляем webhook перед запуском polling
+# === приём обновлений через вебхук ===
+# раньше бот умел только long polling: один цикл getUpdates, за каждой пачкой - запрос к
+# телеграму. BOT_MODE=webhook поднимает aiohttp-сервер: телеграм сам присылает обновления
+# по нескольким соединениям, сервер сверяет секретный токен, сразу отвечает 200 и обрабатывает
+# обновление отдельной задачей (не больше WEBHOOK_MAX_CONCURRENT одновременно; если очередь
+# переполнена, отвечаем 503 и телеграм повторит позже). без WEBHOOK_URL вебхук у телеграма не
+# ставится, а сервер слушает только 127.0.0.1 - так его можно проверять локально, отправляя
+# записанные обновления: python app.py replay_updates updates.jsonl [адрес]
+# без секрета любой, кто достучится до сервера, пришлёт поддельное обновление (например, от
+# имени админа), поэтому с WEBHOOK_URL или на внешнем адресе без WEBHOOK_SECRET сервер не стартует
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling или webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес, например https://bot.example.com/webhook
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0' if WEBHOOK_URL else '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # соединений от телеграма
+WEBHOOK_MAX_CONCURRENT = int(os.getenv('WEBHOOK_MAX_CONCURRENT', '100'))  # обновлений в обработке
+WEBHOOK_MAX_BACKLOG = int(os.getenv('WEBHOOK_MAX_BACKLOG', '10000'))  # принятых, но ещё не обработанных
+WEBHOOK_DRAIN_TIMEOUT = 30  # сколько ждать недообработанные обновления при остановке
+WEBHOOK_LOCAL_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+def webhook_config_error(url: str = WEBHOOK_URL, host: str = WEBHOOK_HOST, secret: str = WEBHOOK_SECRET):
+    """почему вебхук с такими настройками запускать нельзя (None - можно)"""
+    if secret:
+        return None
+    if url:
+        return "WEBHOOK_URL задан, а WEBHOOK_SECRET нет - телеграм не подпишет обновления"
+    if host not in WEBHOOK_LOCAL_HOSTS:
+        return f"WEBHOOK_HOST={host} доступен снаружи, а WEBHOOK_SECRET не задан"
+    return None
+
+class WebhookServer:
+    """aiohttp-приложение, которое принимает обновления и отдаёт их диспетчеру задачами"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret: str = WEBHOOK_SECRET,
+                 max_concurrent: int = WEBHOOK_MAX_CONCURRENT, max_backlog: int = WEBHOOK_MAX_BACKLOG):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.max_backlog = max_backlog
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.tasks = set()
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.runner = None
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post(WEBHOOK_PATH, self.handle)
+        return application
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(
+                request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), self.secret):
+            return web.Response(status=401)
+        if len(self.tasks) >= self.max_backlog:
+            self.rejected += 1
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except Exception as e:
+            print(f"⚠️ Не удалось разобрать обновление: {e}")
+            return web.Response(status=400)
+        return await self.accept(data)
+
+    async def accept(self, data) -> web.Response:
+        """отдаёт разобранное обновление на обработку"""
+        try:
+            update = types.Update.model_validate(data, context={'bot': self.bot})
+        except Exception as e:
+            print(f"⚠️ Не удалось разобрать обновление: {e}")
+            return web.Response(status=400)
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        async with self.semaphore:
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+        error = webhook_config_error(host=host, secret=self.secret)
+        if error:
+            raise RuntimeError(f"вебхук не запущен: {error}")
+        # access-лог aiohttp писал бы строку на каждое обновление
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=WEBHOOK_DRAIN_TIMEOUT)
+
+async def run_webhook():
+    """работа через вебхук до SIGINT/SIGTERM"""
+    server = WebhookServer(dp, bot)
+    await server.start()
+    print(f"🌐 Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        print(f"✅ Вебхук установлен: {WEBHOOK_URL}")
+    else:
+        print(f"⚠️ WEBHOOK_URL не задан - вебхук у телеграма не ставим, принимаем запросы на {WEBHOOK_HOST}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        print("✅ Webhook удален, запускаем polling...")
-    except Exception as e:
-        print(f"⚠️ Ошибка при удалении webhook: {e}")
+        await stop.wait()
+    finally:
+        # вебхук у телеграма не снимаем: обновления подождут у него до перезапуска
+        await server.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        print(f"🌐 Вебхук остановлен: принято {server.received}, обработано {server.processed}, "
+              f"ошибок {server.failed}, отклонено {server.rejected}")
+
+async def replay_updates(path: str, url: str, concurrency: int = WEBHOOK_MAX_CONNECTIONS):
+    """отправляет записанные обновления (по одному json в строке) на локальный вебхук"""
+    with open(path, 'r', encoding='utf-8') as f:
+        updates = [line for line in f if line.strip()]
+    headers = {'Content-Type': 'application/json'}
+    if WEBHOOK_SECRET:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = WEBHOOK_SECRET
+    statuses = collections.Counter()
+    position = 0
+    started = time.monotonic()
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def sender():
+            nonlocal position
+            while position < len(updates):
+                body = updates[position]
+                position += 1
+                async with session.post(url, data=body) as response:
+                    statuses[response.status] += 1
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    print(f"📨 Отправлено {len(updates)} обновлений за {elapsed:.2f} с "
+          f"({len(updates) / max(elapsed, 1e-9):.0f}/с), ответы: {dict(statuses)}")
+
+# === шардирование по игрокам ===
+# один процесс упирается в одно ядро: все спины всех игроков идут через один цикл событий.
+# при SHARD_WORKERS=N процесс становится фронтом: принимает обновления (polling или вебхук),
+# запускает N воркеров (python app.py shard_worker) и отдаёт каждое обновление воркеру
+# игрока - shard_for(id, N). у одного игрока все обновления идут через одно соединение
+# и обрабатываются воркером строго по очереди, разные игроки - параллельно.
+#
+# все воркеры держат в памяти всю базу, но пишут в общий sqlite только своих игроков.
+# протокол между шардами (сообщения идут через фронт):
+#   op      - изменение поля/записи чужого игрока уходит владельцу, у себя меняется только копия
+#   delta   - изменение баланса чужого игрока уходит разницей: начисления с разных шардов складываются
+#   replica - после каждой записи в базу владелец рассылает свежие записи своих игроков
+#   reload  - база очищена или переписана целиком, остальные перечитывают её
+#   call    - вызов функции на другом шарде с ответом (промокоды живут на шарде 0,
+#             ставку игрока проверяет и списывает шард, который им владеет)
+#   refund  - отмена ставки по её id, если ответ на call со ставкой не дошёл
+# копии чужих игроков согласованы в конечном счёте: переводы и админские правки видят
+# чужой баланс с задержкой, но сама запись о деньгах не теряется и не перетирается.
+# игры двух игроков (баскет, кости) живут на шарде создателя: нажатия их кнопок фронт
+# отдаёт туда же, а ставку второго игрока списывает его шард (take_stake_shared).
+# промокоды, налоги, чаты, рассылки, резервные копии и налоговый планировщик - только на шарде 0
+#
+# ограничение: каждый воркер применяет реплики всех остальных, то есть пересобирает запись
+# (и индексы) каждого игрока, изменённого где угодно. эта работа не делится между воркерами
+# и растёт с их числом, поэтому пропускная способность упирается в поток реплик, а не в ядра.
+# на одном ядре режим медленнее и одного воркера (bench/bench_shards.py), на нескольких ядрах
+# рост не проверен - не включайте SHARD_WORKERS > 1 в расчёте на ускорение без такого замера
+SHARD_SOCKET = os.getenv('SHARD_SOCKET', 'shards.sock')  # unix-сокет между фронтом и воркерами
+SHARD_LINE_LIMIT = 64 * 1024 * 1024  # самое длинное сообщение (пачка записей после сохранения)
+SHARD_START_TIMEOUT = 120  # воркер грузит всю базу, прежде чем подключиться
+SHARD_STOP_TIMEOUT = 60
+SHARD_CALL_TIMEOUT = 10
+SHARD_POLL_TIMEOUT = 30  # long polling фронта
+
+# кнопки игр двух игроков: в конце callback_data - id создателя игры
+SHARD_PINNED_CALLBACKS = ('basket_accept_', 'basket_cancel_', 'dice_accept_', 'dice_cancel_')
+
+def game_button(action: str, initiator_id) -> str:
+    """callback_data кнопки игры двух игроков; action - один из SHARD_PINNED_CALLBACKS без '_'"""
+    return f'{action}_{initiator_id}'
+
+def game_button_owner(data: str) -> str | None:
+    """id создателя игры из callback_data (None - не кнопка игры или кнопка старого формата)"""
+    if not data.startswith(SHARD_PINNED_CALLBACKS):
+        return None
+    owner = data.rsplit('_', 1)[1]
+    return owner if owner.isdigit() else None
+
+def update_actor_id(data: dict):
+    """id игрока, от которого пришло обновление (сырой json), или id чата, если игрока нет"""
+    for kind, payload in data.items():
+        if kind == 'update_id' or not isinstance(payload, dict):
+            continue
+        if kind == 'my_chat_member':
+            return None  # бота добавили/выгнали - это про список чатов, он на шарде 0
+        if kind == 'callback_query':
+            owner = game_button_owner(payload.get('data') or '')
+            if owner is not None:
+                return int(owner)  # игра живёт на шарде создателя, а не нажавшего
+        if kind == 'chat_member':
+            user = (payload.get('new_chat_member') or {}).get('user')
+        else:
+            user = payload.get('from') or payload.get('user')
+        if user:
+            return user.get('id')
+        chat = payload.get('chat') or payload.get('actor_chat')
+        return chat.get('id') if chat else None
+    return None
+
+def _apply_shard_op(message: dict):
+    """применяет изменение своего игрока, сделанное на другом шарде"""
+    op, user_id = message['op'], message['uid']
+    if op == 'put':
+        users[user_id] = message['value']
+    elif op == 'del':
+        users.pop(user_id, None)
+    else:
+        user_data = users.get(user_id)
+        if user_data is None:
+            return
+        if op == 'set':
+            user_data[message['field']] = message['value']
+        else:
+            user_data.pop(message['field'], None)
+    save_users('shard_op')
+    if op == 'put':
+        _settle_parked_deltas()
+
+# изменение баланса игрока, которого владелец не знает (запись удалена или ещё не дошла),
+# не выбрасываем: деньги уже ушли с другого шарда. оно ждёт в файле и применяется, как только
+# запись игрока появится; то, что осталось в файле, админ видит и разбирает вручную
+SHARD_PARKED_DELTAS_FILE = shard_local_path('shard_parked_deltas.json')
+_parked_deltas = {}  # игрок -> [[разница, причина], ...]
+
+def _load_parked_deltas():
+    global _parked_deltas
+    try:
+        with open(SHARD_PARKED_DELTAS_FILE, encoding='utf-8') as f:
+            _parked_deltas = json.load(f)
+    except FileNotFoundError:
+        _parked_deltas = {}
+
+def _settle_parked_deltas() -> int:
+    """применяет отложенные изменения игроков, которые уже появились; возвращает их число"""
+    settled = 0
+    for user_id in [user_id for user_id in _parked_deltas if user_id in users]:
+        for delta, reason in _parked_deltas.pop(user_id):
+            credit(user_id, delta, reason)
+            settled += 1
+    if settled:
+        save_users('shard_parked_delta')
+        _write_json_atomic(SHARD_PARKED_DELTAS_FILE, _parked_deltas)
+        print(f"💸 Применено отложенных изменений баланса: {settled}")
+    return settled
+
+def _apply_shard_delta(message: dict):
+    user_id = message['uid']
+    if user_id not in users:
+        _parked_deltas.setdefault(user_id, []).append([message['delta'], message['reason']])
+        _write_json_atomic(SHARD_PARKED_DELTAS_FILE, _parked_deltas)
+        print(f"⚠️ Изменение баланса {message['delta']} для неизвестного игрока {user_id} отложено до появления его записи")
+        return
+    credit(user_id, message['delta'], message['reason'])
+
+def _apply_replicas(records: dict):
+    for user_id, user_data in records.items():
+        if not shard_owns(user_id):
+            users.replicate(user_id, user_data)
+
+def _reload_users():
+    """перечитывает базу из хранилища после её очистки/замены на другом шарде"""
+    global users
+    flush_user_changes('shard_reload')
+    users = load_users()
+    user_index.rebuild(users)
+    leaderboard.rebuild(users)
+    deposit_index.rebuild(users)
+    _settle_parked_deltas()
+
+SHARD_CALLS = {'activate_promo': activate_promo, 'take_stake': take_stake}  # что можно вызвать с другого шарда
+
+class ShardFeeder:
+    """обработка обновлений на воркере: у одного игрока по очереди, у разных - параллельно"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrent: int = WEBHOOK_MAX_CONCURRENT):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.queues = {}  # игрок -> очередь его необработанных обновлений
+        self.tasks = set()
+        self.processed = 0
+        self.failed = 0
+
+    def feed(self, data: dict):
+        key = update_actor_id(data)
+        queue = self.queues.get(key)
+        if queue is not None:
+            queue.append(data)
+            return
+        self.queues[key] = collections.deque([data])
+        task = asyncio.create_task(self._drain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _drain(self, key):
+        queue = self.queues[key]
+        try:
+            while queue:
+                data = queue.popleft()
+                async with self.semaphore:
+                    try:
+                        update = types.Update.model_validate(data, context={'bot': self.bot})
+                        await self.dispatcher.feed_update(self.bot, update)
+                        self.processed += 1
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"❌ Ошибка обработки обновления {data.get('update_id')}: {e}")
+        finally:
+            del self.queues[key]
+
+    async def wait(self, timeout: float):
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+class ShardLink:
+    """соединение воркера с фронтом: обновления и сообщения других шардов"""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.calls = {}  # id вызова -> future с ответом
+        self._call_ids = itertools.count(1)
+        self.stopping = asyncio.Event()
+        self.sent = 0
+        self.received = 0
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self, path: str = SHARD_SOCKET):
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(path, limit=SHARD_LINE_LIMIT)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self.writer.write(f'{SHARD_INDEX}\n'.encode())
+        # всё, что шард успел изменить у чужих игроков до подключения
+        for to, message in _shard_outbox:
+            self.send(to, message)
+        _shard_outbox.clear()
+
+    def send(self, to, message: dict):
+        self.sent += 1
+        self.writer.write(f'{to}\t{json.dumps(message, ensure_ascii=False, default=str)}\n'.encode())
+
+    async def call(self, to: int, name: str, args: list, timeout: float = SHARD_CALL_TIMEOUT):
+        """вызывает SHARD_CALLS[name](*args) на шарде to и возвращает результат"""
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[call_id] = future
+        self.send(to, {'t': 'call', 'id': call_id, 'from': SHARD_INDEX, 'name': name, 'args': args})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.calls.pop(call_id, None)
+
+    def _answer(self, message: dict):
+        reply = {'t': 'reply', 'id': message['id']}
+        try:
+            reply['result'] = SHARD_CALLS[message['name']](*message['args'])
+        except Exception as e:
+            reply['error'] = f'{type(e).__name__}: {e}'
+        self.send(message['from'], reply)
+
+    def _replied(self, message: dict):
+        future = self.calls.get(message['id'])
+        if future is None or future.done():
+            return
+        if 'error' in message:
+            future.set_exception(RuntimeError(message['error']))
+        else:
+            future.set_result(message['result'])
+
+    async def run(self, feeder: ShardFeeder):
+        """читает сообщения фронта, пока он не попросит остановиться или не закроет соединение"""
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            self.received += 1
+            kind = message['t']
+            try:
+                if kind == 'update':
+                    feeder.feed(message['u'])
+                elif kind == 'replica':
+                    _apply_replicas(message['users'])
+                elif kind == 'delta':
+                    _apply_shard_delta(message)
+                elif kind == 'refund':
+                    refund_stake(message['stake'], message['reason'])
+                elif kind == 'op':
+                    _apply_shard_op(message)
+                elif kind == 'call':
+                    self._answer(message)
+                elif kind == 'reply':
+                    self._replied(message)
+                elif kind == 'reload':
+                    _reload_users()
+                elif kind == 'stop':
+                    self.stopping.set()
+            except Exception as e:
+                print(f"❌ Ошибка сообщения шарда ({kind}): {e}")
+        self.stopping.set()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            with contextlib.suppress(Exception):
+                await self.writer.wait_closed()
+
+shard_link = ShardLink() if SHARD_COUNT else None
+
+async def run_shard_worker():
+    """воркер шарда: обрабатывает обновления своих игроков, пока фронт не остановит"""
+    feeder = ShardFeeder(dp, bot)
+    _load_parked_deltas()
+    _settle_parked_deltas()
+    await shard_link.connect()
+    print(f"🧩 Шард {SHARD_INDEX}/{SHARD_COUNT} подключен к фронту")
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, shard_link.stopping.set)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    reader = asyncio.create_task(shard_link.run(feeder))
+    try:
+        await shard_link.stopping.wait()
+    finally:
+        # соединение ещё открыто: дорабатываем принятое и рассылаем последние записи
+        await feeder.wait(WEBHOOK_DRAIN_TIMEOUT)
+        users_write_behind.flush_now('shard_stop')
+        reader.cancel()
+        await shard_link.close()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        print(f"🧩 Шард {SHARD_INDEX} остановлен: обработано {feeder.processed}, ошибок {feeder.failed}, "
+              f"сообщений шардам {shard_link.sent}, от фронта {shard_link.received}")
+
+class ShardFront:
+    """фронт: держит воркеров и раздаёт им обновления по игрокам"""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.writers = {}  # номер шарда -> соединение
+        self.backlog = collections.defaultdict(list)  # сообщения шардам, которые ещё не подключились
+        self.processes = []
+        self.server = None
+        self.ready = asyncio.Event()
+        self.routed = [0] * count
+        self.relayed = 0
+
+    async def start(self, path: str = SHARD_SOCKET):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        self.server = await asyncio.start_unix_server(self._serve, path, limit=SHARD_LINE_LIMIT)
+        for index in range(self.count):
+            env = dict(os.environ, SHARD_WORKERS='0', SHARD_COUNT=str(self.count),
+                       SHARD_INDEX=str(index), SHARD_SOCKET=path)
+            self.processes.append(await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), 'shard_worker', env=env))
+        await asyncio.wait_for(self.ready.wait(), SHARD_START_TIMEOUT)
+
+    def _write(self, index: int, line: bytes):
+        writer = self.writers.get(index)
+        if writer is None:
+            self.backlog[index].append(line)
+        elif not writer.is_closing():
+            writer.write(line)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        index = int(await reader.readline())
+        self.writers[index] = writer
+        for line in self.backlog.pop(index, ()):
+            writer.write(line)
+        if len(self.writers) == self.count:
+            self.ready.set()
+        try:
+            # воркер пишет "кому<tab>сообщение": пересылаем адресату или всем остальным
+            while line := await reader.readline():
+                to, _, body = line.partition(b'\t')
+                self.relayed += 1
+                if to == b'*':
+                    for other in range(self.count):
+                        if other != index:
+                            self._write(other, body)
+                else:
+                    self._write(int(to), body)
+        except ConnectionError:
+            pass  # воркер завершился - его смерть заметит run_shard_front
+        finally:
+            self.writers.pop(index, None)
+
+    async def route(self, data: dict):
+        """отдаёт обновление воркеру его игрока"""
+        index = shard_for(update_actor_id(data), self.count)
+        self.routed[index] += 1
+        self._write(index, json.dumps({'t': 'update', 'u': data}, ensure_ascii=False).encode() + b'\n')
+        writer = self.writers.get(index)
+        if writer is not None:
+            with contextlib.suppress(ConnectionError):
+                await writer.drain()  # воркер не успевает - притормаживаем приём
+
+    async def poll(self):
+        """long polling getUpdates сырым json: фронт не разбирает обновления, только читает id игрока"""
+        url = bot.session.api.api_url(token=bot.token, method='getUpdates')
+        allowed_updates = dp.resolve_used_update_types()
+        offset = 0
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    async with session.post(
+                        url,
+                        json={'offset': offset, 'timeout': SHARD_POLL_TIMEOUT, 'allowed_updates': allowed_updates},
+                        timeout=aiohttp.ClientTimeout(total=SHARD_POLL_TIMEOUT + 10),
+                    ) as response:
+                        payload = await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    print(f"⚠️ Ошибка getUpdates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not payload.get('ok'):
+                    print(f"⚠️ getUpdates вернул ошибку: {payload.get('description')}")
+                    await asyncio.sleep(1)
+                    continue
+                for data in payload['result']:
+                    offset = data['update_id'] + 1
+                    await self.route(data)
+
+    async def stop(self):
+        # просим воркеров доработать и сохраниться; пока они не отключились, пересылаем их сообщения
+        for index in range(self.count):
+            self._write(index, b'{"t": "stop"}\n')
+        waiting = [process.wait() for process in self.processes if process.returncode is None]
+        if waiting:
+            done, pending = await asyncio.wait([asyncio.ensure_future(w) for w in waiting], timeout=SHARD_STOP_TIMEOUT)
+            if pending:
+                for process in self.processes:
+                    if process.returncode is None:
+                        process.kill()
+                await asyncio.wait(pending)
+        if self.server is not None:
+            self.server.close()
+
+class ShardWebhookServer(WebhookServer):
+    """вебхук фронта: обновление не обрабатывается, а сразу уходит воркеру"""
+
+    def __init__(self, front: ShardFront):
+        super().__init__(dp, bot)
+        self.front = front
+
+    async def accept(self, data) -> web.Response:
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return web.Response(status=400)
+        self.received += 1
+        await self.front.route(data)
+        self.processed += 1
+        return web.Response()
+
+async def run_shard_front(count: int = SHARD_WORKERS):
+    """фронт: приём обновлений и N воркеров до SIGINT/SIGTERM или падения воркера"""
+    # миграция схемы - один раз и до старта воркеров; дальше фронт базу не трогает
+    open_users()
+    migrate_existing_users()
+    flush_user_changes('shard_front')
+    user_storage.close()
+    front = ShardFront(count)
+    await front.start()
+    print(f"🧩 Фронт запустил {count} воркеров")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    watchers = [asyncio.create_task(process.wait()) for process in front.processes]
+    for watcher in watchers:
+        watcher.add_done_callback(lambda _: stop.set())  # воркер упал - останавливаемся целиком
+    server = None
+    intake = None
+    try:
+        if BOT_MODE == 'webhook':
+            server = ShardWebhookServer(front)
+            await server.start()
+            print(f"🌐 Вебхук фронта слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            if WEBHOOK_URL:
+                await bot.set_webhook(
+                    WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=dp.resolve_used_update_types(),
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                )
+                print(f"✅ Вебхук установлен: {WEBHOOK_URL}")
+        else:
+            try:
+                await bot.delete_webhook(drop_pending_updates=True)
+                print("✅ Webhook удален, запускаем polling...")
+            except Exception as e:
+                print(f"⚠️ Ошибка при удалении webhook: {e}")
+            intake = asyncio.create_task(front.poll())
+        await stop.wait()
+    finally:
+        if intake is not None:
+            intake.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await intake
+        if server is not None:
+            await server.stop()
+        await front.stop()
+        for watcher in watchers:
+            watcher.cancel()
+        await bot.session.close()
+        print(f"🧩 Фронт остановлен: обновлений по шардам {front.routed}, пересылок между шардами {front.relayed}")
+
+async def main():
+    # Загружаем пользователей и мигрируем их (при шардировании миграцию уже сделал фронт)
+    open_users()
+    migrate_existing_users()
+    
+    # Удаляем webhook перед запуском polling (у шардов обновления принимает фронт)
+    if BOT_MODE != 'webhook' and not SHARD_COUNT:
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+            print("✅ Webhook удален, запускаем polling...")
+        except Exception as e:
+            print(f"⚠️ Ошибка при удалении webhook: {e}")
     
     # Загружаем настройки налога
     load_tax_settings()
@@ -5368,17 +9818,62 @@ async def main():
     # Загружаем промокоды
     load_promo_codes()
     
-    # Запускаем пинг в фоне
-    ping_task = asyncio.create_task(start_ping())
+    # пинг, налог и резервные копии - общие для всех игроков, при шардировании их ведёт шард 0
+    if not SHARD_INDEX:
+        # Запускаем пинг в фоне
+        ping_task = asyncio.create_task(start_ping())
+        
+        # Запускаем планировщик налога в фоне
+        tax_task = asyncio.create_task(start_wealth_tax_scheduler())
+        
+        # Запускаем планировщик резервного копирования в фоне
+        backup_task = asyncio.create_task(start_backup_scheduler())
+    
+    # Запускаем компактор журнала пользователей в фоне
+    journal_task = asyncio.create_task(start_journal_compactor())
+    
+    # Запускаем отложенную запись пользователей
+    users_write_behind.start()
+    
+    # Запускаем запись промокодов, налогов и чатов
+    side_stores.start()
+    
+    # Рисуем картинки рулетки заранее, чтобы спины не ждали PIL и диска
+    rendered = await asyncio.to_thread(prerender_roulette_images)
+    print(f"🎰 Картинки рулетки готовы: {rendered}/37")
     
-    # Запускаем планировщик налога в фоне
-    tax_task = asyncio.create_task(start_wealth_tax_scheduler())
+    # Запускаем уведомления о созревших вкладах
+    notify_sender.start()
+    deposit_scheduler.start()
     
-    # Запускаем планировщик резервного копирования в фоне
-    backup_task = asyncio.create_task(start_backup_scheduler())
+    # Данные бота и id основного чата - один раз, а не в обработчиках
+    await telegram_metadata.warm_up()
     
-    # Запускаем бота
-    await dp.start_polling(bot)
+    # Изредка перепроверяем недоступных получателей
+    dead_recipients.start()
+    
+    # Продолжаем рассылку, если её прервал перезапуск (рассылки запускают админы - на шарде 0)
+    if not SHARD_INDEX:
+        broadcast_engine.resume()
+    
+    # Запускаем бота (start_polling, run_webhook и воркер шарда сами ловят SIGTERM/SIGINT и завершаются штатно)
+    try:
+        if SHARD_COUNT:
+            await run_shard_worker()
+        elif BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await broadcast_engine.stop()
+        await dead_recipients.stop()
+        await deposit_scheduler.stop()
+        await notify_sender.stop()
+        await outbound.stop()
+        # дописываем всё, что не успели сохранить, чтобы не потерять ни одного спина
+        await users_write_behind.drain()
+        await side_stores.drain()
+        user_storage.close()
 
 # Добавляем команду для перезагрузки БД
 @dp.message(Command('reload_db'))
@@ -5439,7 +9934,7 @@ async def create_backup_command(message: types.Message):
     await message.answer('💾 создаю резервную копию базы данных...')
     
     try:
-        success = create_backup()
+        success = await create_backup()
         if success:
             await message.answer('✅ резервная копия базы данных успешно создана!')
         else:
@@ -5447,6 +9942,144 @@ async def create_backup_command(message: types.Message):
     except Exception as e:
         await message.answer(f'❌ ошибка при создании резервной копии: {e}')
 
+@dp.message(Command('storage_status'))
+async def storage_status_command(message: types.Message):
+    """Команда для проверки состояния отложенной записи базы"""
+    user_id = message.from_user.id
+    
+    user_id_str = str(user_id)
+    
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
+    
+    # Проверяем, является ли пользователь администратор
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
+    
+    stats = users_write_behind.stats()
+    side_stats = side_stores.stats()
+    status_text = (
+        f"💾 <b>Состояние хранилища</b>\n\n"
+        f"🗄️ <b>Хранилище:</b> {user_storage.name}\n"
+        f"⚙️ <b>Фоновая запись:</b> {'✅' if users_write_behind.running else '❌'} (раз в {USERS_FLUSH_INTERVAL_MS} мс)\n\n"
+        f"📝 <b>Вызовов save_users:</b> {stats['marks']}\n"
+        f"💽 <b>Реальных записей:</b> {stats['flushes']}\n"
+        f"🔗 <b>Объединено записей:</b> {stats['coalesced']}\n"
+        f"📄 <b>Записано изменений:</b> {stats['records']}\n\n"
+        f"⏱️ <b>Время записи:</b> последняя {stats['last_flush_ms']:.1f} мс, средняя {stats['avg_flush_ms']:.1f} мс, макс {stats['max_flush_ms']:.1f} мс\n"
+        f"⌛ <b>Отставание:</b> сейчас {stats['staleness_ms']:.0f} мс, макс {stats['max_staleness_ms']:.0f} мс\n\n"
+        f"📁 <b>Промокоды/налоги/чаты:</b> изменений {side_stats['marks']}, записей {side_stats['writes']}, "
+        f"ошибок {side_stats['failures']}, ждут записи: {', '.join(side_stats['dirty']) or 'нет'}"
+    )
+    
+    await message.answer(status_text, parse_mode='HTML')
+
+@dp.message(Command('check_indexes'))
+async def check_indexes_command(message: types.Message):
+    """Команда для сверки индексов юзернеймов, ников и рейтинга с базой"""
+    user_id = message.from_user.id
+    
+    user_id_str = str(user_id)
+    
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
+    
+    # Проверяем, является ли пользователь администратор
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
+    
+    problems = user_index.check() + leaderboard.check() + deposit_index.check()
+    if not problems:
+        await message.answer(
+            f"✅ индексы сходятся с базой\n\n"
+            f"📱 юзернеймов: {len(user_index.maps['tg_username'])}\n"
+            f"👤 ников: {len(user_index.maps['nick'])}\n"
+            f"💰 в рейтинге: {len(leaderboard)}\n"
+            f"🏦 активных вкладов: {len(deposit_index)}"
+        )
+        return
+    
+    # расхождение - сообщаем и перестраиваем индексы с нуля
+    user_index.rebuild(users)
+    leaderboard.rebuild(users)
+    deposit_index.rebuild(users)
+    preview = '\n'.join(problems[:20])
+    await message.answer(
+        f"⚠️ найдено расхождений: {len(problems)}, индексы перестроены\n\n<code>{html_escape(preview)}</code>",
+        parse_mode='HTML'
+    )
+
+@dp.message(Command('restore_at'))
+async def restore_at_command(message: types.Message):
+    """Команда восстановления базы на момент времени: /restore_at ГГГГ-ММ-ДД ЧЧ:ММ[:СС] [user_id] [apply]"""
+    user_id = message.from_user.id
+    
+    user_id_str = str(user_id)
+    
+    # Собираем информацию о пользователе
+    collect_user_info(message, user_id_str)
+    
+    # Проверяем, является ли пользователь администратор
+    if user_id not in ADMIN_IDS:
+        await message.answer('у тебя нет доступа к этой команде')
+        return
+    
+    args = message.text.split()[1:]
+    apply = bool(args) and args[-1].lower() == 'apply'
+    if apply:
+        args = args[:-1]
+    try:
+        # время - либо дата и время двумя словами, либо unix-время одним
+        if len(args) >= 2 and not args[0].isdigit():
+            target_time = parse_restore_time(f'{args[0]} {args[1]}')
+            rest = args[2:]
+        else:
+            target_time = parse_restore_time(args[0])
+            rest = args[1:]
+    except (IndexError, ValueError):
+        await message.answer(
+            'использование: /restore_at ГГГГ-ММ-ДД ЧЧ:ММ[:СС] [user_id] [apply]\n\n'
+            'без apply только показывает, что изменится'
+        )
+        return
+    target_user = rest[0] if rest else None
+    
+    await message.answer('⏳ собираю состояние на этот момент...')
+    # всё изменённое до этой секунды должно быть в журнале, иначе сравнение будет неполным
+    users_write_behind.flush_now('restore_at')
+    try:
+        restored, info = await asyncio.to_thread(restore_point_in_time, target_time, target_user)
+    except Exception as e:
+        await message.answer(f'❌ не удалось восстановить: {e}')
+        return
+    
+    diff = diff_users(users, restored, target_user)
+    moment = datetime.datetime.fromtimestamp(target_time).strftime('%d.%m.%Y %H:%M:%S')
+    summary = (
+        f"🕰️ <b>Состояние на {moment}</b>\n\n"
+        f"💾 копия: {info['point']}\n"
+        f"📄 изменений из журнала: {info['replayed']} ({info['segments']} файлов)\n"
+        f"⏱️ собрано за {info['seconds']:.1f} с\n"
+        f"🔀 отличий от текущей базы: {len(diff)}"
+    )
+    if diff:
+        preview = '\n'.join(diff[:30])
+        if len(preview) > 3000:
+            preview = preview[:3000] + '...'
+        summary += f"\n\n<code>{html_escape(preview)}</code>"
+        if len(diff) > 30:
+            summary += f"\n... и ещё {len(diff) - 30}"
+    
+    if apply and diff:
+        changed = apply_restored_users(restored, target_user)
+        summary += f"\n\n✅ применено: изменено {changed} пользователей"
+    elif diff:
+        summary += "\n\nчтобы применить, повтори команду с apply в конце"
+    
+    await message.answer(summary, parse_mode='HTML')
+
 @dp.message(Command('roulette_status'))
 async def roulette_status_command(message: types.Message):
     """Команда для проверки статуса рулетки"""
@@ -5730,12 +10363,9 @@ async def show_user_info(message: types.Message):
     target_user_id = None
     target_user_data = None
     
-    for uid, user_data in users.items():
-        if (user_data.get('tg_username', '').lower() == username.lower() or 
-            user_data.get('nick', '').lower() == target_text.lower()):
-            target_user_id = uid
-            target_user_data = user_data
-            break
+    target_user_id = find_user_id(username=username, nick=target_text)
+    if target_user_id is not None:
+        target_user_data = users[target_user_id]
     
     if not target_user_data:
         await message.answer('пользователь не найден')
@@ -5865,7 +10495,7 @@ async def extend_k_limit_command(message: types.Message):
     # проверяем текущий лимит
     current_max = get_max_k_count()
     
-    max_balance = max((user.get('balance', 0) for user in users.values()), default=0)
+    max_balance = leaderboard.max_balance()
     
     info_text = f"🔢 <b>информация о лимите сокращений:</b>\n\n"
     
@@ -6265,12 +10895,9 @@ async def probe_target_selected(message: types.Message, state: FSMContext):
     
     target_user_data = None
     
-    for uid, user_data in users.items():
-        if (user_data.get('tg_username', '').lower() == username.lower() or 
-            user_data.get('nick', '').lower() == target_text.lower()):
-            target_user_id = uid
-            target_user_data = user_data
-            break
+    target_user_id = find_user_id(username=username, nick=target_text)
+    if target_user_id is not None:
+        target_user_data = users[target_user_id]
     
     if not target_user_data:
         await message.answer('пользователь не найден')
@@ -6398,8 +11025,8 @@ async def give_reason_entered(message: types.Message, state: FSMContext):
         return
     # выполняем зачисление
     if target_user_id in users:
-        users[target_user_id]['balance'] = users[target_user_id].get('balance', 0) + int(amount)
-        save_users()
+        credit(target_user_id, int(amount), f'admin_give: {reason}')
+        save_users(critical=True)
         try:
             await bot.send_message(
                 int(target_user_id),
@@ -6439,6 +11066,8 @@ async def tax_percent_entered(message: types.Message, state: FSMContext):
         
         # Сохраняем настройки
         save_tax_settings()
+        # админ увидит подтверждение только после записи на диск
+        await side_stores.flush('tax_settings')
         
         await message.answer(
             f'✅ <b>процент налога изменен!</b>\n\n'
@@ -6477,6 +11106,8 @@ async def commission_percent_entered(message: types.Message, state: FSMContext):
         
         # Сохраняем настройки
         save_tax_settings()
+        # админ увидит подтверждение только после записи на диск
+        await side_stores.flush('tax_settings')
         
         await message.answer(
             f'✅ <b>процент комиссии изменен!</b>\n\n'
@@ -6574,15 +11205,14 @@ async def reset_all_balance_confirm(message: types.Message, state: FSMContext):
     
     if confirm_text == 'да':
         # обнуляем баланс всем игрокам
-        reset_count = 0
-        
-        for user_id_str, user_data in users.items():
-            if 'balance' in user_data:
-                user_data['balance'] = 0
-                reset_count += 1
+        balances = bulk_apply(
+            [(user_id_str, -user_data.get('balance', 0)) for user_id_str, user_data in users.items() if 'balance' in user_data],
+            'reset_all_balance'
+        )
+        reset_count = len(balances)
         
         # сохраняем изменения в базу данных
-        save_users()
+        save_users(critical=True)
         
         await message.answer(
             f'✅ <b>баланс обнулен всем игрокам!</b>\n\n'
@@ -6624,11 +11254,9 @@ async def add_admin_username_handler(message: types.Message, state: FSMContext):
     
     target_nick = None
     
-    for uid, user_data in users.items():
-        if user_data.get('tg_username', '').lower() == username:
-            target_user_id = uid
-            target_nick = user_data.get('nick', 'неизвестно')
-            break
+    target_user_id = find_user_id(username=username)
+    if target_user_id is not None:
+        target_nick = users[target_user_id].get('nick', 'неизвестно')
     
     if not target_user_id:
         await message.answer(f'❌ Пользователь @{username} не найден в базе данных')
@@ -6913,6 +11541,8 @@ async def create_promo_final(message: types.Message, state: FSMContext, expiry=N
     
     # Сохраняем промокоды
     save_promo_codes()
+    # админ увидит подтверждение только после записи на диск
+    await side_stores.flush('promo_codes')
     
     # Формируем сообщение об успехе
     expiry_text = "бессрочно" if expiry is None else datetime.datetime.fromtimestamp(expiry).strftime('%d.%m.%Y %H:%M')
@@ -6976,6 +11606,8 @@ async def delete_promo_callback(callback: types.CallbackQuery):
     
     # Сохраняем промокоды
     save_promo_codes()
+    # админ увидит подтверждение только после записи на диск
+    await side_stores.flush('promo_codes')
     
     await callback.answer(f'✅ промокод {promo_code} удален!', show_alert=True)
     
@@ -7029,6 +11661,12 @@ async def new_nick_handler(message: types.Message, state: FSMContext):
         await message.answer('❌ ник не должен превышать 20 символов')
         return
     
+    # ник должен оставаться уникальным и после смены
+    nick_owner = find_user_id(nick=new_nick)
+    if nick_owner is not None and nick_owner != user_id_str:
+        await message.answer('❌ этот ник уже занят, выбери другой')
+        return
+    
     # сохраняем старый ник для истории
     old_nick = user_data.get('nick', 'неизвестно')
     
@@ -7493,11 +12131,7 @@ async def annul_deposit_user_execute(message: types.Message, state: FSMContext):
         target_id = raw
     else:
         # поддержка @username
-        uname = raw.lstrip('@').lower()
-        for uid, data in users.items():
-            if str(data.get('tg_username', '')).lower() == uname:
-                target_id = uid
-                break
+        target_id = find_user_id(username=raw.lstrip('@'))
     if not target_id or target_id not in users:
         await message.answer('пользователь не найден')
         await state.clear()
@@ -7509,7 +12143,7 @@ async def annul_deposit_user_execute(message: types.Message, state: FSMContext):
     amount = users[target_id].get('bank_deposit', 0)
     users[target_id]['bank_deposit'] = 0
     users[target_id]['bank_deposit_time'] = 0
-    save_users()
+    save_users(critical=True)
     await state.clear()
     await message.answer(f'✅ вклад игрока аннулирован на сумму ${format_money(amount)}')
     # Возврат в раздел вкладов
@@ -7531,13 +12165,8 @@ async def annul_all_deposits(message: types.Message):
         return
     
     # подсчитываем статистику
-    total_deposits = 0
-    affected_users = 0
-    
-    for user_data in users.values():
-        if user_data.get('bank_deposit', 0) > 0:
-            total_deposits += user_data['bank_deposit']
-            affected_users += 1
+    total_deposits = deposit_index.total
+    affected_users = len(deposit_index)
     
     if affected_users == 0:
         await message.answer('📊 у игроков нет активных вкладов для аннулирования')
@@ -7570,19 +12199,17 @@ async def confirm_annul_deposits_callback(callback: types.CallbackQuery):
         await callback.answer('у тебя нет доступа к этой функции', show_alert=True)
         return
     
-    # аннулируем вклады
-    total_deposits = 0
-    affected_users = 0
+    # аннулируем вклады: обходим только вкладчиков, забрав их из индекса разом
+    total_deposits = deposit_index.total
+    affected_users = len(deposit_index)
     
-    for user_data in users.values():
-        if user_data.get('bank_deposit', 0) > 0:
-            total_deposits += user_data['bank_deposit']
-            user_data['bank_deposit'] = 0
-            user_data['bank_deposit_time'] = 0
-            affected_users += 1
+    for user_id_key in deposit_index.take_all():
+        user_data = users[user_id_key]
+        user_data['bank_deposit'] = 0
+        user_data['bank_deposit_time'] = 0
     
     # сохраняем изменения
-    save_users()
+    save_users(critical=True)
     
     await callback.answer('✅ вклады аннулированы!', show_alert=True)
     await callback.message.edit_text(
@@ -7754,6 +12381,17 @@ async def transfer_commission_settings_button(message: types.Message, state: FSM
 # активные игры по чатам
 basket_games = {}
 
+async def _take_second_stake(user_id: str, amount, reason: str) -> bool:
+    """ставка принявшего игру (баскет, кости); False - денег нет или его шард не ответил"""
+    stake_id = f'{reason}-{os.urandom(8).hex()}'
+    try:
+        return await take_stake_shared(user_id, amount, reason, stake_id)
+    except Exception as e:
+        # шард мог списать ставку, а ответ потеряться - отменяем её, прежде чем снова открыть игру
+        print(f"❌ Не удалось списать ставку {user_id} ({reason}): {e}")
+        refund_stake_shared(user_id, stake_id, f'{reason}_refund')
+        return False
+
 BASKET_IMAGE_PATH = 'img/basket.jpg'
 
 @dp.message(F.text.lower().contains('баскет') | F.text.lower().contains('бск'))
@@ -7833,8 +12471,8 @@ async def basket_create(message: types.Message):
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
     
-    [InlineKeyboardButton(text='✅ играть', callback_data='basket_accept')],
-        [InlineKeyboardButton(text='❌ отмена', callback_data='basket_cancel')]
+    [InlineKeyboardButton(text='✅ играть', callback_data=game_button('basket_accept', user_id_str))],
+        [InlineKeyboardButton(text='❌ отмена', callback_data=game_button('basket_cancel', user_id_str))]
     
     ])
     nick = users[user_id_str].get('nick','игрок')
@@ -7850,54 +12488,30 @@ async def basket_create(message: types.Message):
     import os
     try:
         # пытаемся отправить фото, если файл существует
-        if os.path.exists(BASKET_IMAGE_PATH):
+        basket_image = static_photo(BASKET_IMAGE_PATH)
+        if basket_image is not None:
             try:
-                msg = await bot.send_photo(chat_id, types.FSInputFile(BASKET_IMAGE_PATH), caption=caption, parse_mode='HTML', reply_markup=kb)
+                msg = await send_photo_asset(chat_id, basket_image, caption=caption, parse_mode='HTML', reply_markup=kb)
             except Exception as e:
-                # обработка flood control с единичным ретраем
-                try:
-                    from aiogram.exceptions import TelegramRetryAfter
-                except Exception:
-                    TelegramRetryAfter = None
-                if TelegramRetryAfter and isinstance(e, TelegramRetryAfter):
-                    try:
-                        await asyncio.sleep(getattr(e, 'retry_after', 3) + 1)
-                        msg = await bot.send_photo(chat_id, types.FSInputFile(BASKET_IMAGE_PATH), caption=caption, parse_mode='HTML', reply_markup=kb)
-                    except Exception as e2:
-                        print(f'не удалось отправить картинку баскета после ретрая: {e2}')
-                        msg = await message.answer(caption, parse_mode='HTML', reply_markup=kb)
-                else:
-                    print(f'не удалось отправить картинку баскета: {e}')
-                    msg = await message.answer(caption, parse_mode='HTML', reply_markup=kb)
+                # flood-ошибку уже переждал планировщик исходящих, сюда попадают остальные
+                print(f'не удалось отправить картинку баскета: {e}')
+                msg = await message.answer(caption, parse_mode='HTML', reply_markup=kb)
         else:
             msg = await message.answer(caption, parse_mode='HTML', reply_markup=kb)
     except Exception as e:
-        # обработка flood control для текстового сообщения
+        # на крайний случай — немой провал без спама
         print(f'fallback на текст и он тоже упал: {e}')
-        try:
-            from aiogram.exceptions import TelegramRetryAfter
-        except Exception:
-            TelegramRetryAfter = None
-        if TelegramRetryAfter and isinstance(e, TelegramRetryAfter):
-            try:
-                await asyncio.sleep(getattr(e, 'retry_after', 3) + 1)
-                msg = await message.answer(caption, parse_mode='HTML', reply_markup=kb)
-            except Exception as e2:
-                print(f'не удалось отправить карточку баскета после ретрая: {e2}')
-                # на крайний случай — немой провал без спама
-                msg = None
-        else:
-            # иные ошибки — не спамим повторно
-            msg = None
+        msg = None
     
     if msg is not None:
         basket_games[chat_id]['message_id'] = msg.message_id
-@dp.callback_query(lambda c: c.data == 'basket_cancel')
+@dp.callback_query(lambda c: c.data == 'basket_cancel' or c.data.startswith('basket_cancel_'))
 async def basket_cancel(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     
     game = basket_games.get(chat_id)
-    if not game:
+    owner = game_button_owner(callback.data)
+    if not game or (owner is not None and owner != game['initiator_id']):
         await callback.answer('игра не найдена', show_alert=False)
         return
     if str(callback.from_user.id) != game['initiator_id']:
@@ -7911,14 +12525,15 @@ async def basket_cancel(callback: types.CallbackQuery):
     basket_games.pop(chat_id, None)
     await callback.answer('отменено')
 
-@dp.callback_query(lambda c: c.data == 'basket_accept')
+@dp.callback_query(lambda c: c.data == 'basket_accept' or c.data.startswith('basket_accept_'))
 async def basket_accept(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     
     accepter_id = str(callback.from_user.id)
     game = basket_games.get(chat_id)
+    owner = game_button_owner(callback.data)
     
-    if not game or game.get('status') != 'pending':
+    if not game or game.get('status') != 'pending' or (owner is not None and owner != game['initiator_id']):
         await callback.answer('игра не найдена', show_alert=False)
         return
     if accepter_id == game['initiator_id']:
@@ -7942,9 +12557,15 @@ async def basket_accept(callback: types.CallbackQuery):
         await callback.answer('у тебя недостаточно денег для ставки', show_alert=True)
         return
     
-    # списываем
-    users[game['initiator_id']]['balance'] -= amount
-    users[accepter_id]['balance'] -= amount
+    # списываем: создатель - игрок этого шарда, ставку второго игрока проверяет и списывает его шард
+    game['status'] = 'accepting'
+    debit(game['initiator_id'], amount, 'basket_stake')
+    if not await _take_second_stake(accepter_id, amount, 'basket_stake'):
+        credit(game['initiator_id'], amount, 'basket_stake_refund')
+        save_users()
+        game['status'] = 'pending'
+        await callback.answer('у тебя недостаточно денег для ставки', show_alert=True)
+        return
     save_users()
     game['status'] = 'started'
     game['opponent_id'] = accepter_id
@@ -7968,14 +12589,13 @@ async def basket_accept(callback: types.CallbackQuery):
 
     await callback.message.answer(f"кидает {initiator_link}", parse_mode='HTML')
     
-    await asyncio.sleep(0.4)
     throw1 = await bot.send_dice(chat_id, emoji='🏀')
     
+    # ждём, пока докрутится анимация
     await asyncio.sleep(3)
     
     await callback.message.answer(f"кидает {opponent_link}", parse_mode='HTML')
     
-    await asyncio.sleep(0.4)
     throw2 = await bot.send_dice(chat_id, emoji='🏀')
     
     await asyncio.sleep(3)
@@ -7985,8 +12605,7 @@ async def basket_accept(callback: types.CallbackQuery):
     val2 = throw2.dice.value
     
     if val1 == val2:
-        users[game['initiator_id']]['balance'] += amount
-        users[accepter_id]['balance'] += amount
+        bulk_apply([(game['initiator_id'], amount), (accepter_id, amount)], 'basket_draw')
         save_users()
         await callback.message.answer(
             'ничья\n\n'
@@ -8007,8 +12626,7 @@ async def basket_accept(callback: types.CallbackQuery):
     
     # если оба забили идеально - ничья
     if initiator_perfect and opponent_perfect:
-        users[game['initiator_id']]['balance'] += amount
-        users[accepter_id]['balance'] += amount
+        bulk_apply([(game['initiator_id'], amount), (accepter_id, amount)], 'basket_draw')
         save_users()
         await callback.message.answer(
             'ничья - оба забили идеально!\n\n'
@@ -8022,8 +12640,7 @@ async def basket_accept(callback: types.CallbackQuery):
     
     # если оба не забили - ничья
     if not initiator_scored and not opponent_scored:
-        users[game['initiator_id']]['balance'] += amount
-        users[accepter_id]['balance'] += amount
+        bulk_apply([(game['initiator_id'], amount), (accepter_id, amount)], 'basket_draw')
         save_users()
         await callback.message.answer(
             'ничья - оба не забили\n\n'
@@ -8037,7 +12654,7 @@ async def basket_accept(callback: types.CallbackQuery):
     
     # если один забил идеально, другой обычный - приз x2 тому, кто идеально
     if initiator_perfect and opponent_scored and not opponent_perfect:
-        users[game['initiator_id']]['balance'] += amount * 2
+        credit(game['initiator_id'], amount * 2, 'basket_win')
         save_users()
         winner_link = f"<a href=\"tg://user?id={int(game['initiator_id'])}\"><b>{initiator_nick}</b></a>"
         loser_link = f"<a href=\"tg://user?id={int(accepter_id)}\"><b>{opponent_nick}</b></a>"
@@ -8053,7 +12670,7 @@ async def basket_accept(callback: types.CallbackQuery):
         return
     
     if opponent_perfect and initiator_scored and not initiator_perfect:
-        users[accepter_id]['balance'] += amount * 2
+        credit(accepter_id, amount * 2, 'basket_win')
         # первый игрок проигрывает (x0)
         save_users()
         winner_link = f"<a href=\"tg://user?id={int(accepter_id)}\"><b>{opponent_nick}</b></a>"
@@ -8073,7 +12690,7 @@ async def basket_accept(callback: types.CallbackQuery):
     print(f"DEBUG: initiator_scored={initiator_scored}, opponent_scored={opponent_scored}")
     print(f"DEBUG: val1={val1}, val2={val2}")
     if initiator_scored and not opponent_scored:
-        users[game['initiator_id']]['balance'] += amount * 2
+        credit(game['initiator_id'], amount * 2, 'basket_win')
         save_users()
         winner_link = f"<a href=\"tg://user?id={int(game['initiator_id'])}\"><b>{initiator_nick}</b></a>"
         loser_link = f"<a href=\"tg://user?id={int(accepter_id)}\"><b>{opponent_nick}</b></a>"
@@ -8090,7 +12707,7 @@ async def basket_accept(callback: types.CallbackQuery):
     
     print(f"DEBUG: opponent_scored={opponent_scored}, initiator_scored={initiator_scored}")
     if opponent_scored and not initiator_scored:
-        users[accepter_id]['balance'] += amount * 2
+        credit(accepter_id, amount * 2, 'basket_win')
         save_users()
         winner_link = f"<a href=\"tg://user?id={int(accepter_id)}\"><b>{opponent_nick}</b></a>"
         loser_link = f"<a href=\"tg://user?id={int(game['initiator_id'])}\"><b>{initiator_nick}</b></a>"
@@ -8124,7 +12741,7 @@ async def basket_accept(callback: types.CallbackQuery):
     win_amount = amount * 2
     multiplier_text = "2x"
     
-    users[winner_id]['balance'] += win_amount
+    credit(winner_id, win_amount, 'basket_win')
     save_users()
     
     winner_link = f"<a href=\"tg://user?id={int(winner_id)}\"><b>{users[winner_id].get('nick','игрок')}</b></a>"
@@ -8236,14 +12853,15 @@ async def dice_game(message: types.Message):
         'initiator_id': user_id,
         'initiator_nick': users[user_id]['nick'],
         'amount': amount,
+        'status': 'pending',
         'message_id': None
     }
     
     # создаем клавиатуру
     kb = InlineKeyboardMarkup(inline_keyboard=[
     
-    [InlineKeyboardButton(text='✅ принять', callback_data='dice_accept')],
-        [InlineKeyboardButton(text='❌ отмена', callback_data='dice_cancel')]
+    [InlineKeyboardButton(text='✅ принять', callback_data=game_button('dice_accept', user_id))],
+        [InlineKeyboardButton(text='❌ отмена', callback_data=game_button('dice_cancel', user_id))]
     
     ])
     
@@ -8261,13 +12879,14 @@ async def dice_game(message: types.Message):
     
     dice_games[chat_id]['message_id'] = msg.message_id
 
-@dp.callback_query(lambda c: c.data == 'dice_cancel')
+@dp.callback_query(lambda c: c.data == 'dice_cancel' or c.data.startswith('dice_cancel_'))
 async def dice_cancel(callback: types.CallbackQuery):
     """отмена игры в кости"""
     chat_id = str(callback.message.chat.id)
     
     game = dice_games.get(chat_id)
-    if not game:
+    owner = game_button_owner(callback.data)
+    if not game or (owner is not None and owner != game['initiator_id']):
         await callback.answer('игра не найдена', show_alert=False)
         return
     if str(callback.from_user.id) != game['initiator_id']:
@@ -8281,15 +12900,16 @@ async def dice_cancel(callback: types.CallbackQuery):
     dice_games.pop(chat_id, None)
     await callback.answer('отменено')
 
-@dp.callback_query(lambda c: c.data == 'dice_accept')
+@dp.callback_query(lambda c: c.data == 'dice_accept' or c.data.startswith('dice_accept_'))
 async def dice_accept(callback: types.CallbackQuery):
     """принятие игры в кости"""
     chat_id = str(callback.message.chat.id)
     
     accepter_id = str(callback.from_user.id)
     game = dice_games.get(chat_id)
+    owner = game_button_owner(callback.data)
     
-    if not game:
+    if not game or game.get('status') != 'pending' or (owner is not None and owner != game['initiator_id']):
         await callback.answer('игра не найдена', show_alert=True)
         return
     
@@ -8316,10 +12936,17 @@ async def dice_accept(callback: types.CallbackQuery):
         await callback.answer('игра отменена', show_alert=True)
         return
     
-    # снимаем деньги с обоих игроков
-    users[game['initiator_id']]['balance'] -= game['amount']
-    users[accepter_id]['balance'] -= game['amount']
+    # снимаем деньги с обоих игроков: создатель - игрок этого шарда, второго списывает его шард
+    game['status'] = 'accepting'
+    debit(game['initiator_id'], game['amount'], 'dice_stake')
+    if not await _take_second_stake(accepter_id, game['amount'], 'dice_stake'):
+        credit(game['initiator_id'], game['amount'], 'dice_stake_refund')
+        save_users()
+        game['status'] = 'pending'
+        await callback.answer('у тебя недостаточно денег для ставки', show_alert=True)
+        return
     save_users()
+    game['status'] = 'started'
     
     # удаляем исходное сообщение
     try:
@@ -8340,14 +12967,13 @@ async def dice_accept(callback: types.CallbackQuery):
 
     await callback.message.answer(f"кидает {opponent_link}", parse_mode='HTML')
     
-    await asyncio.sleep(0.4)
     throw1 = await bot.send_dice(chat_id, emoji='🎲')
     
+    # ждём, пока докрутится анимация
     await asyncio.sleep(3)
     
     await callback.message.answer(f"кидает {initiator_link}", parse_mode='HTML')
     
-    await asyncio.sleep(0.4)
     throw2 = await bot.send_dice(chat_id, emoji='🎲')
     
     await asyncio.sleep(3)
@@ -8357,8 +12983,7 @@ async def dice_accept(callback: types.CallbackQuery):
     val2 = throw2.dice.value
     
     if val1 == val2:
-        users[game['initiator_id']]['balance'] += game['amount']
-        users[accepter_id]['balance'] += game['amount']
+        bulk_apply([(game['initiator_id'], game['amount']), (accepter_id, game['amount'])], 'dice_draw')
         save_users()
         await callback.message.answer(
             'ничья\n\n'
@@ -8383,7 +13008,7 @@ async def dice_accept(callback: types.CallbackQuery):
     # начисляем выигрыш
     win_amount = game['amount'] * 2  # всегда x2 ставки
     
-    users[winner_id]['balance'] += win_amount
+    credit(winner_id, win_amount, 'dice_win')
     save_users()
     
     winner_link = f"<a href=\"tg://user?id={int(winner_id)}\"><b>{users[winner_id].get('nick','игрок')}</b></a>"
@@ -8403,25 +13028,18 @@ async def dice_accept(callback: types.CallbackQuery):
 # === конец мини-игры кости ===
 
 # === команда топ ===
-def get_top_players():
-    """получает топ игроков по балансу (только топ 100)"""
-    # сортируем пользователей по балансу (по убыванию)
-    sorted_users = sorted(users.items(), key=lambda x: x[1].get('balance', 0), reverse=True)
-    
+def get_top_players(limit: int = 100):
+    """получает топ игроков по балансу (по умолчанию топ 100)"""
+    # берём готовый рейтинг вместо сортировки всей базы
     # НЕ фильтруем скрытых игроков - они остаются в топе, но без ссылок
-    # visible_users = [(uid, user_data) for uid, user_data in sorted_users if not user_data.get('hide_from_top', False)]
-    
-    # возвращаем только топ 100
-    return sorted_users[:100]
+    return [(uid, users[uid]) for uid in leaderboard.top(limit)]
 
 def get_user_position(user_id: str) -> int:
-    """получает позицию пользователя в топе"""
-    sorted_users = get_top_players()
-    
-    for i, (uid, _) in enumerate(sorted_users):
-        if uid == user_id:
-            return i + 1
-    return len(sorted_users) + 1
+    """получает точную позицию пользователя среди всех игроков"""
+    position = leaderboard.rank(user_id)
+    if position is None:
+        return len(leaderboard) + 1
+    return position
 
 async def show_top_page(message: types.Message, page: int = 0):
     
@@ -8549,8 +13167,34 @@ async def top_refresh_callback(callback: types.CallbackQuery):
     await callback.answer('топ обновляется каждые 5 минут')
 # === конец команды топ ===
 # === рулетка ===
-def create_roulette_result_image(number, color, bet_type, amount, won, multiplier, win_amount):
-    """создает изображение рулетки с результатом игры
+# картинка результата зависит только от выпавшего числа, а чисел всего 37. раньше на каждый
+# спин заново открывался jpeg, искался шрифт, рисовалось число и писался временный png в img/
+# (со случайным суффиксом, который мог совпасть у двух спинов), а после отправки удалялся.
+# теперь все 37 картинок рисуются один раз при старте и хранятся в памяти готовыми байтами,
+# а отправляются через кэш file_id - спин не загружает в телеграм ничего
+ROULETTE_BASE_IMAGES = {'green': 'img/rul__zero.jpg', 'red': 'img/rul_red.jpg', 'black': 'img/rul_black.jpg'}
+ROULETTE_IMAGE_QUALITY = 90
+
+_roulette_images = {}  # число -> PhotoAsset с jpeg
+_roulette_font = None
+
+def _load_roulette_font():
+    """шрифт для числа: ищется один раз на весь процесс"""
+    global _roulette_font
+    if _roulette_font is None:
+        # Уменьшаем размер шрифта для лучшего размещения; если arial не найден - пробуем другие
+        for name, size in (("arial.ttf", 50), ("DejaVuSans-Bold.ttf", 70), ("LiberationSans-Bold.ttf", 70)):
+            try:
+                _roulette_font = ImageFont.truetype(name, size)
+                break
+            except Exception:
+                continue
+        else:
+            _roulette_font = ImageFont.load_default()
+    return _roulette_font
+
+def render_roulette_image(number: int, base_image=None) -> bytes:
+    """рисует картинку рулетки с выпавшим числом и возвращает её как jpeg
     
     Логика работы:
     - Для числа 0 (зеро): использует rul__zero.jpg (зеленая картинка, ноль уже есть)
@@ -8559,75 +13203,61 @@ def create_roulette_result_image(number, color, bet_type, amount, won, multiplie
     
     Числа пишутся белым цветом на полоске внизу изображения
     """
-    try:
-        # открываем базовое изображение рулетки в зависимости от цвета выпавшего числа
-        if number == 0:
-            # зеро - зеленая картинка (используем rul__zero.jpg)
-            base_image = Image.open('img/rul__zero.jpg')
-        elif color == 'red':
-            # красное число - красная картинка
-            base_image = Image.open('img/rul_red.jpg')
-        else:
-            # черное число - черная картинка
-            base_image = Image.open('img/rul_black.jpg')
-        
-        # создаем копию для рисования
-        img = base_image.copy()
+    # создаем копию базовой картинки для рисования
+    if base_image is None:
+        with Image.open(ROULETTE_BASE_IMAGES[get_roulette_number_color(number)]) as base_image:
+            img = base_image.convert('RGB')
+    else:
+        img = base_image.convert('RGB')
+    
+    # рисуем выпавшее число на полоске внизу (кроме зеро - оно уже есть на картинке)
+    if number != 0:
         draw = ImageDraw.Draw(img)
-        
-        # пытаемся загрузить шрифт, если не получается - используем стандартный
-        try:
-            # Уменьшаем размер шрифта для лучшего размещения
-            font = ImageFont.truetype("arial.ttf", 50)
-        except:
-            try:
-                # Пробуем другие шрифты если arial не найден
-                font = ImageFont.truetype("DejaVuSans-Bold.ttf", 70)
-            except:
-                try:
-                    font = ImageFont.truetype("LiberationSans-Bold.ttf", 70)
-                except:
-                    # Если ничего не найдено, используем стандартный
-                    font = ImageFont.load_default()
-        
-        # получаем размеры изображения
+        font = _load_roulette_font()
         width, height = img.size
-        
-        # рисуем выпавшее число на соответствующей полоске (кроме зеро)
-        if number != 0:  # не рисуем число для зеро, так как оно уже есть на картинке
-            number_text = str(number)
-            text_bbox = draw.textbbox((0, 0), number_text, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            text_height = text_bbox[3] - text_bbox[1]
-            
-            # позиция для текста - по горизонтали по центру, по вертикали на полоске внизу
-            x = (width - text_width) // 2
-            
-            if color == 'red':
-                # для красных чисел - на красной полоске внизу, чуть пониже
-                y = height - 120  # на красной полоске внизу, чуть пониже
-                text_color = (255, 255, 255)  # белый текст на красном фоне
-            else:
-                # для черных чисел - на черной полоске внизу, чуть пониже
-                y = height - 120  # на черной полоске внизу, чуть пониже
-                text_color = (255, 255, 255)  # белый текст на черном фоне
-            
-            # рисуем тень для текста (черная тень для лучшей читаемости)
-            shadow_color = (0, 0, 0)  # черная тень
-            draw.text((x+2, y+2), number_text, fill=shadow_color, font=font)
-            
-            # рисуем основной текст на полоске внизу
-            draw.text((x, y), number_text, fill=text_color, font=font)
-        
-        # сохраняем временное изображение в папку img
-        temp_path = f'img/temp_roulette_{random.randint(1000, 9999)}.png'
-        img.save(temp_path, 'PNG')
-        
-        return temp_path
-        
-    except Exception as e:
-        print(f"Ошибка создания изображения рулетки: {e}")
-        return None
+        number_text = str(number)
+        text_bbox = draw.textbbox((0, 0), number_text, font=font)
+        text_width = text_bbox[2] - text_bbox[0]
+        
+        # позиция для текста - по горизонтали по центру, по вертикали на полоске внизу, чуть пониже
+        x = (width - text_width) // 2
+        y = height - 120
+        
+        # рисуем тень для текста (черная тень для лучшей читаемости), затем белый текст
+        draw.text((x+2, y+2), number_text, fill=(0, 0, 0), font=font)
+        draw.text((x, y), number_text, fill=(255, 255, 255), font=font)
+    
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=ROULETTE_IMAGE_QUALITY)
+    return buffer.getvalue()
+
+def prerender_roulette_images() -> int:
+    """рисует картинки для всех 37 чисел (вызывается при старте в отдельном потоке)"""
+    bases = {}
+    for number in range(37):
+        if number in _roulette_images:
+            continue
+        color = get_roulette_number_color(number)
+        try:
+            if color not in bases:
+                with Image.open(ROULETTE_BASE_IMAGES[color]) as base_image:
+                    bases[color] = base_image.convert('RGB')
+            _roulette_images[number] = PhotoAsset(render_roulette_image(number, bases[color]), f'roulette_{number}.jpg')
+        except Exception as e:
+            print(f"Ошибка создания изображения рулетки для {number}: {e}")
+    return len(_roulette_images)
+
+def get_roulette_image(number: int) -> PhotoAsset | None:
+    """готовая картинка результата для send_photo_asset; None - если картинку нарисовать не удалось"""
+    asset = _roulette_images.get(number)
+    if asset is None:
+        # предварительная отрисовка не успела или не смогла - рисуем сейчас и запоминаем
+        try:
+            asset = _roulette_images[number] = PhotoAsset(render_roulette_image(number), f'roulette_{number}.jpg')
+        except Exception as e:
+            print(f"Ошибка создания изображения рулетки: {e}")
+            return None
+    return asset
 
 def get_roulette_number_color(number):
     """определяет цвет числа в рулетке"""
@@ -8671,11 +13301,10 @@ async def roulette_handler(message: types.Message):
     # если только "рул" - показываем информацию
     if len(parts) == 1:
         try:
-            # добавляем небольшую задержку для предотвращения flood control
-            await asyncio.sleep(0.5)
-            await bot.send_photo(
+            # темп отправки в чат держит планировщик исходящих
+            await send_photo_asset(
                 message.chat.id,
-                types.FSInputFile('img/rul_info.jpg'),
+                static_photo('img/rul_info.jpg'),
                 caption="🃏 <b>используй:</b>\n"
     
     "<code>рул ставка сумма</code>\n\n"
@@ -8806,7 +13435,7 @@ async def roulette_handler(message: types.Message):
             return
     
     # Списываем ставку СРАЗУ после проверки баланса
-    users[user_id]['balance'] -= amount
+    debit(user_id, amount, 'roulette_bet')
     
     # Для занижения шансов только при многократном повторе одной ставки ведём минимальный стрик
     user_streak = roulette_bet_streaks.get(user_id, {'bet_type': None, 'streak': 0})
@@ -9219,7 +13848,7 @@ async def roulette_handler(message: types.Message):
         payout_amount = amount * multiplier
         
         # Начисляем выигрыш
-        users[user_id]['balance'] += payout_amount
+        credit(user_id, payout_amount, 'roulette_win')
         
         # Проверяем, была ли это ставка "все"
         was_all_in = len(parts) >= 3 and parts[2] in ['вб', 'все', 'всё', 'алл', 'вабанк', 'вс', 'в', 'ваб', 'вабан', 'вседеньги', 'всёденьги']
@@ -9249,26 +13878,17 @@ async def roulette_handler(message: types.Message):
     
     # отправляем результат с фотографией рулетки
     try:
-        # создаем изображение с результатом
-        # Передаем в изображение сумму чистого выигрыша (или 0 при проигрыше)
-        image_path = create_roulette_result_image(number, color, bet_type, amount, won, multiplier, profit_amount if won else 0)
-        
-        if image_path and os.path.exists(image_path):
-            # добавляем небольшую задержку для предотвращения flood control
-            await asyncio.sleep(0.5)
-            # отправляем созданное изображение
-            await bot.send_photo(
+        # берём готовую картинку с выпавшим числом
+        result_image = get_roulette_image(number)
+        
+        if result_image is not None:
+            # отправляем картинку по file_id (загружается только самый первый раз)
+            await send_photo_asset(
                 message.chat.id,
-                types.FSInputFile(image_path),
+                result_image,
                 caption=result_text,
                 parse_mode='HTML'
             )
-            
-            # удаляем временный файл
-            try:
-                os.remove(image_path)
-            except:
-                pass
         else:
             # если не удалось создать изображение, отправляем только текст
             await message.answer(result_text, parse_mode='HTML')
@@ -9414,7 +14034,7 @@ async def claim_bonus_callback(callback: types.CallbackQuery):
         bonus_amount = random.randint(min_bonus, max_bonus)
         
         # выдаем бонус
-        user_data['balance'] += bonus_amount
+        credit(user_id_str, bonus_amount, 'bonus')
         user_data['last_bonus_time'] = current_time
         save_users()
         
@@ -9440,8 +14060,7 @@ async def create_human_callback(callback: types.CallbackQuery):
         await callback.answer("переходим в личку для регистрации...")
         
         # создаем ссылку на бота
-        bot_info = await bot.get_me()
-        bot_username = bot_info.username
+        bot_username = telegram_metadata.bot_username or (await telegram_metadata.get_me()).username
         
         # отправляем сообщение с ссылкой
         await callback.message.answer(
@@ -9546,7 +14165,7 @@ async def deposit_amount_callback(callback: types.CallbackQuery):
     # создаем вклад
     user_data['bank_deposit'] = deposit_amount
     user_data['bank_deposit_time'] = datetime.datetime.now().timestamp()
-    user_data['balance'] -= deposit_amount
+    debit(user_id_str, deposit_amount, 'bank_deposit')
     save_users()
     
     # обновляем баланс после списания
@@ -9608,7 +14227,7 @@ async def bank_withdraw_callback(callback: types.CallbackQuery):
         total_withdraw = deposit + total_interest
         
         # забираем деньги с процентами
-        user_data['balance'] += total_withdraw
+        credit(user_id_str, total_withdraw, 'bank_withdraw')
         user_data['bank_deposit'] = 0
         user_data['bank_deposit_time'] = 0
         save_users()
@@ -9834,7 +14453,7 @@ async def withdraw_early_confirm_callback(callback: types.CallbackQuery):
     total_withdraw = deposit - penalty
     
     # забираем деньги со штрафом
-    user_data['balance'] += total_withdraw
+    credit(user_id_str, total_withdraw, 'bank_withdraw_early')
     user_data['bank_deposit'] = 0
     user_data['bank_deposit_time'] = 0
     save_users()
@@ -9876,22 +14495,10 @@ async def bank_stats_callback(callback: types.CallbackQuery):
         await callback.answer("сначала зарегистрируйся", show_alert=True)
         return
     
-    # собираем статистику вкладов
-    total_deposits = 0
-    
-    users_with_deposits = 0
-    max_deposit = 0
-    
-    deposits_list = []
-    
-    for user_id_key, user_data in users.items():
-        deposit = user_data.get('bank_deposit', 0)
-        if deposit > 0:
-            total_deposits += deposit
-            users_with_deposits += 1
-            deposits_list.append(deposit)
-            if deposit > max_deposit:
-                max_deposit = deposit
+    # статистика вкладов берётся из индекса вкладчиков
+    total_deposits = deposit_index.total
+    users_with_deposits = len(deposit_index)
+    max_deposit = deposit_index.max_amount()
     
     total_users = len(users)
     percentage_with_deposits = (users_with_deposits / total_users * 100) if total_users > 0 else 0
@@ -9928,25 +14535,18 @@ async def bank_top_callback(callback: types.CallbackQuery):
         await callback.answer("сначала зарегистрируйся", show_alert=True)
         return
     
-    # собираем данные о вкладах
-    deposits_data = []
-    total_deposits = 0
-    users_with_deposits = 0
-    
-    for user_id_key, user_data in users.items():
-        deposit = user_data.get('bank_deposit', 0)
-        if deposit > 0:
-            deposits_data.append({
-                'user_id': user_id_key,
-                'nick': user_data.get('nick', 'игрок'),
-                'tg_username': user_data.get('tg_username', ''),
-                'deposit': deposit
-            })
-            total_deposits += deposit
-            users_with_deposits += 1
-    
-    # сортируем по размеру вклада (убывание)
-    deposits_data.sort(key=lambda x: x['deposit'], reverse=True)
+    # топ-10 вкладов уже упорядочен в индексе вкладчиков
+    deposits_data = [
+        {
+            'user_id': user_id_key,
+            'nick': users[user_id_key].get('nick', 'игрок'),
+            'tg_username': users[user_id_key].get('tg_username', ''),
+            'deposit': deposit
+        }
+        for user_id_key, deposit in deposit_index.top(10)
+    ]
+    total_deposits = deposit_index.total
+    users_with_deposits = len(deposit_index)
     
     # создаем кнопки для возврата
     markup = InlineKeyboardMarkup(inline_keyboard=[
@@ -9983,16 +14583,18 @@ async def bank_top_callback(callback: types.CallbackQuery):
 # === функции налога на богатство ===
 async def send_tax_notification(user_id: int, text: str):
     """Отправляет уведомление о налоге пользователю"""
+    if user_id in dead_recipients:
+        return
     try:
-        await bot.send_message(
-            chat_id=user_id,
-    
-    text=text,
-            parse_mode='HTML'
-    
-    )
+        with outbound_class(PRIORITY_NOTIFY):
+            await bot.send_message(
+                chat_id=user_id,
+                text=text,
+                parse_mode='HTML'
+            )
     except Exception as e:
-        print(f"❌ Ошибка отправки уведомления о налоге пользователю {user_id}: {e}")
+        if not dead_recipients.record_failure(user_id, e):
+            print(f"❌ Ошибка отправки уведомления о налоге пользователю {user_id}: {e}")
 
 async def collect_wealth_tax():
     """Списывает налог на богатство (настраиваемый процент) у топ-15 игроков каждый час"""
@@ -10000,7 +14602,7 @@ async def collect_wealth_tax():
         print("💰 Начинаем сбор налога на богатство...")
         
         # Получаем топ-15 игроков
-        top_players = get_top_players()[:15]
+        top_players = get_top_players(15)
         
         if not top_players:
             print("⚠️ Нет игроков для сбора налога")
@@ -10021,7 +14623,7 @@ async def collect_wealth_tax():
                 continue
             
             # Списываем налог
-            users[user_id]['balance'] -= tax_amount
+            debit(user_id, tax_amount, 'wealth_tax')
             total_tax_collected += tax_amount
             
             # Отправляем уведомление пользователю
@@ -10157,6 +14759,64 @@ def cleanup_temp_files():
         pass
 
 if __name__ == '__main__':
+    # python app.py migrate_sqlite - разовый перенос users_db.json в sqlite без запуска бота
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate_sqlite':
+        migrate_json_to_sqlite(force='--force' in sys.argv)
+        sys.exit(0)
+    # python app.py snapshot_to_binary / snapshot_to_json - перевод снапшота между форматами
+    if len(sys.argv) > 1 and sys.argv[1] == 'snapshot_to_binary':
+        convert_snapshot_to_binary()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'snapshot_to_json':
+        convert_snapshot_to_json()
+        sys.exit(0)
+    # python app.py restore_backup [точка] [--to файл] - собрать точку резервной копии в отдельный снапшот
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore_backup':
+        args = sys.argv[2:]
+        target = 'restored_users_db.json'
+        if '--to' in args:
+            index = args.index('--to')
+            target = args[index + 1]
+            del args[index:index + 2]
+        restore_backup(args[0] if args else None, target)
+        sys.exit(0)
+    # python app.py restore_at "ГГГГ-ММ-ДД ЧЧ:ММ[:СС]" [--user ID] [--dry-run] [--to файл] -
+    # восстановление на момент времени: копия + журнал; --dry-run только печатает разницу
+    if len(sys.argv) > 2 and sys.argv[1] == 'restore_at':
+        args = sys.argv[3:]
+        open_users()
+        target_user = args[args.index('--user') + 1] if '--user' in args else None
+        target = args[args.index('--to') + 1] if '--to' in args else 'restored_users_db.json'
+        restored, info = restore_point_in_time(parse_restore_time(sys.argv[2]), target_user)
+        diff = diff_users(users, restored, target_user)
+        print(f"💾 копия {info['point']}, из журнала {info['replayed']} изменений "
+              f"({info['segments']} файлов), собрано за {info['seconds']:.2f} с")
+        if '--dry-run' in args:
+            print('\n'.join(diff) if diff else 'отличий от текущей базы нет')
+            print(f"🔀 отличий: {len(diff)}")
+        else:
+            # для одного пользователя остальная база остаётся как сейчас
+            result = {uid: dict(user_data) for uid, user_data in users.items()} if target_user else {}
+            if target_user:
+                result.pop(target_user, None)
+            result.update(restored)
+            _write_json_atomic(target, result)
+            print(f"✅ Записано в {target}: {len(result)} пользователей, отличий от текущей базы: {len(diff)}")
+        sys.exit(0)
+    # python app.py replay_updates updates.jsonl [адрес] - прогнать записанные обновления через локальный вебхук
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay_updates':
+        url = sys.argv[3] if len(sys.argv) > 3 else f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+        asyncio.run(replay_updates(sys.argv[2], url))
+        sys.exit(0)
+    # вебхук без секрета не запускаем вовсе - ни бота, ни фронта с воркерами
+    if BOT_MODE == 'webhook' and webhook_config_error():
+        print(f"❌ ОШИБКА: {webhook_config_error()}")
+        print("🔐 Задайте WEBHOOK_SECRET (любая строка из A-Z, a-z, 0-9, _ и -)")
+        sys.exit(1)
+    # SHARD_WORKERS=N - фронт с N воркерами; воркеров фронт запускает как python app.py shard_worker
+    if SHARD_WORKERS and not SHARD_COUNT:
+        asyncio.run(run_shard_front())
+        sys.exit(0)
     try:
         # очищаем временные файлы при запуске
         cleanup_temp_files()
@@ -0,0 +1,52 @@
+"""замер к user-005: холодный старт с json-снапшота против бинарного.
+
+    python bench/bench_cold_start.py [пользователей=100000]
+
+одна и та же база пишется в users_db.json и переводится в users_db.bin, затем каждая
+читается через JsonUserStorage так же, как это делает load_users при старте, и обе
+сверяются между собой. в коммите было: 100k - json 1.32 с / 95 МБ против
+binary 0.66 с / 2.5 МБ; 1M - 12.4 с против 5.65 с
+"""
+import gc
+import os
+import time
+
+from common import arg, enter_workdir, import_app, write_users_json
+
+
+def load(app, storage_format: str, path: str) -> tuple[dict, float]:
+    storage = app.JsonUserStorage(snapshot_path=path, journal_path=f'{path}.journal',
+                                  snapshot_format=storage_format)
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        data = storage.load_all()
+        return data, time.perf_counter() - started
+    finally:
+        gc.enable()
+
+
+def main():
+    n = arg(1, 100_000)
+    enter_workdir()
+    app = import_app(USERS_STORAGE='json', USERS_SNAPSHOT_FORMAT='json')
+    write_users_json(n, 'bench_users.json')
+    started = time.perf_counter()
+    app.convert_snapshot_to_binary('bench_users.json', 'bench_users.bin')
+    encode = time.perf_counter() - started
+
+    from_json, json_time = load(app, 'json', 'bench_users.json')
+    from_binary, binary_time = load(app, 'binary', 'bench_users.bin')
+    same = len(from_json) == len(from_binary) and all(
+        dict(from_binary[user_id]) == user_data for user_id, user_data in from_json.items())
+    json_size = os.path.getsize('bench_users.json') / 1e6
+    binary_size = os.path.getsize('bench_users.bin') / 1e6
+    print(f"пользователей {n}: json {json_time:.2f} с / {json_size:.0f} МБ, "
+          f"binary {binary_time:.2f} с / {binary_size:.1f} МБ ({json_time / binary_time:.1f}x), "
+          f"перевод в binary {encode:.1f} с")
+    print('данные совпали:', same)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""замер к user-020: сколько рассылка экономит на недоступных получателях и сколько стоит фильтр.
+
+    python bench/bench_dead_recipients.py [получателей рассылки=600] [размер фильтра=1000000]
+
+1) две рассылки подряд через BroadcastEngine на фейковом api (задержка 80 мс, 30% получателей
+   заблокировали бота): первая узнаёт недоступных, вторая их уже не трогает.
+2) dead_recipients.reachable/by_reason над большим списком (30% недоступны) и classify_send_error
+   на одну ошибку - это то, что добавляется к подтверждению рассылки и к каждой неудачной отправке.
+прогон на одном ядре: первая рассылка 600 - 600 запросов за 6.3 с, вторая - 420 запросов за 4.4 с
+(-30%, ровно доля недоступных); фильтр 1M - reachable 0.43 с, by_reason 0.66 с; classify 1.2-1.6 мкс
+"""
+import asyncio
+import random
+import time
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from common import arg, enter_workdir, import_app, per_call
+
+LATENCY = 0.08
+DEAD_SHARE = 0.3
+REPORT_CHAT = 1
+
+
+class FakeApi:
+    def __init__(self, blocked: set):
+        self.blocked = blocked
+        self.calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(LATENCY)
+        if chat_id == REPORT_CHAT:
+            return True
+        self.calls += 1
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(SendMessage(chat_id=chat_id, text=text), 'Forbidden: bot was blocked by the user')
+        return True
+
+
+async def broadcast(app, recipients: list[int]) -> float:
+    engine = app.BroadcastEngine()
+    started = time.perf_counter()
+    engine.start(app.dead_recipients.reachable(recipients), 'привет', None, None, REPORT_CHAT, None)
+    await engine.task
+    return time.perf_counter() - started
+
+
+def main():
+    n, filter_size = arg(1, 600), arg(2, 1_000_000)
+    enter_workdir()
+    app = import_app()
+    rng = random.Random(20)
+
+    recipients = [10**9 + i for i in range(n)]
+    api = FakeApi(set(rng.sample(recipients, int(n * DEAD_SHARE))))
+    app.bot.send_message = api.send_message
+    for run in ('первая', 'вторая'):
+        api.calls = 0
+        elapsed = asyncio.run(broadcast(app, recipients))
+        print(f"{run} рассылка {n}: запросов к api {api.calls}, {elapsed:.1f} с, недоступных {len(app.dead_recipients)}")
+
+    ids = [10**9 + i for i in range(filter_size)]
+    now = time.time()
+    dead = app.DeadRecipients({chat_id: {'reason': 'blocked', 'since': now, 'checked': now}
+                               for chat_id in rng.sample(ids, int(filter_size * DEAD_SHARE))})
+    as_text = [str(chat_id) for chat_id in ids]  # получатели из базы приходят строками
+    reachable = per_call(lambda: dead.reachable(as_text), 3)
+    by_reason = per_call(lambda: dead.by_reason(as_text), 3)
+    print(f"фильтр {filter_size}: reachable {reachable:.2f} с, by_reason {by_reason:.2f} с")
+
+    method = SendMessage(chat_id=1, text='x')
+    blocked = TelegramForbiddenError(method, 'Forbidden: bot was blocked by the user')
+    retry = TelegramRetryAfter(method, 'Too Many Requests', 5)
+    print(f"classify_send_error: блокировка {per_call(lambda: app.classify_send_error(blocked), 100_000) * 1e6:.2f} мкс, "
+          f"временная {per_call(lambda: app.classify_send_error(retry), 100_000) * 1e6:.2f} мкс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""замер к user-016: очередь сроков вкладов на большой базе.
+
+    python bench/bench_deposit_scheduler.py [вкладов=300000]
+
+schedule/cancel - на заполненной очереди; rebuild - пересборка индекса вкладов и очереди по таблице,
+как на старте бота; pop_due - выдача созревших вкладов, когда срок наступил у всех сразу.
+для сравнения - то, как искали созревшие вклады без очереди: перебор всей таблицы.
+прогон на одном ядре (300k): rebuild 1.6 с, schedule 3.2 мкс, cancel 1.4 мкс, pop_due 6.6 мкс на
+вклад (вместе с вычищением 50k отменённых записей), перебор таблицы 0.17 с на каждую проверку
+"""
+import random
+import time
+
+from common import arg, enter_workdir, import_app, make_user, per_call
+
+
+def main():
+    n = arg(1, 300_000)
+    enter_workdir()
+    app = import_app()
+    rng = random.Random(16)
+    now = time.time()
+    table = app.UsersTable()
+    for i in range(n):
+        user_data = make_user(i, rng)
+        user_data['bank_deposit'] = rng.randint(1, 10**9)
+        user_data['bank_deposit_time'] = now - rng.uniform(0, 2 * app.BANK_DEPOSIT_TERM)
+        user_id = str(10**9 + i)
+        dict.__setitem__(table, user_id, app.UserRecord(user_id, user_data))
+    app.users = table
+
+    started = time.perf_counter()
+    app.deposit_index.rebuild(table)
+    rebuild = time.perf_counter() - started
+    scheduler = app.deposit_scheduler
+    print(f"вкладов {n}: rebuild {rebuild:.2f} с, в очереди {len(scheduler.pending)}")
+
+    ids = list(scheduler.pending)
+    rng.shuffle(ids)
+    sample = ids[:50_000]
+    started = time.perf_counter()
+    for user_id in sample:
+        scheduler.cancel(user_id)
+    cancel = (time.perf_counter() - started) / len(sample)
+    started = time.perf_counter()
+    for user_id in sample:
+        scheduler.schedule(user_id, now)
+    schedule = (time.perf_counter() - started) / len(sample)
+    print(f"schedule {schedule * 1e6:.2f} мкс, cancel {cancel * 1e6:.2f} мкс")
+
+    def scan():
+        return [user_id for user_id, user_data in table.items()
+                if user_data.get('bank_deposit', 0) > 0
+                and now - user_data.get('bank_deposit_time', 0) >= app.BANK_DEPOSIT_TERM]
+
+    matured = len(scan())
+    scan_time = per_call(scan, 3)
+    started = time.perf_counter()
+    due = scheduler.pop_due(now + app.BANK_DEPOSIT_TERM)
+    pop = time.perf_counter() - started
+    print(f"pop_due: {len(due)} вкладов за {pop:.2f} с ({pop / max(len(due), 1) * 1e6:.2f} мкс на вклад); "
+          f"перебор таблицы {scan_time:.2f} с на проверку, созревших сейчас {matured}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""замер к user-001: цена одного спина при журнале против полной перезаписи users_db.json.
+
+    python bench/bench_journal.py [пользователей=100000] [спинов=200]
+
+старый save_users после каждого спина делал json.dump всей базы; теперь спин дописывает
+в users_journal.jsonl пару строк. после замера база перечитывается из снапшота и журнала
+и сверяется с памятью. в коммите было: ~25 мкс на спин против 387 мс (10k),
+4.9 с (100k) и 33.4 с (1M) на полную перезапись
+"""
+import json
+import os
+import time
+
+from common import arg, enter_workdir, import_app, per_call, write_users_json
+
+
+def main():
+    n = arg(1, 100_000)
+    spins = arg(2, 200)
+    enter_workdir()
+    write_users_json(n)
+    app = import_app(USERS_STORAGE='json', USERS_SNAPSHOT_FORMAT='json')
+    user_id = str(10**9 + 5)
+
+    def spin():
+        # ставка списывается, выигрыш начисляется, изменения сразу уходят в журнал
+        app.debit(user_id, 10, 'roulette')
+        app.credit(user_id, 20, 'roulette')
+        app.flush_user_changes('roulette')
+
+    journal = per_call(spin, spins)
+
+    # раньше база в памяти была обычным словарём словарей - его и пишем
+    plain = {uid: dict(user_data) for uid, user_data in app.users.items()}
+
+    def full_dump():
+        with open('old_users_db.json', 'w', encoding='utf-8') as f:
+            json.dump(plain, f, ensure_ascii=False, indent=2)
+
+    dumps = 3 if n <= 100_000 else 1
+    full = per_call(full_dump, dumps)
+    os.remove('old_users_db.json')
+
+    started = time.perf_counter()
+    reloaded = app.user_storage.load_all()
+    replay = time.perf_counter() - started
+    same = reloaded[user_id]['balance'] == app.users[user_id]['balance']
+    print(f"пользователей {n}: журнал {journal * 1e6:.0f} мкс/спин, "
+          f"полная перезапись {full * 1000:.0f} мс/спин ({full / journal:.0f}x)")
+    print(f"загрузка снапшота + {spins * 2} строк журнала: {replay:.2f} с, баланс совпал: {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""замер к user-014: проверка лимита "к" через рейтинг против прохода по всей базе.
+
+    python bench/bench_k_limit.py [пользователей=10000,100000,1000000]
+
+раньше auto_extend_k_limit на каждый разбор суммы искал максимальный баланс проходом
+по всем пользователям, теперь берёт первый ключ рейтинга. в конце проверяется, что лимит
+вырастает до 20 после выигрыша больше 10^15 и возвращается к 15 после проигрыша.
+в коммите было: ~0.5 мкс против 2-113 мс, максимум совпал с полным проходом
+"""
+import random
+import sys
+
+from common import enter_workdir, import_app, make_user, per_call
+
+
+def old_auto_extend(table) -> bool:
+    max_balance = 0
+    for user_data in table.values():
+        balance = user_data.get('balance', 0)
+        if balance > max_balance:
+            max_balance = balance
+    return max_balance > 10**15
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(',')] if len(sys.argv) > 1 else [10_000, 100_000, 1_000_000]
+    enter_workdir()
+    app = import_app()
+    rng = random.Random(14)
+    for n in sizes:
+        table = app.UsersTable()
+        for i in range(n):
+            user_id = str(10**9 + i)
+            dict.__setitem__(table, user_id, app.UserRecord(user_id, make_user(i, rng)))
+        app.users = table
+        app.leaderboard.rebuild(table)
+        old = per_call(lambda: old_auto_extend(table), 5)
+        new = per_call(app.get_max_k_count, 10_000)
+        same = app.leaderboard.max_balance() == max(user_data['balance'] for user_data in table.values())
+        print(f"пользователей {n:>9}: проход {old * 1000:7.1f} мс | рейтинг {new * 1e6:.2f} мкс | максимум совпал: {same}")
+
+    top = app.leaderboard.top(1)[0]
+    app.credit(top, 10**16, 'bench')
+    print('лимит после выигрыша 10^16:', app.get_max_k_count())
+    app.debit(top, app.users[top]['balance'], 'bench')
+    print('лимит после проигрыша:', app.get_max_k_count(),
+          '| максимум совпал:', app.leaderboard.max_balance() == max(u['balance'] for u in app.users.values()))
+    app._pending_mutations.clear()
+
+
+if __name__ == '__main__':
+    main()
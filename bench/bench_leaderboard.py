@@ -0,0 +1,80 @@
+"""замер к user-012: цена спина с рейтингом против сортировки всей базы.
+
+    python bench/bench_leaderboard.py [пользователей=100000]
+
+спин проверяет топ-20 (комиссия), ищет место игрока и меняет баланс. раньше первые два
+шага сортировали всю базу, теперь отвечает leaderboard. после случайных изменений,
+удалений и регистраций топ-100 и места всех игроков сверяются с полной устойчивой
+сортировкой. в коммите было (100k): 237.8 мс на спин против 18.4 мкс, топ и места совпали
+"""
+import random
+import time
+
+from common import arg, enter_workdir, import_app, make_user, per_call
+
+
+def full_sort(table) -> list:
+    return sorted(table.items(), key=lambda item: item[1].get('balance', 0), reverse=True)
+
+
+def main():
+    n = arg(1, 100_000)
+    enter_workdir()
+    app = import_app()
+    rng = random.Random(3)
+    table = app.UsersTable()
+    for i in range(n):
+        user_id = str(10**9 + i)
+        user_data = make_user(i, rng)
+        user_data['balance'] = rng.choice([0, 0, 1000, rng.randint(0, 10**9)])  # много равных балансов
+        dict.__setitem__(table, user_id, app.UserRecord(user_id, user_data))
+    started = time.perf_counter()
+    app.leaderboard.rebuild(table)
+    print(f"построение рейтинга на {n}: {(time.perf_counter() - started) * 1000:.0f} мс")
+    app.users = table
+    user_ids = list(table)
+
+    def old_is_top20(user_id: str) -> bool:
+        return user_id in [uid for uid, _ in full_sort(table)[:20]]
+
+    def old_position(user_id: str) -> int:
+        for place, (uid, _) in enumerate(full_sort(table)[:100], 1):
+            if uid == user_id:
+                return place
+        return 101
+
+    def spin_sort():
+        user_id = rng.choice(user_ids)
+        old_is_top20(user_id)
+        old_position(user_id)
+        table[user_id]['balance'] += rng.randint(-500, 500)
+
+    def spin_leaderboard():
+        user_id = rng.choice(user_ids)
+        app.is_top20_player(user_id)
+        app.get_user_position(user_id)
+        table[user_id]['balance'] += rng.randint(-500, 500)
+
+    old = per_call(spin_sort, 20)
+    new = per_call(spin_leaderboard, 20_000)
+    print(f"на спин: сортировка {old * 1000:.1f} мс, рейтинг {new * 1e6:.1f} мкс")
+    for rate in (20, 100):
+        print(f"{rate} спинов/с: сортировка {old * rate * 100:.0f}% цикла, рейтинг {new * rate * 100:.3f}%")
+
+    for _ in range(5000):
+        table[rng.choice(user_ids)]['balance'] = rng.choice([0, 1000, rng.randint(0, 10**9)])
+    for _ in range(300):
+        user_id = user_ids.pop(rng.randrange(len(user_ids)))
+        del table[user_id]
+    for i in range(300):
+        table[f'new{i}'] = {'nick': f'new{i}', 'balance': rng.choice([0, 1000])}
+    app._pending_mutations.clear()
+    ordered = full_sort(table)
+    print('топ-100 совпал:', [uid for uid, _ in ordered[:100]] == [uid for uid, _ in app.get_top_players()])
+    print('все места совпали:', all(app.get_user_position(uid) == place
+                                    for place, (uid, _) in enumerate(ordered, 1)))
+    print('проверка рейтинга:', app.leaderboard.check() or 'ок')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""замер к user-013: операций в секунду у леджера балансов.
+
+    python bench/bench_ledger.py [пользователей=100000] [операций=200000]
+
+direct += - старая прямая запись в запись пользователя (тоже идёт в журнал и к слушателям через
+UserRecord.__setitem__); credit/debit/transfer/bulk_apply - леджер. каждая строка считается с
+рейтингом (как в боте) и без слушателей, чтобы было видно цену самого леджера.
+между прогонами накопленные изменения сбрасываются, запись на диск в замер не входит.
+прогон на одном ядре (100k, 200k операций), с рейтингом / без слушателей:
+    direct += 79k / 440k оп/s, credit 63k / 384k, debit 63k / 338k,
+    transfer 31k / 230k переводов/s (две записи баланса на перевод), bulk_apply(100) 94k / 348k записей/s
+в коммите было (разовый замер другим скриптом): direct += 83k, credit 75k, debit 87k, transfer 41k/s.
+credit на 10-20% дороже прямой записи; почти всё время в обоих случаях уходит на порядок рейтинга
+"""
+import random
+import time
+
+from common import arg, enter_workdir, import_app, make_user
+
+BULK = 100
+
+
+def main():
+    n, ops = arg(1, 100_000), arg(2, 200_000)
+    enter_workdir()
+    app = import_app()
+    rng = random.Random(13)
+    table = app.UsersTable()
+    for i in range(n):
+        user_id = str(10**9 + i)
+        user_data = make_user(i, rng)
+        user_data['balance'] = rng.randint(10**9, 10**12)  # хватит на все списания прогона
+        dict.__setitem__(table, user_id, app.UserRecord(user_id, user_data))
+    app.users = table
+    app.leaderboard.rebuild(table)
+    ids = list(table)
+    picks = [rng.choice(ids) for _ in range(ops)]
+    amounts = [rng.randint(1, 1000) for _ in range(ops)]
+
+    def direct():
+        for user_id, amount in zip(picks, amounts):
+            table[user_id]['balance'] += amount
+
+    def credit():
+        for user_id, amount in zip(picks, amounts):
+            app.credit(user_id, amount, 'bench')
+
+    def debit():
+        for user_id, amount in zip(picks, amounts):
+            app.debit(user_id, amount, 'bench')
+
+    def transfer():
+        for i in range(0, ops - 1, 2):
+            app.transfer(picks[i], picks[i + 1], amounts[i], reason='bench')
+
+    def bulk():
+        for i in range(0, ops, BULK):
+            app.bulk_apply([(user_id, amount) for user_id, amount in zip(picks[i:i + BULK], amounts[i:i + BULK])], 'bench')
+
+    # (название, функция, записей баланса за прогон, что считаем)
+    runs = [('direct +=', direct, ops, 'оп'), ('credit', credit, ops, 'оп'), ('debit', debit, ops, 'оп'),
+            ('transfer', transfer, ops // 2 * 2, 'записей'), (f'bulk_apply({BULK})', bulk, ops, 'записей')]
+    listeners = list(app.BALANCE_LISTENERS)
+    for title, with_listeners in (('с рейтингом', True), ('без слушателей', False)):
+        app.BALANCE_LISTENERS[:] = listeners if with_listeners else []
+        print(f"{title} ({n} пользователей, {ops} операций):")
+        for name, run, writes, unit in runs:
+            app.flush_user_changes('bench')
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            extra = f" ({writes // 2 / elapsed / 1000:.0f}k переводов/s)" if run is transfer else ''
+            print(f"    {name:<16} {writes / elapsed / 1000:6.0f}k {unit}/s{extra}")
+        app.flush_user_changes('bench')
+        if with_listeners:
+            print(f"    расхождений рейтинга с базой: {len(app.leaderboard.check())}")
+    app.BALANCE_LISTENERS[:] = listeners
+
+
+if __name__ == '__main__':
+    main()
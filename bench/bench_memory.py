@@ -0,0 +1,43 @@
+"""замер к user-006: память на пользователя - словарь из json против UserRecord.
+
+    python bench/bench_memory.py [пользователей=50000]
+
+база в старом формате (все поля регистрации и миграций) разбирается json.load, tracemalloc
+считает, сколько занимают словари. потом из тех же данных строятся UserRecord, словари
+освобождаются, и снова считается память. строки-значения в обоих случаях одни и те же объекты.
+прогон на одном ядре (50k): словарь 1763 Б на пользователя, UserRecord 699 Б (в 2.5 раза меньше)
+"""
+import gc
+import json
+import tracemalloc
+
+from common import arg, enter_workdir, import_app, make_users
+
+
+def traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def main():
+    n = arg(1, 50_000)
+    enter_workdir()
+    app = import_app()
+    source = json.dumps({user_id: app.new_user_record(user_data) for user_id, user_data in make_users(n).items()})
+
+    tracemalloc.start()
+    base = traced()
+    plain = json.loads(source)
+    as_dicts = traced() - base
+    records = {user_id: app.UserRecord(user_id, user_data) for user_id, user_data in plain.items()}
+    del plain
+    as_records = traced() - base
+    tracemalloc.stop()
+
+    print(f"пользователей {n}: полей в записи {len(next(iter(records.values())))}")
+    print(f"    словарь   {as_dicts / n:7.0f} Б на пользователя")
+    print(f"    UserRecord {as_records / n:6.0f} Б на пользователя (в {as_dicts / as_records:.1f} раза меньше)")
+
+
+if __name__ == '__main__':
+    main()
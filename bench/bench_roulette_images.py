@@ -0,0 +1,105 @@
+"""замер к user-017: задержка картинки результата на один спин рулетки - раньше и сейчас.
+
+    python bench/bench_roulette_images.py [спинов=200]
+
+базовые картинки (1280x720, шум поверх заливки - похоже на фото по весу) создаются во временной
+папке img/. раньше - копия старой create_roulette_result_image: открыть jpeg, поискать шрифт,
+нарисовать число, записать temp png, затем прочитать его как тело загрузки и удалить.
+сейчас - get_roulette_image после prerender_roulette_images, тело загрузки - asset.data.
+сеть в замер не входит.
+прогон на одном ядре: раньше p50 472 мс, p95 522 мс, 1.4 МиБ на загрузку; сейчас - поиск готовой
+картинки, p50 ~1 мкс, 0.44 МиБ (а с кэшем file_id после первой отправки не загружается ничего);
+предварительная отрисовка всех 37 - 0.35 с.
+в коммите было (другие базовые картинки): раньше p50 387 мс, сейчас 0.23 мс вместе с BufferedInputFile
+"""
+import os
+import random
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from common import arg, enter_workdir, import_app, percentile
+
+SIZE = (1280, 720)
+COLORS = {'green': (20, 120, 40), 'red': (170, 20, 30), 'black': (25, 25, 25)}
+
+
+def make_base_images(app):
+    os.makedirs('img', exist_ok=True)
+    for color, path in app.ROULETTE_BASE_IMAGES.items():
+        noise = Image.effect_noise(SIZE, 60).convert('RGB')
+        Image.blend(Image.new('RGB', SIZE, COLORS[color]), noise, 0.35).save(path, 'JPEG', quality=92)
+
+
+def old_result_image(number: int, color: str) -> str:
+    """старая отрисовка, как была до user-017"""
+    base_image = Image.open({'green': 'img/rul__zero.jpg', 'red': 'img/rul_red.jpg'}.get(color, 'img/rul_black.jpg'))
+    img = base_image.copy()
+    draw = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.truetype("arial.ttf", 50)
+    except Exception:
+        try:
+            font = ImageFont.truetype("DejaVuSans-Bold.ttf", 70)
+        except Exception:
+            try:
+                font = ImageFont.truetype("LiberationSans-Bold.ttf", 70)
+            except Exception:
+                font = ImageFont.load_default()
+    width, height = img.size
+    if number != 0:
+        number_text = str(number)
+        text_bbox = draw.textbbox((0, 0), number_text, font=font)
+        x = (width - (text_bbox[2] - text_bbox[0])) // 2
+        y = height - 120
+        draw.text((x + 2, y + 2), number_text, fill=(0, 0, 0), font=font)
+        draw.text((x, y), number_text, fill=(255, 255, 255), font=font)
+    temp_path = f'img/temp_roulette_{random.randint(1000, 9999)}.png'
+    img.save(temp_path, 'PNG')
+    return temp_path
+
+
+def old_spin(app, number: int) -> int:
+    path = old_result_image(number, app.get_roulette_number_color(number))
+    with open(path, 'rb') as f:  # FSInputFile читает файл при загрузке
+        size = len(f.read())
+    os.remove(path)
+    return size
+
+
+def new_spin(app, number: int) -> int:
+    return len(app.get_roulette_image(number).data)
+
+
+def duration(seconds: float) -> str:
+    return f"{seconds * 1000:.0f} мс" if seconds >= 0.001 else f"{seconds * 1e6:.1f} мкс"
+
+
+def report(name: str, times: list, sizes: list):
+    print(f"{name}: p50 {duration(percentile(times, 0.5))}, p95 {duration(percentile(times, 0.95))}, "
+          f"загрузка в среднем {sum(sizes) / len(sizes) / 2**20:.2f} МиБ")
+
+
+def main():
+    spins = arg(1, 200)
+    enter_workdir()
+    app = import_app()
+    make_base_images(app)
+    rng = random.Random(17)
+    numbers = [rng.randrange(37) for _ in range(spins)]
+
+    started = time.perf_counter()
+    app.prerender_roulette_images()
+    print(f"предварительная отрисовка 37 картинок: {time.perf_counter() - started:.2f} с")
+    for name, spin in (('раньше', old_spin), ('сейчас', new_spin)):
+        times, sizes = [], []
+        for number in numbers:
+            started = time.perf_counter()
+            sizes.append(spin(app, number))
+            times.append(time.perf_counter() - started)
+        report(name, times, sizes)
+    print(f"временных файлов осталось: {len([name for name in os.listdir('img') if name.startswith('temp_')])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""замер к user-025: бот с SHARD_WORKERS воркерами против одного процесса на фейковом Bot API.
+
+    python bench/bench_shards.py [режим=spin] [воркеров=0,1,2,4,8]
+
+режимы:
+    spin     - каждый игрок крутит рулетку ("рул красное 100")
+    transfer - игроки по кругу переводят друг другу по 1000 (кольцо: сумма и каждый баланс
+               в конце должны остаться прежними)
+    dice     - создатель игры в кости и принявший её живут на разных шардах; все игры
+               должны начаться, сумма балансов не меняется, отрицательных балансов нет
+
+0 воркеров - обычный polling одним процессом. фейковый API (этот же файл с аргументом api)
+отдаёт обновления через getUpdates и считает ответы; база - общий sqlite.
+
+ВАЖНО: рост пропускной способности с числом воркеров этим замером НЕ подтверждён. он
+писался в песочнице с одним ядром, где воркеры делят одно ядро, и там пропускная
+способность с ростом числа воркеров падала (spin: 156 обн/с при 1 воркере, 118 при 2,
+108 при 4, 75 при 8; один процесс без фронта - 79). выигрыш от шардирования возможен
+только на машине с несколькими ядрами - прогоните замер там, прежде чем на него опираться.
+на одном ядре замер проверяет только корректность: балансы и доставку ответов
+"""
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from common import ROOT
+
+UPDATES = int(os.getenv('BENCH_UPDATES', '4000'))
+PLAYERS = int(os.getenv('BENCH_PLAYERS', '2000'))
+API_RTT = float(os.getenv('BENCH_API_RTT', '0.005'))  # задержка фейкового API на запрос
+QUIET = 20  # столько секунд без новых ответов - значит, бот всё обработал
+START_BALANCE = 10**12
+TOP_PLAYERS = 20  # богачи занимают топ-20, чтобы игроки замера не платили комиссию топа за переводы
+TOP_BALANCE = 10**15
+
+
+def player(i: int) -> int:
+    return 10_000 + i
+
+
+# --- фейковый Bot API ---
+def make_updates(mode: str) -> tuple[list, list]:
+    """(обновления сразу, обновления после того, как бот разослал все карточки игр)"""
+    if mode == 'dice':
+        pairs = PLAYERS // 2
+        created, accepted = [], []
+        for k in range(pairs):
+            creator, accepter, chat = player(2 * k), player(2 * k + 1), {'id': -(1000 + k), 'type': 'supergroup', 'title': 'g'}
+            created.append({'message': {'message_id': k + 1, 'date': 0, 'text': 'кости 1000', 'chat': chat,
+                                        'from': {'id': creator, 'is_bot': False, 'first_name': 'x'}}})
+            # data подставит фейковый API - из кнопки "принять", которую бот прислал в этот чат
+            accepted.append({'callback_query': {
+                'id': str(k), 'chat_instance': 'x', 'data': None,
+                'from': {'id': accepter, 'is_bot': False, 'first_name': 'x'},
+                'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': 'x'}}})
+        return created, accepted
+    updates = []
+    for i in range(UPDATES):
+        user_id = player(i % PLAYERS)
+        text = f'кинуть @u{(i + 1) % PLAYERS} 1000' if mode == 'transfer' else 'рул красное 100'
+        updates.append({'message': {'message_id': i + 1, 'date': 0, 'text': text,
+                                    'chat': {'id': user_id, 'type': 'private'},
+                                    'from': {'id': user_id, 'is_bot': False, 'first_name': 'x', 'username': f'u{i % PLAYERS}'}}})
+    return updates, []
+
+
+def run_api(mode: str, port: int):
+    from aiohttp import web
+
+    first, later = make_updates(mode)
+    updates = first
+    state = {'first': None, 'last': None, 'replies': 0, 'served': 0, 'cards': 0, 'texts': {}}
+    buttons = {}  # чат -> callback_data кнопки "принять" из карточки игры
+    chat_info = {'id': -1, 'type': 'supergroup', 'accent_color_id': 0, 'max_reaction_count': 0,
+                 'accepted_gift_types': {'unlimited_gifts': False, 'limited_gifts': False, 'unique_gifts': False,
+                                         'premium_subscription': False, 'gifts_from_channels': False}}
+
+    async def handler(request):
+        nonlocal updates
+        method = request.match_info['method']
+        data = await request.json() if request.content_type == 'application/json' else dict(await request.post())
+        await asyncio.sleep(API_RTT)
+        if method == 'getUpdates':
+            if later and state['cards'] >= len(first) and len(updates) == len(first):
+                # все игры созданы - игроки жмут "принять"
+                for update in later:
+                    press = update['callback_query']
+                    press['data'] = buttons.get(press['message']['chat']['id'])
+                updates = first + later
+            # update_id = номер обновления с единицы, offset - следующий нужный update_id
+            start = max(int(data.get('offset') or 1) - 1, 0)
+            batch = [dict(update, update_id=i + 1) for i, update in enumerate(updates[start:start + 100], start)]
+            if batch:
+                state['first'] = state['first'] or time.monotonic()
+                state['served'] = start + len(batch)
+            else:
+                await asyncio.sleep(0.5)
+            return web.json_response({'ok': True, 'result': batch})
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'b', 'username': 'b'}})
+        if method == 'getChat':
+            return web.json_response({'ok': True, 'result': chat_info})
+        if method == 'getChatMember':
+            return web.json_response({'ok': True, 'result': {'status': 'member', 'user': {'id': 1, 'is_bot': False, 'first_name': 'x'}}})
+        if method.startswith(('delete', 'answer', 'sendChatAction')):
+            text = data.get('text')
+            if text:
+                state['texts'][text] = state['texts'].get(text, 0) + 1
+            return web.json_response({'ok': True, 'result': True})
+        state['replies'] += 1
+        state['last'] = time.monotonic()
+        markup = data.get('reply_markup')
+        if markup and 'dice_accept' in str(markup):
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            buttons[int(data['chat_id'])] = markup['inline_keyboard'][0][0]['callback_data']
+            state['cards'] += 1
+        text = str(data.get('text') or data.get('caption') or '')[:40]
+        state['texts'][text] = state['texts'].get(text, 0) + 1
+        chat_id = int(data.get('chat_id', 1))
+        result = {'message_id': state['replies'], 'date': 0, 'text': 'ok',
+                  'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+                  'photo': [{'file_id': 'f', 'file_unique_id': 'u', 'width': 1, 'height': 1}]}
+        if method == 'sendDice':
+            result['dice'] = {'emoji': data.get('emoji', '🎲'), 'value': random.randint(1, 6)}
+        return web.json_response({'ok': True, 'result': result})
+
+    async def stats(request):
+        return web.json_response({key: value for key, value in state.items()} | {'total': len(first) + len(later)})
+
+    async def main():
+        application = web.Application()
+        application.router.add_post('/bot{token}/{method}', handler)
+        application.router.add_get('/stats', stats)
+        runner = web.AppRunner(application, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+# --- прогон ---
+def write_users(path: str):
+    data = {str(player(i)): {'nick': f'u{i}', 'tg_username': f'u{i}', 'balance': START_BALANCE,
+                             'transfer_confirmations': False} for i in range(PLAYERS)}
+    for i in range(TOP_PLAYERS):
+        data[str(9000 + i)] = {'nick': f'top{i}', 'tg_username': f'top{i}', 'balance': TOP_BALANCE}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def api_stats(port: int) -> dict:
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as response:
+        return json.load(response)
+
+
+def run(mode: str, workers: int, port: int):
+    workdir = tempfile.mkdtemp(prefix=f'kasik-shards{workers}-')
+    write_users(os.path.join(workdir, 'users_db.json'))
+    os.symlink(os.path.join(ROOT, 'img'), os.path.join(workdir, 'img'))
+    api = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'api', mode, str(port)])
+    env = dict(os.environ, BOT_TOKEN='123:BENCH', TELEGRAM_API_SERVER=f'http://127.0.0.1:{port}',
+               OUTBOUND_RATE='100000', USERS_STORAGE='sqlite', SHARD_WORKERS=str(workers), PYTHONUNBUFFERED='1')
+    with open(os.path.join(workdir, 'log.txt'), 'w') as log:
+        bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=workdir, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+        try:
+            while True:
+                try:
+                    stats = api_stats(port)
+                    break
+                except OSError:
+                    time.sleep(0.2)
+            replies, changed = -1, time.monotonic()
+            while True:
+                time.sleep(0.5)
+                stats = api_stats(port)
+                if stats['replies'] != replies:
+                    replies, changed = stats['replies'], time.monotonic()
+                elif stats['served'] >= stats['total'] and replies and time.monotonic() - changed > QUIET:
+                    break
+        finally:
+            bot.send_signal(signal.SIGTERM)
+            bot.wait(timeout=120)
+            api.kill()
+
+    conn = sqlite3.connect(os.path.join(workdir, 'users_db.sqlite3'))
+    balances = {uid: int(json.loads(data).get('balance', 0)) for uid, data in conn.execute('SELECT uid, data FROM users')}
+    conn.close()
+    elapsed = stats['last'] - stats['first']
+    name = f'{workers} воркеров' if workers else 'один процесс'
+    line = (f"{name}: {stats['total']} обновлений, {stats['replies']} ответов за {elapsed:.2f} с "
+            f"-> {stats['total'] / elapsed:.0f} обн/с; сумма балансов изменилась на "
+            f"{sum(balances.values()) - PLAYERS * START_BALANCE - TOP_PLAYERS * TOP_BALANCE}")
+    if mode == 'transfer':
+        changed = sum(balance != START_BALANCE for uid, balance in balances.items() if int(uid) >= player(0))
+        line += f", балансов не равных начальному: {changed}"
+    if mode == 'dice':
+        texts = stats['texts']
+        line += (f"; игр начато {texts.get('начинаем игру', 0)} из {PLAYERS // 2}, "
+                 f"'игра не найдена': {texts.get('игра не найдена', 0)}, "
+                 f"отрицательных балансов: {sum(b < 0 for b in balances.values())}")
+    print(line, flush=True)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'api':
+        run_api(sys.argv[2], int(sys.argv[3]))
+        return
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'spin'
+    runs = [int(n) for n in sys.argv[2].split(',')] if len(sys.argv) > 2 else [0, 1, 2, 4, 8]
+    print(f"ядер: {os.cpu_count()} - на одном ядре воркеры делят его, рост с их числом не ожидается")
+    for offset, workers in enumerate(runs):
+        run(mode, workers, 8950 + offset)
+
+
+if __name__ == '__main__':
+    main()
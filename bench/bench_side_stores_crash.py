@@ -0,0 +1,105 @@
+"""замер к user-010: целостность побочных json-файлов при падении и число записей.
+
+    python bench/bench_side_stores_crash.py [падений=25]
+
+дочерний процесс активирует промокоды и добавляет чаты, а мы убиваем его SIGKILL в
+случайный момент и пробуем прочитать promo_codes.json и bot_chats.json. режим old
+пишет файл на месте, как раньше делал save_promo_codes, режим actor - через
+side_stores. отдельно считаем, сколько раз файл реально записан за 1000 активаций.
+в коммите было: из 25 падений 22 испорченных файла при старой записи и 0 с side_stores;
+1000 активаций - 2 записи
+"""
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+from common import arg, enter_workdir, import_app
+
+STORE_FILES = ('promo_codes.json', 'bot_chats.json')
+
+
+async def activate_forever(app, mode: str):
+    """дочерний процесс: бесконечные активации, после разогрева печатает READY"""
+    def old_save():
+        with open('promo_codes.json', 'w', encoding='utf-8') as f:
+            json.dump(app.promo_codes, f, ensure_ascii=False, indent=2)
+
+    app.side_stores.start()
+    i = 0
+    while True:
+        i += 1
+        promo = app.promo_codes.setdefault(f'P{i % 50}', {
+            'reward': 1, 'activations': -1, 'current_activations': 0, 'expiry': None, 'used_by': []})
+        promo['used_by'].append(str(10**9 + i))
+        promo['current_activations'] += 1
+        if mode == 'old':
+            old_save()
+        else:
+            app.save_promo_codes()
+        if i % 20 == 0:
+            app.bot_chats.append(-i)
+            app.save_bot_chats(app.bot_chats)
+            await app.side_stores.flush()
+        if i == 2000:
+            print('READY', flush=True)
+        await asyncio.sleep(0)
+
+
+def crash_runs(mode: str, runs: int) -> int:
+    corrupted = 0
+    for _ in range(runs):
+        for path in STORE_FILES:
+            if os.path.exists(path):
+                os.remove(path)
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'child', mode],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        for line in child.stdout:
+            if line.strip() == 'READY':
+                break
+        else:
+            raise RuntimeError(f'дочерний процесс завершился сам с кодом {child.wait()}')
+        time.sleep(random.uniform(0.0, 0.5))
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        for path in STORE_FILES:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                corrupted += 1
+    return corrupted
+
+
+async def count_writes(app, activations: int) -> int:
+    app.side_stores.start()
+    before = app.side_stores.writes
+    for i in range(activations):
+        app.promo_codes.setdefault('BENCH', {'used_by': []})['used_by'].append(str(i))
+        app.save_promo_codes()
+        await asyncio.sleep(0)
+    await app.side_stores.flush()
+    await app.side_stores.drain()
+    return app.side_stores.writes - before
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == 'child':
+        asyncio.run(activate_forever(import_app(), sys.argv[2]))
+        return
+    runs = arg(1, 25)
+    enter_workdir()
+    for mode in ('old', 'actor'):
+        print(f"{mode}: испорченных файлов после {runs} SIGKILL: {crash_runs(mode, runs)}")
+    app = import_app()
+    print(f"1000 активаций промокода -> записей файла: {asyncio.run(count_writes(app, 1000))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""замер к user-011: поиск игрока по юзернейму/нику через индекс против перебора базы.
+
+    python bench/bench_user_index.py [пользователей=100000,1000000]
+
+перебор - как искали раньше: первый пользователь, у которого юзернейм (или ник) совпал
+без учёта регистра. ищем игроков из начала, середины и конца базы и отсутствующего, в
+конце сверяем ответы индекса с перебором.
+прогон на одном ядре (1M): построение индекса 2.3 с, поиск ~0.6 мкс против 145-190 мс перебором
+"""
+import random
+import sys
+import time
+
+from common import enter_workdir, import_app, make_user, per_call
+
+
+def old_find(table, username=None, nick=None):
+    if username is not None:
+        key = username.casefold()
+        for user_id, user_data in table.items():
+            value = user_data.get('tg_username')
+            if isinstance(value, str) and value.casefold() == key:
+                return user_id
+    if nick is not None:
+        key = nick.casefold()
+        for user_id, user_data in table.items():
+            value = user_data.get('nick')
+            if isinstance(value, str) and value.casefold() == key:
+                return user_id
+    return None
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(',')] if len(sys.argv) > 1 else [100_000, 1_000_000]
+    enter_workdir()
+    app = import_app()
+    rng = random.Random(11)
+    for n in sizes:
+        table = app.UsersTable()
+        for i in range(n):
+            user_id = str(10**9 + i)
+            dict.__setitem__(table, user_id, app.UserRecord(user_id, make_user(i, rng)))
+        app.users = table
+        app.leaderboard.rebuild(table)
+        started = time.perf_counter()
+        app.user_index.rebuild(table)
+        build = time.perf_counter() - started
+        queries = [('username', f'USER{i}') for i in (0, n // 2, n - 1)] + \
+                  [('nick', f'Player{n - 1}'), ('username', 'nobody_here')]
+        print(f"пользователей {n:>9}: построение индекса {build:.2f} с")
+        same = True
+        for kind, value in queries:
+            old = per_call(lambda: old_find(table, **{kind: value}), 3)
+            new = per_call(lambda: app.find_user_id(**{kind: value}), 10_000)
+            same &= old_find(table, **{kind: value}) == app.find_user_id(**{kind: value})
+            print(f"    {kind}={value:<16} перебор {old * 1000:7.1f} мс | индекс {new * 1e6:.2f} мкс")
+        print(f"    ответы совпали: {same}, расхождений индекса: {len(app.user_index.check())}")
+
+
+if __name__ == '__main__':
+    main()
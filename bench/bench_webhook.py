@@ -0,0 +1,214 @@
+"""замер к user-024: приём обновлений long polling'ом против вебхука на фейковом Bot API.
+
+    python bench/bench_webhook.py [задержка API в мс=30,100] [обновлений=6000]
+
+фейковый API (этот же файл с аргументом api) отдаёт обновления через getUpdates или ничего
+не отдаёт, если бот в режиме вебхука - тогда их шлёт отправитель (этот же файл с аргументом
+send) по 100 соединениям с секретным токеном. режимы ответа:
+    silent - текст, на который бот не отвечает; только последнее обновление - спин, по ответу
+             на него видно, что бот дошёл до конца
+    reply  - "рул красное 100", на каждое обновление один ответ с картинкой
+время - от первого отданного обновления до ответа, после которого пришли все ожидаемые ответы.
+прогон этого скрипта (одно ядро, 6000 обновлений, обн/с polling против webhook):
+rtt 30 мс - 98/158 silent, 80/149 reply; rtt 100 мс - 99/187 silent, 88/125 reply.
+в одном прогоне polling 212 спинов из 6000 остались без ответа. цифры в сообщении коммита
+user-024 снимались другим, незакоммиченным скриптом и с этими не сравнимы
+"""
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from common import ROOT
+
+PLAYERS = 1000
+SECRET = 'bench-secret'
+CONNECTIONS = 100
+TIMEOUT = 600
+SPIN = 'рул красное 100'
+MODES = ('silent', 'reply')
+
+
+def expected_replies(mode: str, count: int) -> int:
+    return count if mode == 'reply' else 1
+
+
+def make_updates(count: int, mode: str) -> list:
+    updates = []
+    for i in range(count):
+        user_id = 10_000 + i % PLAYERS
+        text = SPIN if mode == 'reply' or i == count - 1 else 'просто болтаю'
+        updates.append({'update_id': i + 1, 'message': {
+            'message_id': i + 1, 'date': 0, 'text': text, 'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'x', 'username': f'u{i % PLAYERS}'}}})
+    return updates
+
+
+# --- фейковый Bot API ---
+def run_api(port: int, rtt: float, mode: str, count: int, transport: str):
+    from aiohttp import web
+
+    updates = make_updates(count, mode) if transport == 'polling' else []
+    state = {'first': None, 'last': None, 'replies': 0, 'served': 0}
+
+    async def handler(request):
+        method = request.match_info['method']
+        data = await request.json() if request.content_type == 'application/json' else dict(await request.post())
+        await asyncio.sleep(rtt)
+        if method == 'getUpdates':
+            start = max(int(data.get('offset') or 1) - 1, 0)
+            batch = updates[start:start + 100]
+            if batch:
+                state['first'] = state['first'] or time.monotonic()
+                state['served'] = start + len(batch)
+            else:
+                await asyncio.sleep(0.5)
+            return web.json_response({'ok': True, 'result': batch})
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'b', 'username': 'b'}})
+        if method == 'getChat':
+            return web.json_response({'ok': True, 'result': {
+                'id': -1, 'type': 'supergroup', 'accent_color_id': 0, 'max_reaction_count': 0,
+                'accepted_gift_types': {'unlimited_gifts': False, 'limited_gifts': False, 'unique_gifts': False,
+                                        'premium_subscription': False, 'gifts_from_channels': False}}})
+        if method.startswith(('delete', 'answer', 'sendChatAction', 'getChatMember')):
+            return web.json_response({'ok': True, 'result': True})
+        state['replies'] += 1
+        state['last'] = time.monotonic()
+        chat_id = int(data.get('chat_id', 1))
+        return web.json_response({'ok': True, 'result': {
+            'message_id': state['replies'], 'date': 0, 'chat': {'id': chat_id, 'type': 'private'},
+            'photo': [{'file_id': 'f', 'file_unique_id': 'u', 'width': 1, 'height': 1}]}})
+
+    async def stats(request):
+        return web.json_response(state)
+
+    async def mark(request):
+        state['first'] = state['first'] or time.monotonic()
+        return web.json_response(state)
+
+    async def main():
+        application = web.Application()
+        application.router.add_post('/bot{token}/{method}', handler)
+        application.router.add_get('/stats', stats)
+        application.router.add_post('/mark', mark)
+        runner = web.AppRunner(application, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+# --- отправитель обновлений в вебхук ---
+def run_sender(api_port: int, port: int, mode: str, count: int):
+    import aiohttp
+
+    async def main():
+        queue = asyncio.Queue()
+        for update in make_updates(count, mode):
+            queue.put_nowait(update)
+        url = f'http://127.0.0.1:{port}/webhook'
+        headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+        connector = aiohttp.TCPConnector(limit=CONNECTIONS)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await session.post(f'http://127.0.0.1:{api_port}/mark')
+
+            async def worker():
+                while not queue.empty():
+                    update = queue.get_nowait()
+                    while True:
+                        async with session.post(url, json=update, headers=headers) as response:
+                            if response.status != 503:
+                                break
+                        await asyncio.sleep(0.1)  # как телеграм: повтор, пока очередь бота полна
+
+            await asyncio.gather(*(worker() for _ in range(CONNECTIONS)))
+
+    asyncio.run(main())
+
+
+# --- прогон ---
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port: int):
+    for _ in range(600):
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f'порт {port} так и не открылся')
+
+
+def api_stats(port: int) -> dict:
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as response:
+        return json.load(response)
+
+
+def run(transport: str, rtt: float, mode: str, count: int) -> float:
+    workdir = tempfile.mkdtemp(prefix=f'kasik-{transport}-')
+    users = {str(10_000 + i): {'nick': f'u{i}', 'tg_username': f'u{i}', 'balance': 10**12} for i in range(PLAYERS)}
+    with open(os.path.join(workdir, 'users_db.json'), 'w', encoding='utf-8') as f:
+        json.dump(users, f)
+    os.symlink(os.path.join(ROOT, 'img'), os.path.join(workdir, 'img'))
+    api_port, hook_port = free_port(), free_port()
+    me = os.path.abspath(__file__)
+    api = subprocess.Popen([sys.executable, me, 'api', str(api_port), str(rtt), mode, str(count), transport])
+    env = dict(os.environ, BOT_TOKEN='123:BENCH', TELEGRAM_API_SERVER=f'http://127.0.0.1:{api_port}',
+               OUTBOUND_RATE='100000', BOT_MODE=transport, WEBHOOK_PORT=str(hook_port),
+               WEBHOOK_SECRET=SECRET, PYTHONUNBUFFERED='1')
+    log_path = os.path.join(workdir, 'log.txt')
+    with open(log_path, 'w') as log:
+        bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=workdir, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_port(api_port)
+            if transport == 'webhook':
+                wait_port(hook_port)
+                subprocess.run([sys.executable, me, 'send', str(api_port), str(hook_port), mode, str(count)], check=True)
+            deadline = time.monotonic() + TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(0.2)
+                stats = api_stats(api_port)
+                if stats['replies'] >= expected_replies(mode, count):
+                    break
+        finally:
+            bot.send_signal(signal.SIGTERM)
+            bot.wait(timeout=120)
+            api.kill()
+    shutil.rmtree(workdir, ignore_errors=True)
+    if stats['replies'] < expected_replies(mode, count):
+        print(f"⚠️ {transport}: ответов {stats['replies']} из {expected_replies(mode, count)}")
+    return count / (stats['last'] - stats['first'])
+
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'api':
+        run_api(int(sys.argv[2]), float(sys.argv[3]), sys.argv[4], int(sys.argv[5]), sys.argv[6])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'send':
+        run_sender(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], int(sys.argv[5]))
+        return
+    rtts = [int(ms) for ms in sys.argv[1].split(',')] if len(sys.argv) > 1 else [30, 100]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 6000
+    for rtt in rtts:
+        for mode in MODES:
+            polling = run('polling', rtt / 1000, mode, count)
+            webhook = run('webhook', rtt / 1000, mode, count)
+            print(f"rtt {rtt} мс, {mode}: polling {polling:.0f} обн/с, webhook {webhook:.0f} обн/с", flush=True)
+
+
+if __name__ == '__main__':
+    main()
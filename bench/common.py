@@ -0,0 +1,80 @@
+"""общие заготовки для замеров: временная папка, синтетическая база, импорт бота.
+
+каждый замер запускается отдельным процессом из корня репозитория:
+    python bench/bench_journal.py 100000
+бот импортируется уже внутри временной папки, поэтому рабочие файлы базы не трогаются
+"""
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def arg(index: int, default: int) -> int:
+    """целое число из командной строки (размер базы, число прогонов)"""
+    return int(sys.argv[index]) if len(sys.argv) > index else default
+
+
+def enter_workdir(prefix: str = 'kasik-bench-') -> str:
+    """переходит в свежую временную папку, в ней бот создаст все свои файлы"""
+    path = tempfile.mkdtemp(prefix=prefix)
+    os.chdir(path)
+    return path
+
+
+def make_user(i: int, rng: random.Random) -> dict:
+    """пользователь с теми же полями, что создаёт регистрация"""
+    now = str(datetime.datetime.now())
+    return {
+        'nick': f'player{i}', 'tg_username': f'user{i}', 'balance': rng.randint(0, 10**12),
+        'referrals': 0, 'referral_earnings': 0, 'warns': 0, 'banned': False,
+        'registration_date': now, 'last_activity': now, 'total_messages': 5,
+        'phone_number': None, 'email': None, 'age': None, 'city': None, 'country': None,
+        'language': 'ru', 'device_info': None, 'ip_address': None, 'referral_source': 'direct',
+        'account_type': 'regular', 'verification_status': 'unverified', 'security_level': 'basic',
+        'premium_features': False, 'last_login': now, 'login_count': 1, 'session_duration': 0,
+        'last_bonus_time': 0,
+        'preferences': {'notifications': True, 'privacy_mode': False, 'auto_save': True},
+        'bank_deposit': 0, 'bank_deposit_time': 0,
+    }
+
+
+def make_users(n: int, seed: int = 1) -> dict:
+    rng = random.Random(seed)
+    return {str(10**9 + i): make_user(i, rng) for i in range(n)}
+
+
+def write_users_json(n: int, path: str = 'users_db.json', seed: int = 1):
+    """снапшот в старом формате (json.dump с отступами), как его писал бот до журнала"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(make_users(n, seed), f, ensure_ascii=False, indent=2)
+
+
+def import_app(**env):
+    """импортирует бота и загружает базу, как при запуске; env - переменные окружения до импорта"""
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+    for key, value in env.items():
+        os.environ[key] = str(value)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    app.open_users()
+    return app
+
+
+def per_call(fn, repeat: int) -> float:
+    """среднее время одного вызова в секундах"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
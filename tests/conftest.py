@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """модуль бота, импортированный в пустой временной папке (все файлы базы создаются там)"""
+    os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+    os.chdir(tmp_path_factory.mktemp('bot'))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app as module
+    module.open_users()
+    return module
+
+
+@pytest.fixture
+def bound_table(app, monkeypatch):
+    """пустая таблица пользователей вместо app.users, к ней привязаны рейтинг, индекс ников и индекс вкладов"""
+    app.flush_user_changes('test')
+    table = app.UsersTable()
+    monkeypatch.setattr(app, 'users', table)
+    app.leaderboard.rebuild(table)
+    app.user_index.rebuild(table)
+    app.deposit_index.rebuild(table)
+    yield table
+    # изменения тестовой таблицы в хранилище не пишем
+    app._pending_mutations.clear()
+    app._pending_reasoned = 0
+    monkeypatch.undo()
+    app.leaderboard.rebuild(app.users)
+    app.user_index.rebuild(app.users)
+    app.deposit_index.rebuild(app.users)
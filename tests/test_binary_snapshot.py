@@ -0,0 +1,55 @@
+def _users():
+    common = {'nick': 'a', 'balance': 5, 'banned': False, 'email': None,
+              'preferences': {'notifications': True}, 'last_bonus_time': 1.5}
+    return {
+        '1': dict(common),
+        '2': dict(common, nick='б', balance=10**31, banned=True),
+        '3': dict(common, nick='c', balance=-7, email='c@example.com'),
+        '4': {'nick': 'rare', 'balance': 0, 'ban_reason': 'spam'},  # другой набор полей
+    }
+
+
+def _matches(record, user_data: dict) -> bool:
+    return all(key in record and record[key] == value for key, value in user_data.items())
+
+
+def test_binary_snapshot_round_trip(app):
+    users = _users()
+    data = app._encode_binary_snapshot(users.items(), {'schema_version': 3})
+    decoded = app._decode_binary_snapshot(data)
+    assert decoded.pop(app.USERS_META_KEY) == {'schema_version': 3}
+    assert decoded == users
+
+    records = app._decode_binary_snapshot(data, as_records=True)
+    records.pop(app.USERS_META_KEY)
+    # UserRecord добавляет поля профиля со значениями по умолчанию - сверяем сохранённые
+    assert records.keys() == users.keys()
+    assert all(_matches(records[user_id], user_data) for user_id, user_data in users.items())
+    assert all(isinstance(record, app.UserRecord) for record in records.values())
+
+
+def test_empty_binary_snapshot(app):
+    assert app._decode_binary_snapshot(app._encode_binary_snapshot([])) == {}
+
+
+def test_convert_json_binary_json(app, tmp_path):
+    json_path = str(tmp_path / 'users_db.json')
+    binary_path = str(tmp_path / 'users_db.bin')
+    app._write_json_atomic(json_path, _users())
+    assert app.convert_snapshot_to_binary(json_path, binary_path) == 4
+    assert app.convert_snapshot_to_json(binary_path, json_path) == 4
+    assert app._read_snapshot_file(json_path) == _users()
+
+
+def test_binary_storage_replays_journal(app, tmp_path):
+    storage = app.JsonUserStorage(snapshot_path=str(tmp_path / 'users_db.bin'),
+                                  journal_path=str(tmp_path / 'users_journal.jsonl'),
+                                  snapshot_format='binary')
+    users = _users()
+    storage.replace_all(users)
+    storage.apply([('set', '1', 'balance', 6, 'spin')], 'test', users)
+    storage.close()
+    loaded = storage.load_all()
+    assert loaded['1']['balance'] == 6
+    assert loaded['2']['balance'] == 10**31
+    assert _matches(loaded['4'], users['4'])
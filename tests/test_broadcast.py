@@ -0,0 +1,71 @@
+import asyncio
+
+REPORT_CHAT = 1
+RECIPIENTS = [10**12 + i for i in range(300)]
+
+
+class FakeBroadcastApi:
+    """send_message бота: получатели из failing не принимают сообщения, после stop_after доставок
+    выставляет reached, чтобы тест остановил рассылку посреди работы"""
+
+    def __init__(self, failing: set, stop_after: int):
+        self.failing = failing
+        self.stop_after = stop_after
+        self.delivered = []
+        self.reports = []
+        self.reached = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.001)
+        if chat_id == REPORT_CHAT:
+            self.reports.append(text)
+            return True
+        if chat_id in self.failing:
+            raise RuntimeError('bot was blocked by the user')
+        self.delivered.append(chat_id)
+        if len(self.delivered) >= self.stop_after:
+            self.reached.set()
+        return True
+
+
+def _bind(app, monkeypatch, engine):
+    """задание и прогресс движка пишутся во временные файлы теста"""
+    for name, get_data in (('broadcast_job', engine._job_data), ('broadcast_progress', engine._progress_data)):
+        path = app.BROADCAST_JOB_FILE if name == 'broadcast_job' else app.BROADCAST_PROGRESS_FILE
+        monkeypatch.setitem(app.side_stores.stores, name, (path, get_data))
+
+
+def test_resumed_broadcast_reaches_everyone_once_in_counters(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'BROADCAST_JOB_FILE', str(tmp_path / 'job.json'))
+    monkeypatch.setattr(app, 'BROADCAST_PROGRESS_FILE', str(tmp_path / 'progress.json'))
+    monkeypatch.setattr(app.dead_recipients, 'record_failure', lambda chat_id, error: None)
+    failing = set(RECIPIENTS[5::7])
+    api = FakeBroadcastApi(failing, stop_after=100)
+    monkeypatch.setattr(app.bot, 'send_message', api.send_message)
+
+    async def scenario():
+        first = app.BroadcastEngine()
+        _bind(app, monkeypatch, first)
+        first.start(list(RECIPIENTS), 'привет', None, None, REPORT_CHAT, None)
+        await api.reached.wait()
+        await first.stop()  # перезапуск бота посреди рассылки
+        stopped_at = first.job['position']
+
+        second = app.BroadcastEngine()
+        _bind(app, monkeypatch, second)
+        assert second.resume()
+        await second.task
+        return stopped_at, second.job
+
+    stopped_at, job = asyncio.run(scenario())
+    assert 0 < stopped_at < len(RECIPIENTS)
+    # никто не пропущен; повторно могли получить только те, кто был в работе в момент остановки
+    assert set(api.delivered) == set(RECIPIENTS) - failing
+    assert len(api.delivered) - len(set(api.delivered)) <= app.BROADCAST_WORKERS
+    # счётчики задания точные: каждый получатель учтён ровно один раз
+    assert job['position'] == len(RECIPIENTS)
+    assert job['sent'] == len(RECIPIENTS) - len(failing)
+    assert job['failed'] == len(failing)
+    assert api.reports == [f"готово. отправлено: {job['sent']}/{len(RECIPIENTS)}, не доставлено: {len(failing)}"]
+    # законченная рассылка после следующего перезапуска не продолжается
+    assert not app.BroadcastEngine().resume()
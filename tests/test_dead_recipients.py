@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound,
+                                TelegramRetryAfter, TelegramServerError)
+from aiogram.methods import SendMessage
+
+METHOD = SendMessage(chat_id=1, text='x')
+
+
+@pytest.fixture
+def dead(app, monkeypatch):
+    """пустой список недоступных вместо app.dead_recipients"""
+    recipients = app.DeadRecipients()
+    monkeypatch.setattr(app, 'dead_recipients', recipients)
+    monkeypatch.setitem(app.side_stores.stores, 'dead_recipients', (app.DEAD_RECIPIENTS_FILE, recipients._data))
+    return recipients
+
+
+@pytest.mark.parametrize('error, reason', [
+    (TelegramForbiddenError(METHOD, 'Forbidden: bot was blocked by the user'), 'blocked'),
+    (TelegramForbiddenError(METHOD, 'Forbidden: user is deactivated'), 'deactivated'),
+    (TelegramForbiddenError(METHOD, 'Forbidden: bot was kicked from the group chat'), 'kicked'),
+    (TelegramForbiddenError(METHOD, 'Forbidden: bot is not a member of the channel chat'), 'kicked'),
+    (TelegramForbiddenError(METHOD, 'Forbidden: bot can\'t initiate conversation with a user'), 'forbidden'),
+    (TelegramBadRequest(METHOD, 'Bad Request: chat not found'), 'chat_not_found'),
+    (TelegramBadRequest(METHOD, 'Bad Request: PEER_ID_INVALID'), 'chat_not_found'),
+    (TelegramNotFound(METHOD, 'Not Found: user not found'), 'chat_not_found'),
+    # временные ошибки и ошибки самого сообщения получателя не выключают
+    (TelegramBadRequest(METHOD, 'Bad Request: message is too long'), None),
+    (TelegramRetryAfter(METHOD, 'Too Many Requests', 5), None),
+    (TelegramServerError(METHOD, 'Internal Server Error'), None),
+    (OSError('connection reset'), None),
+])
+def test_classify_send_error(app, error, reason):
+    assert app.classify_send_error(error) == reason
+
+
+def test_record_failure_marks_only_permanent_errors(app, dead):
+    assert not dead.record_failure(5, OSError('timeout'))
+    assert dead.record_failure(6, TelegramForbiddenError(METHOD, 'Forbidden: bot was blocked by the user'))
+    assert dead.entries.keys() == {6}
+    assert dead.entries[6]['reason'] == 'blocked'
+    assert dead.reachable([5, '6', 7]) == [5, 7]
+    assert dead.by_reason([5, 6, 7]) == {'blocked': 1}
+
+
+def test_private_message_revives_recipient(app, dead, bound_table):
+    dead.mark(42, 'blocked')
+    dead.mark(-100, 'kicked')
+    group = SimpleNamespace(chat=SimpleNamespace(type='supergroup'),
+                            from_user=SimpleNamespace(id=43, username=None))
+    app.collect_user_info(group, '42')  # написал в группе - блокировка лс от этого не снимается
+    assert 42 in dead
+    private = SimpleNamespace(chat=SimpleNamespace(type='private'),
+                              from_user=SimpleNamespace(id=42, username=None))
+    app.collect_user_info(private, '42')
+    assert 42 not in dead
+    assert dead.reachable([42, -100]) == [42]
+    assert dead.revived == 1
+
+
+def test_my_chat_member_marks_and_revives(app, dead, monkeypatch):
+    monkeypatch.setattr(app, 'bot_chats', [])
+    monkeypatch.setattr(app, 'save_bot_chats', lambda chats: None)
+
+    def member_update(chat_id: int, chat_type: str, status: str):
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id, type=chat_type),
+                               new_chat_member=SimpleNamespace(status=status))
+
+    asyncio.run(app.on_my_chat_member(member_update(42, 'private', 'kicked')))
+    asyncio.run(app.on_my_chat_member(member_update(-100, 'supergroup', 'kicked')))
+    assert {chat_id: entry['reason'] for chat_id, entry in dead.entries.items()} == {42: 'blocked', -100: 'kicked'}
+    asyncio.run(app.on_my_chat_member(member_update(42, 'private', 'member')))
+    asyncio.run(app.on_my_chat_member(member_update(-100, 'supergroup', 'administrator')))
+    assert len(dead) == 0
+
+
+def test_recheck_revives_reachable_recipient(app, dead, monkeypatch):
+    monkeypatch.setattr(app, 'DEAD_RECHECK_AFTER', 0)
+    answers = {7: True, 8: TelegramForbiddenError(METHOD, 'Forbidden: user is deactivated')}
+
+    async def send_chat_action(chat_id, action, **kwargs):
+        answer = answers[chat_id]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(app.bot, 'send_chat_action', send_chat_action)
+    dead.mark(7, 'blocked')
+    dead.mark(8, 'blocked')
+    asyncio.run(dead.recheck_one())
+    asyncio.run(dead.recheck_one())
+    assert dead.entries.keys() == {8}
+    assert dead.entries[8]['reason'] == 'deactivated'
+    assert (dead.rechecked, dead.revived) == (2, 1)
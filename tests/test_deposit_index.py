@@ -0,0 +1,66 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+
+def _deposit(amount, started, **fields):
+    return {'nick': 'x', 'balance': 0, 'bank_deposit': amount, 'bank_deposit_time': started, **fields}
+
+
+def test_totals_and_order_follow_the_table(app, bound_table):
+    rng = random.Random(15)
+    for i in range(300):
+        bound_table[str(i)] = _deposit(rng.choice([0, rng.randint(1, 10**6)]), rng.randint(1, 10**6))
+    for _ in range(1000):
+        user_data = bound_table[str(rng.randrange(300))]
+        if rng.random() < 0.3:
+            user_data['bank_deposit'] = 0  # забрал вклад
+        else:
+            user_data['bank_deposit'] = rng.randint(1, 10**6)
+            user_data['bank_deposit_time'] = rng.randint(1, 10**6)
+    del bound_table['7']
+
+    index = app.deposit_index
+    deposits = {user_id: (u['bank_deposit'], u['bank_deposit_time'])
+                for user_id, u in bound_table.items() if u['bank_deposit'] > 0}
+    assert index.check() == []
+    assert len(index) == len(deposits)
+    assert index.total == sum(amount for amount, _ in deposits.values())
+    assert index.max_amount() == max(amount for amount, _ in deposits.values())
+    assert index.top(10) == sorted(((user_id, amount) for user_id, (amount, _) in deposits.items()),
+                                   key=lambda item: (-item[1], item[0]))[:10]
+    assert index.opened_before(500_000) == [user_id for user_id, _ in sorted(
+        ((user_id, started) for user_id, (_, started) in deposits.items() if started < 500_000),
+        key=lambda item: (item[1], item[0]))]
+
+
+def test_annul_clears_every_deposit(app, bound_table, monkeypatch):
+    for i in range(50):
+        bound_table[str(i)] = _deposit(100 * (i % 5), 1000 + i)
+    bound_table['1']['balance'] = 777
+    monkeypatch.setattr(app, 'ADMIN_IDS', [1])
+    edited = []
+
+    async def answer(*args, **kwargs):
+        pass
+
+    async def edit_text(text, **kwargs):
+        edited.append(text)
+
+    callback = SimpleNamespace(from_user=SimpleNamespace(id=1), answer=answer,
+                               message=SimpleNamespace(edit_text=edit_text))
+    asyncio.run(app.confirm_annul_deposits_callback(callback))
+
+    assert all(u['bank_deposit'] == 0 for u in bound_table.values())
+    assert [user_id for user_id, u in bound_table.items() if u['bank_deposit_time'] == 0] == \
+        [str(i) for i in range(50) if i % 5]  # время обнуляется только у бывших вкладчиков
+    assert bound_table['1']['balance'] == 777
+    assert (len(app.deposit_index), app.deposit_index.total, app.deposit_index.max_amount()) == (0, 0, 0)
+    assert app.deposit_index.check() == []
+    assert app.deposit_scheduler.pending == {}
+    assert 'затронуто игроков: <b>40</b>' in edited[0]
+    assert f'обнулено вкладов: <b>${app.format_money(10_000)}</b>' in edited[0]
+    # после аннулирования индекс снова следит за таблицей
+    bound_table['3']['bank_deposit'] = 50
+    bound_table['3']['bank_deposit_time'] = 9
+    assert app.deposit_index.top(1) == [('3', 50)] and app.deposit_index.check() == []
@@ -0,0 +1,60 @@
+TERM = 86400
+
+
+def test_cancelled_and_replaced_deposits_are_not_due(app):
+    scheduler = app.DepositMaturityScheduler()
+    scheduler.schedule('1', 0)
+    scheduler.schedule('2', 10)
+    scheduler.schedule('3', 20)
+    scheduler.cancel('1')        # забрал вклад досрочно
+    scheduler.schedule('2', 30)  # закрыл и открыл новый - старый срок больше не действует
+    assert scheduler.next_due() == 20 + TERM
+    assert scheduler.pop_due(20 + TERM - 1) == []
+    assert scheduler.pop_due(20 + TERM) == [('3', 20)]
+    assert scheduler.pop_due(10**9) == [('2', 30)]
+    assert scheduler.next_due() is None and scheduler.pending == {}
+
+
+def test_compaction_keeps_live_deposits(app):
+    scheduler = app.DepositMaturityScheduler()
+    for i in range(3000):
+        scheduler.schedule(str(i), i)
+    for i in range(2500):
+        scheduler.cancel(str(i))
+    # отменённые записи вычищены пересборкой, а не висят в куче до срока
+    assert len(scheduler.heap) < 2 * len(scheduler.pending) + 1024
+    assert scheduler.pop_due(10**9) == [(str(i), i) for i in range(2500, 3000)]
+
+
+def test_index_feeds_the_scheduler(app, bound_table):
+    scheduler = app.deposit_scheduler
+    bound_table['1'] = {'nick': 'a', 'balance': 0, 'bank_deposit': 100, 'bank_deposit_time': 50}
+    bound_table['2'] = {'nick': 'b', 'balance': 0, 'bank_deposit': 200, 'bank_deposit_time': 60}
+    assert scheduler.pending == {'1': 50, '2': 60}
+    bound_table['1']['bank_deposit'] = 0  # снял вклад
+    assert scheduler.pending == {'2': 60}
+    del bound_table['2']
+    assert scheduler.pop_due(10**9) == []
+
+
+def test_rebuild_skips_notified_deposits(app, bound_table):
+    bound_table['1'] = {'nick': 'a', 'balance': 0, 'bank_deposit': 100, 'bank_deposit_time': 50,
+                        'bank_deposit_notified': 50}
+    bound_table['2'] = {'nick': 'b', 'balance': 0, 'bank_deposit': 200, 'bank_deposit_time': 60,
+                        'bank_deposit_notified': 10}  # о прошлом вкладе сообщили, о новом ещё нет
+    bound_table['3'] = {'nick': 'c', 'balance': 0, 'bank_deposit': 0, 'bank_deposit_time': 70}
+    app.deposit_index.rebuild(bound_table)  # перезапуск бота
+    assert app.deposit_scheduler.pending == {'2': 60}
+
+
+def test_matured_deposit_is_notified_once(app, bound_table, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app.notify_sender, 'send', lambda chat_id, text, **kwargs: sent.append(chat_id))
+    bound_table['7'] = {'nick': 'a', 'balance': 0, 'bank_deposit': 1000, 'bank_deposit_time': 5}
+    scheduler = app.deposit_scheduler
+    for user_id, started in scheduler.pop_due(5 + TERM):
+        scheduler.notify(user_id, started)
+    assert sent == [7]
+    assert bound_table['7']['bank_deposit_notified'] == 5
+    app.deposit_index.rebuild(bound_table)  # после перезапуска повторно не напоминаем
+    assert scheduler.pending == {}
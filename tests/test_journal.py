@@ -0,0 +1,57 @@
+import json
+import os
+
+import pytest
+
+
+def test_journal_replay_restores_flushed_changes(app, tmp_path):
+    storage = app.JsonUserStorage(snapshot_path=str(tmp_path / 'users_db.json'),
+                                  journal_path=str(tmp_path / 'users_journal.jsonl'),
+                                  snapshot_format='json')
+    current = {'1': {'nick': 'a', 'balance': 5}, '2': {'nick': 'b', 'balance': 1}}
+    storage.replace_all(current)
+    storage.apply([
+        ('set', '1', 'balance', 10**31, 'spin'),
+        ('put', '3', None, {'nick': 'c', 'balance': 7}, 'register'),
+        ('del', '2', None, None, 'admin'),
+    ], 'test', current)
+    storage.close()
+
+    assert storage.load_all() == {'1': {'nick': 'a', 'balance': 10**31}, '3': {'nick': 'c', 'balance': 7}}
+
+
+def test_torn_last_journal_line_is_skipped(app, tmp_path):
+    journal = tmp_path / 'users_journal.jsonl'
+    storage = app.JsonUserStorage(snapshot_path=str(tmp_path / 'users_db.json'),
+                                  journal_path=str(journal), snapshot_format='json')
+    storage.apply([('put', '1', None, {'nick': 'a', 'balance': 5}, 'register')], 'test', {})
+    storage.close()
+    # падение посреди записи: вторая строка обрезана
+    line = json.dumps({'ts': 0, 'op': 'set', 'uid': '1', 'f': 'balance', 'v': 99})
+    with open(journal, 'a', encoding='utf-8') as f:
+        f.write(line[:len(line) // 2])
+
+    assert storage.load_all() == {'1': {'nick': 'a', 'balance': 5}}
+
+
+def test_spins_reach_journal_without_snapshot_rewrite(app):
+    storage = app.user_storage
+    if storage.name != 'json':
+        pytest.skip('журнал только у json-хранилища')
+    app.users['900101'] = {'nick': 'journal_spin', 'balance': 100}
+    app.flush_user_changes('test')
+    snapshot_mtime = _mtime(storage.snapshot_path)
+    for _ in range(20):
+        app.debit('900101', 10, 'roulette')
+        app.credit('900101', 20, 'roulette')
+        app.flush_user_changes('roulette')
+
+    assert _mtime(storage.snapshot_path) == snapshot_mtime
+    assert storage.load_all()['900101']['balance'] == 300
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
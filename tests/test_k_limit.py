@@ -0,0 +1,54 @@
+import random
+import time
+
+
+def test_max_balance_matches_full_scan(app, bound_table):
+    rng = random.Random(14)
+    for i in range(500):
+        bound_table[str(i)] = {'nick': f'p{i}', 'balance': rng.randint(0, 10**12)}
+    for _ in range(2000):
+        user_id = str(rng.randrange(500))
+        if rng.random() < 0.5:
+            app.credit(user_id, rng.randint(1, 10**11), 'spin')
+        else:
+            app.debit(user_id, rng.randint(1, 10**11), 'spin', floor=0)
+        assert app.leaderboard.max_balance() == max(u['balance'] for u in bound_table.values())
+
+
+def test_k_limit_follows_richest_player(app, bound_table):
+    bound_table['1'] = {'nick': 'rich', 'balance': 10**12}
+    bound_table['2'] = {'nick': 'poor', 'balance': 5}
+    assert app.get_max_k_count() == 15
+
+    app.credit('1', 10**16, 'spin')
+    assert app.get_max_k_count() == 20
+
+    app.debit('1', app.users['1']['balance'], 'spin')
+    assert app.get_max_k_count() == 15
+
+    bound_table['3'] = {'nick': 'new', 'balance': 10**15 + 1}
+    assert app.get_max_k_count() == 20
+    del bound_table['3']
+    assert app.get_max_k_count() == 15
+
+
+def _save_cost(app, table, n: int) -> float:
+    """лучшее время "спин + save_users" на базе из n пользователей"""
+    rng = random.Random(n)
+    for i in range(len(table), n):
+        table[str(i)] = {'nick': f'p{i}', 'balance': rng.randint(0, 10**12)}
+    app.flush_user_changes('test')
+    best = float('inf')
+    for _ in range(200):
+        started = time.perf_counter()
+        app.credit(str(rng.randrange(n)), 1, 'spin')
+        app.save_users('spin')
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def test_save_users_cost_does_not_grow_with_table(app, bound_table):
+    small = _save_cost(app, bound_table, 2_000)
+    large = _save_cost(app, bound_table, 50_000)
+    # проход по всей базе сделал бы сохранение в 25 раз дороже; рейтинг добавляет только log n
+    assert large < small * 5 + 0.0002, (small, large)
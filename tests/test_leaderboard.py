@@ -0,0 +1,38 @@
+import random
+
+
+def _full_sort(table) -> list[str]:
+    # так считался топ до рейтинга: устойчивая сортировка всей базы
+    return [uid for uid, _ in sorted(table.items(), key=lambda item: item[1].get('balance', 0), reverse=True)]
+
+
+def test_ranks_match_full_sort_after_random_updates(app, bound_table):
+    rng = random.Random(12)
+    for i in range(2000):
+        bound_table[str(i)] = {'nick': f'p{i}', 'balance': rng.choice([0, 0, 1000, rng.randint(0, 10**6)])}
+    user_ids = list(bound_table)
+    for _ in range(3000):
+        user_id = rng.choice(user_ids)
+        if rng.random() < 0.5:
+            app.credit(user_id, rng.randint(1, 5000), 'spin')
+        else:
+            app.debit(user_id, rng.randint(1, 5000), 'spin', floor=0)
+    for _ in range(100):
+        del bound_table[user_ids.pop(rng.randrange(len(user_ids)))]
+    for i in range(100):
+        bound_table[f'new{i}'] = {'nick': f'new{i}', 'balance': rng.choice([0, 1000])}
+
+    ordered = _full_sort(bound_table)
+    assert [uid for uid, _ in app.get_top_players()] == ordered[:100]
+    assert all(app.get_user_position(uid) == place for place, uid in enumerate(ordered, 1))
+    assert all(app.is_top20_player(uid) == (place <= 20) for place, uid in enumerate(ordered, 1))
+    assert app.leaderboard.check() == []
+
+
+def test_equal_balances_keep_registration_order(app, bound_table):
+    for uid in ('a', 'b', 'c'):
+        bound_table[uid] = {'nick': uid, 'balance': 100}
+    app.credit('a', 50, 'spin')
+    app.debit('a', 50, 'spin')
+    assert app.leaderboard.top(3) == ['a', 'b', 'c']
+    assert app.get_user_position('zzz') == 4  # незарегистрированный - после всех
@@ -0,0 +1,104 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+# база до версионирования схемы: без _meta, у игроков только часть полей
+LEGACY_USERS = {
+    '1001': {'nick': 'old', 'balance': 500, 'tg_username': 'old_one'},
+    '1002': {'nick': 'older', 'warns': 2, 'bank_deposit': 70, 'language': 'en'},
+}
+
+
+@pytest.fixture
+def legacy_storage(app, bound_table, monkeypatch, tmp_path):
+    """хранилище со старым users_db.json; app.users загружен из него"""
+    path = tmp_path / 'users_db.json'
+    path.write_text(json.dumps(LEGACY_USERS), encoding='utf-8')
+    storage = app.JsonUserStorage(str(path), str(tmp_path / 'users_journal.jsonl'), 'json')
+    monkeypatch.setattr(app, 'user_storage', storage)
+    monkeypatch.setattr(app, 'users', app.load_users())
+    yield storage
+    storage.close()
+
+
+def test_new_user_record_has_current_schema_fields(app):
+    stub = app.new_user_record()
+    migrated = {}
+    app.run_user_migrations({'stub': migrated}, 0)
+    assert stub.keys() == migrated.keys()
+    for field, value in (('warns', 0), ('banned', False), ('referral_earnings', 0)):
+        assert stub[field] == value
+
+
+def test_new_user_record_keeps_given_fields(app):
+    record = app.new_user_record({'nick': 'fresh', 'balance': 5, 'language': 'en'})
+    assert record['nick'] == 'fresh'
+    assert record['balance'] == 5
+    assert record['language'] == 'en'
+    assert record['bank_deposit'] == 0
+
+
+
+
+def test_legacy_users_are_migrated_once(app, legacy_storage):
+    assert legacy_storage.schema_version == 0
+    assert app.migrate_existing_users() > 0
+    assert legacy_storage.schema_version == app.USERS_SCHEMA_VERSION
+
+    # после перезапуска база уже в текущей схеме, а данные игроков не тронуты
+    reopened = app.JsonUserStorage(legacy_storage.snapshot_path, legacy_storage.journal_path, 'json')
+    data = reopened.load_all()
+    reopened.close()
+    assert reopened.schema_version == app.USERS_SCHEMA_VERSION
+    for user_id, fields in LEGACY_USERS.items():
+        for field, value in fields.items():
+            assert data[user_id][field] == value
+    for field, value in (('warns', 0), ('banned', False), ('referrals', 0), ('login_count', 1), ('bank_deposit_time', 0)):
+        assert data['1001'][field] == value
+    assert data['1002']['balance'] == 0
+    assert app.migrate_existing_users() == 0
+
+
+def test_run_user_migrations_skips_applied_versions(app):
+    data = {user_id: dict(fields) for user_id, fields in LEGACY_USERS.items()}
+    assert app.run_user_migrations(data, app.USERS_SCHEMA_VERSION) == 0
+    assert data == LEGACY_USERS
+    assert app.run_user_migrations(data, 1) > 0
+    assert 'warns' not in data['1001']  # поле версии 1 - её шаг не прогонялся
+    assert data['1001']['language'] == 'ru'
+
+
+def test_import_does_not_touch_users(tmp_path):
+    # миграцию запускает main()/фронт шардов, а не импорт (cli-команды её не ждут).
+    # отдельный процесс: в этом уже импортирован модуль, и база открыта фикстурой
+    path = tmp_path / 'users_db.json'
+    path.write_text(json.dumps(LEGACY_USERS), encoding='utf-8')
+    code = 'import app; assert app.user_storage is None and not app.users'
+    env = dict(os.environ, BOT_TOKEN='123456:TEST', PYTHONPATH=ROOT, USERS_STORAGE='sqlite')
+    subprocess.run([sys.executable, '-c', code], cwd=tmp_path, env=env, check=True, capture_output=True)
+    assert json.loads(path.read_text(encoding='utf-8')) == LEGACY_USERS
+    assert sorted(os.listdir(tmp_path)) == ['users_db.json']
+
+
+def test_save_users_does_not_walk_the_table(app, bound_table):
+    class NoWalkTable(app.UsersTable):
+        def _walk(self, *args):
+            raise AssertionError('save_users прошёл по всей базе')
+        __iter__ = keys = values = items = _walk
+
+    for i in range(1000):
+        bound_table[str(i)] = app.new_user_record({'nick': f'p{i}', 'balance': i})
+    app.flush_user_changes('test')
+    bound_table.__class__ = NoWalkTable
+    try:
+        app.credit('5', 10, 'test')
+        app.save_users('test', critical=True)
+        assert not app._pending_mutations
+    finally:
+        bound_table.__class__ = app.UsersTable
+    assert bound_table['5']['balance'] == 15
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, DeleteMessage, EditMessageText, SendMessage
+
+
+class FakeApi:
+    """запоминает время каждого запроса; первые flood_times запросов получают RetryAfter"""
+
+    def __init__(self, flood_times: int = 0, retry_after: int = 1):
+        self.flood_times = flood_times
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def __call__(self, bot, method):
+        self.calls.append((method.__api_method__, time.monotonic()))
+        if self.flood_times:
+            self.flood_times -= 1
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=self.retry_after)
+        return True
+
+
+def _run(app, scenario):
+    async def wrapper():
+        scheduler = app.OutboundScheduler(1000)
+        try:
+            return await scenario(scheduler)
+        finally:
+            await scheduler.stop()
+    return asyncio.run(wrapper())
+
+
+def test_interactive_edit_waits_retry_after(app):
+    api = FakeApi(flood_times=1)
+
+    async def scenario(scheduler):
+        await scheduler.deliver(api, None, EditMessageText(chat_id=5, message_id=1, text='x'))
+
+    _run(app, scenario)
+    assert len(api.calls) == 2
+    assert api.calls[1][1] - api.calls[0][1] >= 1
+
+
+def test_callback_answer_is_retried_after_flood(app):
+    api = FakeApi(flood_times=1)
+
+    async def scenario(scheduler):
+        return await scheduler.deliver(api, None, AnswerCallbackQuery(callback_query_id='1'))
+
+    assert _run(app, scenario) is True
+    assert len(api.calls) == 2
+    assert api.calls[1][1] - api.calls[0][1] >= 1
+
+
+def test_flood_pauses_chat_for_every_method(app):
+    edit_api = FakeApi(flood_times=1)
+    other_api = FakeApi()
+
+    async def scenario(scheduler):
+        edit = asyncio.create_task(scheduler.deliver(edit_api, None, EditMessageText(chat_id=7, message_id=1, text='x')))
+        while not edit_api.calls:
+            await asyncio.sleep(0.001)
+        started = time.monotonic()
+        await scheduler.deliver(other_api, None, DeleteMessage(chat_id=7, message_id=2))
+        await scheduler.deliver(other_api, None, SendMessage(chat_id=8, text='другой чат'))
+        await edit
+        return started
+
+    started = _run(app, scenario)
+    delete_at = other_api.calls[0][1]
+    assert delete_at - started >= 0.9
+    assert other_api.calls[1][1] - delete_at < 0.5
+
+
+def test_group_interval_only_for_background_traffic(app, monkeypatch):
+    # лимит группы соблюдают все классы, но ответы игрокам обгоняют рассылку в очереди чата
+    monkeypatch.setattr(app, 'OUTBOUND_GROUP_INTERVAL', 0.2)
+    sent = []
+
+    async def api(bot, method):
+        sent.append((method.text, time.monotonic()))
+        return True
+
+    async def scenario(scheduler):
+        with app.outbound_class(app.PRIORITY_BULK):
+            bulk = [asyncio.create_task(scheduler.deliver(api, None, SendMessage(chat_id=-100, text=f'b{i}')))
+                    for i in range(6)]
+        await asyncio.sleep(0.05)
+        interactive = [asyncio.create_task(scheduler.deliver(api, None, SendMessage(chat_id=-100, text=f'i{i}')))
+                       for i in range(2)]
+        await asyncio.gather(*bulk, *interactive)
+
+    _run(app, scenario)
+    assert [text for text, _ in sent] == ['b0', 'b1', 'b2', 'i0', 'i1', 'b3', 'b4', 'b5']
+    # три сообщения всплеском, дальше раз в OUTBOUND_GROUP_INTERVAL - и для ответов игрокам
+    gaps = [later - earlier for (_, earlier), (_, later) in zip(sent[2:], sent[3:])]
+    assert min(gaps) >= 0.2 - 0.02
+
+
+def test_shutdown_stops_every_background_service(app):
+    # так их останавливает main() при выключении бота
+    async def shutdown():
+        scheduler = app.OutboundScheduler(1000)
+        await scheduler.deliver(FakeApi(), None, SendMessage(chat_id=-100, text='x'))
+        for service in (app.RateLimitedSender(1000), app.DepositMaturityScheduler(), app.DeadRecipients(), scheduler):
+            await service.stop()
+
+    asyncio.run(shutdown())
@@ -0,0 +1,124 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def _press(data: str, user_id: int, chat_id: int = -100):
+    return {'update_id': 1, 'callback_query': {
+        'id': '1', 'from': {'id': user_id}, 'data': data, 'message': {'chat': {'id': chat_id}}}}
+
+
+def test_game_buttons_route_to_creator_shard(app):
+    assert app.update_actor_id(_press(app.game_button('dice_accept', '111'), 222)) == 111
+    assert app.update_actor_id(_press(app.game_button('basket_cancel', '111'), 222)) == 111
+    # кнопки старого формата и остальные кнопки - по нажавшему
+    assert app.update_actor_id(_press('dice_accept', 222)) == 222
+    assert app.update_actor_id(_press('top_page_1', 222)) == 222
+
+
+def test_take_stake_checks_balance(app, bound_table):
+    bound_table['1'] = {'nick': 'a', 'balance': 100}
+    assert not app.take_stake('1', 101, 'dice_stake')
+    assert app.take_stake('1', 100, 'dice_stake')
+    assert bound_table['1']['balance'] == 0
+    assert not app.take_stake('missing', 1, 'dice_stake')
+
+
+def test_stake_of_other_shard_player_is_taken_by_owner(app, monkeypatch):
+    calls = []
+
+    class FakeLink:
+        async def call(self, to, name, args):
+            calls.append((to, name, args))
+            return False
+
+    monkeypatch.setattr(app, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(app, 'SHARD_INDEX', 0)
+    monkeypatch.setattr(app, 'shard_link', FakeLink())
+    assert not asyncio.run(app.take_stake_shared('1001', 50, 'dice_stake'))
+    assert calls == [(1, 'take_stake', ['1001', 50, 'dice_stake', None])]
+
+
+def test_stake_with_id_is_taken_once(app, bound_table):
+    bound_table['1'] = {'nick': 'a', 'balance': 100}
+    assert app.take_stake('1', 60, 'dice_stake', 's1')
+    assert app.take_stake('1', 60, 'dice_stake', 's1')  # повтор вызова не списывает второй раз
+    assert bound_table['1']['balance'] == 40
+    assert app.refund_stake('s1', 'dice_stake_refund')
+    assert not app.refund_stake('s1', 'dice_stake_refund')
+    assert bound_table['1']['balance'] == 100
+    # отменённая до списания ставка уже не спишется, даже если вызов дойдёт позже
+    assert not app.refund_stake('s2', 'dice_stake_refund')
+    assert not app.take_stake('1', 60, 'dice_stake', 's2')
+    assert bound_table['1']['balance'] == 100
+
+
+def test_lost_stake_reply_is_refunded(app, bound_table, monkeypatch):
+    bound_table['1001'] = {'nick': 'opponent', 'balance': 500}
+    sent = []
+
+    class LostReplyLink:
+        async def call(self, to, name, args):
+            # владелец списал ставку, а ответ до вызвавшего не дошёл
+            monkeypatch.setattr(app, 'SHARD_INDEX', to)
+            assert app.SHARD_CALLS[name](*args)
+            monkeypatch.setattr(app, 'SHARD_INDEX', 0)
+            raise asyncio.TimeoutError()
+
+    monkeypatch.setattr(app, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(app, 'SHARD_INDEX', 0)
+    monkeypatch.setattr(app, 'shard_link', LostReplyLink())
+    monkeypatch.setattr(app, '_shard_send', lambda to, message: sent.append((to, message)))
+    assert not asyncio.run(app._take_second_stake('1001', 300, 'dice_stake'))
+    assert bound_table['1001']['balance'] == 200
+    [(to, message)] = [(to, message) for to, message in sent if message['t'] != 'replica']
+    assert (to, message['t']) == (1, 'refund')
+    # отмену обрабатывает шард игрока
+    monkeypatch.setattr(app, 'SHARD_INDEX', 1)
+    app.refund_stake(message['stake'], message['reason'])
+    assert bound_table['1001']['balance'] == 500
+
+
+def test_delta_for_unknown_player_waits_for_record(app, bound_table, monkeypatch, tmp_path):
+    path = str(tmp_path / 'parked.json')
+    monkeypatch.setattr(app, 'SHARD_PARKED_DELTAS_FILE', path)
+    monkeypatch.setattr(app, '_parked_deltas', {})
+    app._apply_shard_delta({'t': 'delta', 'uid': '7', 'delta': 250, 'reason': 'transfer'})
+    assert app._settle_parked_deltas() == 0
+    app._load_parked_deltas()  # изменение пережило бы и перезапуск
+    assert app._parked_deltas == {'7': [[250, 'transfer']]}
+    bound_table['7'] = {'nick': 'late', 'balance': 100}
+    assert app._settle_parked_deltas() == 1
+    assert bound_table['7']['balance'] == 350
+    app._load_parked_deltas()
+    assert app._parked_deltas == {}
+
+
+def test_refused_second_stake_refunds_creator(app, bound_table, monkeypatch):
+    bound_table['111'] = {'nick': 'creator', 'balance': 500}
+    # копия второго игрока устарела: здесь деньги есть, а у владельца уже нет
+    bound_table['222'] = {'nick': 'opponent', 'balance': 500}
+    answers = []
+
+    async def refused(user_id, amount, reason, stake_id=None):
+        return False
+
+    async def answer(text=None, show_alert=None, **kwargs):
+        answers.append(text)
+
+    monkeypatch.setattr(app, 'take_stake_shared', refused)
+    for games, handler, action, chat_id in (
+            (app.dice_games, app.dice_accept, 'dice_accept', '-100'),
+            (app.basket_games, app.basket_accept, 'basket_accept', -100)):
+        games[chat_id] = {'initiator_id': '111', 'amount': 300, 'status': 'pending', 'message_id': None}
+        callback = SimpleNamespace(
+            data=app.game_button(action, '111'), from_user=SimpleNamespace(id=222), answer=answer,
+            message=SimpleNamespace(chat=SimpleNamespace(id=-100), answer=answer))
+        try:
+            asyncio.run(handler(callback))
+            assert games[chat_id]['status'] == 'pending'
+        finally:
+            games.pop(chat_id, None)
+
+    assert answers == ['у тебя недостаточно денег для ставки'] * 2
+    assert bound_table['111']['balance'] == 500
+    assert bound_table['222']['balance'] == 500
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# дочерний процесс: бесконечные активации промокодов через side_stores, после разогрева - READY
+CRASH_CHILD = '''
+import asyncio, sys
+sys.path.insert(0, sys.argv[1])
+import app
+
+async def activate_forever():
+    app.side_stores.start()
+    i = 0
+    while True:
+        i += 1
+        promo = app.promo_codes.setdefault(f'P{i % 50}', {
+            'reward': 1, 'activations': -1, 'current_activations': 0, 'expiry': None, 'used_by': []})
+        promo['used_by'].append(str(10**9 + i))
+        promo['current_activations'] += 1
+        app.save_promo_codes()
+        if i % 20 == 0:
+            await app.side_stores.flush()
+        if i == 500:
+            print('READY', flush=True)
+        await asyncio.sleep(0)
+
+asyncio.run(activate_forever())
+'''
+
+
+def _actor(app, tmp_path, data):
+    actor = app.SideStoreActor(interval_ms=50)
+    actor.register('promo_codes', str(tmp_path / 'promo_codes.json'), lambda: data)
+    return actor
+
+
+def _read(tmp_path):
+    with open(tmp_path / 'promo_codes.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_failed_write_keeps_previous_file(app, tmp_path, monkeypatch):
+    data = {'OLD': {'used_by': []}}
+    actor = _actor(app, tmp_path, data)
+    actor.mark('promo_codes')
+    assert _read(tmp_path) == data
+
+    def crash(*args):
+        # как будто процесс умер между записью временного файла и подменой
+        raise OSError(5, 'Input/output error')
+
+    monkeypatch.setattr(app.os, 'replace', crash)
+    data['NEW'] = {'used_by': ['1']}
+    actor.mark('promo_codes')
+    assert 'promo_codes' in actor.errors
+    assert _read(tmp_path) == {'OLD': {'used_by': []}}
+
+    monkeypatch.undo()
+    asyncio.run(actor.flush())
+    assert _read(tmp_path) == data
+
+
+def test_marks_are_batched_into_few_writes(app, tmp_path):
+    data = {'PROMO': {'used_by': []}}
+    actor = _actor(app, tmp_path, data)
+
+    async def scenario():
+        actor.start()
+        for i in range(1000):
+            data['PROMO']['used_by'].append(str(i))
+            actor.mark('promo_codes')
+            await asyncio.sleep(0)
+        await actor.flush()
+        await actor.drain()
+
+    asyncio.run(scenario())
+    assert actor.marks == 1000
+    assert actor.writes <= 3
+    assert len(_read(tmp_path)['PROMO']['used_by']) == 1000
+
+
+def test_flush_reports_failed_write(app, tmp_path, monkeypatch):
+    actor = _actor(app, tmp_path, {'PROMO': {}})
+
+    def no_space(*args):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(app, '_write_text_atomic', no_space)
+
+    async def scenario():
+        actor.start()
+        actor.mark('promo_codes')
+        try:
+            with pytest.raises(OSError):
+                await actor.flush()
+        finally:
+            actor.task.cancel()
+
+    asyncio.run(scenario())
+    assert actor.written['promo_codes'] < actor.versions['promo_codes']
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGKILL'), reason='нужен SIGKILL')
+def test_file_survives_kill_during_writes(tmp_path):
+    env = dict(os.environ, BOT_TOKEN='123456:TEST')
+    for delay in (0.0, 0.07, 0.2):
+        child = subprocess.Popen([sys.executable, '-c', CRASH_CHILD, ROOT], cwd=tmp_path, env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        for line in child.stdout:
+            if line.strip() == 'READY':
+                break
+        else:
+            pytest.fail(f'дочерний процесс завершился сам с кодом {child.wait()}')
+        time.sleep(delay)
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        # файл целый и согласованный: это одна из записанных версий, а не смесь двух
+        promo_codes = _read(tmp_path)
+        assert promo_codes
+        for promo in promo_codes.values():
+            assert len(promo['used_by']) == promo['current_activations']
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+
+import pytest
+
+
+def test_background_snapshot_is_consistent_with_its_start(app, monkeypatch):
+    storage = app.user_storage
+    if not hasattr(storage, 'write_snapshot'):
+        pytest.skip('фоновый снапшот только у json-хранилища')
+    app.users['900201'] = {'nick': 'cow_changed', 'balance': 100}
+    app.users['900202'] = {'nick': 'cow_deleted', 'balance': 5}
+    app.flush_user_changes('test')
+
+    thread_started = threading.Event()
+    handlers_done = threading.Event()
+    real_write = storage._write_snapshot_file
+
+    def paused_write(*args):
+        # поток уже начал снапшот - ждём, пока обработчики поменяют базу
+        thread_started.set()
+        handlers_done.wait(5)
+        return real_write(*args)
+
+    monkeypatch.setattr(storage, '_write_snapshot_file', paused_write)
+
+    async def scenario():
+        task = asyncio.create_task(storage.write_snapshot(app.users))
+        while not thread_started.is_set():
+            await asyncio.sleep(0.001)
+        app.credit('900201', 50, 'spin')
+        del app.users['900202']
+        app.users['900203'] = {'nick': 'cow_new', 'balance': 1}
+        app.flush_user_changes('spin')
+        handlers_done.set()
+        assert await task
+
+    asyncio.run(scenario())
+    snapshot = app._read_snapshot_file(storage.snapshot_path)
+    # в снапшоте - состояние на момент старта, изменения во время записи - в журнале
+    assert snapshot['900201']['balance'] == 100
+    assert snapshot['900202']['balance'] == 5
+    assert '900203' not in snapshot
+    reloaded = storage.load_all()
+    assert reloaded['900201']['balance'] == 150
+    assert '900202' not in reloaded
+    assert reloaded['900203']['balance'] == 1
+    assert storage.last_snapshot_copied == 3
@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def sqlite_storage(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'SQLITE_BUSY_TIMEOUT', 0.05)
+    monkeypatch.setattr(app, 'SQLITE_APPLY_RETRY_DELAY', 0.05)
+    storage = app.SqliteUserStorage(str(tmp_path / 'users.sqlite3'), str(tmp_path / 'mutations.jsonl'))
+    monkeypatch.setattr(app, 'user_storage', storage)
+    yield storage
+    storage.close()
+
+
+def _lock(storage):
+    """второй писатель держит базу, как соседний шард посреди транзакции"""
+    blocker = sqlite3.connect(storage.db_path, isolation_level=None, check_same_thread=False)
+    blocker.execute('BEGIN IMMEDIATE')
+    return blocker
+
+
+def test_apply_retries_while_database_is_busy(app, sqlite_storage):
+    app.users['910001'] = {'nick': 'sqlite_busy', 'balance': 3}
+    blocker = _lock(sqlite_storage)
+    threading.Timer(0.15, blocker.rollback).start()
+
+    assert app.flush_user_changes('test') >= 1
+    assert sqlite_storage.get('910001')['balance'] == 3
+    blocker.close()
+
+
+def test_locked_database_keeps_batch_for_next_flush(app, sqlite_storage):
+    app.users['910002'] = {'nick': 'sqlite_locked', 'balance': 4}
+    pending = len(app._pending_mutations)
+    blocker = _lock(sqlite_storage)
+
+    with pytest.raises(sqlite3.OperationalError):
+        app.flush_user_changes('test')
+    assert len(app._pending_mutations) == pending
+    assert sqlite_storage.get('910002') is None
+
+    blocker.rollback()
+    blocker.close()
+    assert app.flush_user_changes('test') == pending
+    assert sqlite_storage.get('910002')['balance'] == 4
+    with open(sqlite_storage.log_path, encoding='utf-8') as f:
+        assert sum('"910002"' in line for line in f) == 1  # неудачная попытка в журнал не попала
+
+
+def test_sortable_int_round_trip_and_order(app):
+    edge = 10**64
+    values = [-edge * 10**40, -edge - 1, -edge, -edge + 1, -10**15, -1, 0, 1, 9, 10,
+              10**15, edge - 1, edge, edge + 1, edge * 10**40]
+    encoded = [app._encode_sortable_int(value) for value in values]
+    assert [app._decode_sortable_int(text) for text in encoded] == values
+    assert sorted(encoded) == encoded
+    assert app._encode_sortable_int('x') is None
+
+
+def test_old_sortable_columns_are_reencoded(app, tmp_path):
+    path = str(tmp_path / 'old.sqlite3')
+    storage = app.SqliteUserStorage(path, str(tmp_path / 'mutations.jsonl'))
+    storage.put('1', {'nick': 'rich', 'balance': 10**70})
+    storage.put('2', {'nick': 'poor', 'balance': -5})
+    # база, записанная до перехода: 64 цифры и нет отметки формата
+    storage.conn.execute("UPDATE users SET balance = 'p' || substr(printf('%064d', 0), 1, 64)")
+    storage.conn.execute('DELETE FROM storage_meta')
+    storage.conn.commit()
+    storage.close()
+
+    storage = app.SqliteUserStorage(path, str(tmp_path / 'mutations.jsonl'))
+    try:
+        assert [user_id for user_id, _ in storage.query(order_by='balance', descending=True)] == ['1', '2']
+    finally:
+        storage.close()
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def test_lookup_ignores_case(app, bound_table):
+    bound_table['1'] = {'nick': 'Straße', 'tg_username': 'BigBoss', 'balance': 0}
+    assert app.find_user_id(username='bigboss') == '1'
+    assert app.find_user_id(username='BIGBOSS') == '1'
+    assert app.find_user_id(nick='STRASSE') == '1'  # casefold, а не lower
+    assert app.find_user_id(username='без_юз') is None
+    # совпадение по юзернейму важнее совпадения по нику
+    bound_table['2'] = {'nick': 'bigboss', 'tg_username': 'other', 'balance': 0}
+    assert app.find_user_id(username='BigBoss', nick='BigBoss') == '1'
+    assert app.find_user_id(username='nobody', nick='BigBoss') == '2'
+
+
+def test_duplicate_username_goes_to_earliest_registered(app, bound_table):
+    for user_id in ('30', '10', '20', '40'):
+        bound_table[user_id] = {'nick': f'n{user_id}', 'tg_username': 'Dup', 'balance': 0}
+    assert app.find_user_id(username='dup') == '30'
+    # первый владелец сменил юзернейм - ключ у следующего по регистрации, а не у случайного из дублей
+    bound_table['30']['tg_username'] = 'fresh'
+    assert app.find_user_id(username='dup') == '10'
+    # вернул старый - снова владелец, потому что зарегистрирован раньше остальных
+    bound_table['30']['tg_username'] = 'DUP'
+    assert app.find_user_id(username='dup') == '30'
+    del bound_table['30']
+    del bound_table['10']
+    assert app.find_user_id(username='dup') == '20'
+    assert app.user_index.check() == []
+
+
+def test_taken_nick_is_refused_in_any_case(app, bound_table):
+    bound_table['1'] = app.new_user_record({'nick': 'Taken', 'tg_username': 'first', 'balance': 0})
+    answers = []
+
+    async def answer(text, **kwargs):
+        answers.append(text)
+
+    async def set_state(*args, **kwargs):
+        pass
+
+    def register(user_id: int, nick: str):
+        message = SimpleNamespace(
+            text=nick, answer=answer, chat=SimpleNamespace(type='private'),
+            from_user=SimpleNamespace(id=user_id, username=f'u{user_id}', language_code='ru'))
+        asyncio.run(app.process_nick(message, SimpleNamespace(clear=set_state, set_state=set_state)))
+
+    register(2, ' tAKEN ')
+    assert answers == ['этот ник уже занят, выбери другой']
+    assert '2' not in bound_table
+    answers.clear()
+    register(2, 'free')
+    assert 'этот ник уже занят, выбери другой' not in answers
+    assert app.find_user_id(nick='FREE') == '2'
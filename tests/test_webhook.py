@@ -0,0 +1,80 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+# обновление в том виде, в каком его присылает телеграм
+UPDATE = {
+    'update_id': 100,
+    'message': {
+        'message_id': 7, 'date': 1700000000, 'text': 'б',
+        'chat': {'id': 42, 'type': 'private', 'first_name': 'x'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'x', 'username': 'u42'},
+    },
+}
+
+
+class FakeDispatcher:
+    """запоминает обновления; пока release не выставлен, обработка висит"""
+
+    def __init__(self):
+        self.updates = []
+        self.release = asyncio.Event()
+
+    async def feed_update(self, bot, update):
+        await self.release.wait()
+        self.updates.append(update)
+
+
+def _run(app, scenario, **kwargs):
+    async def wrapper():
+        dispatcher = FakeDispatcher()
+        server = app.WebhookServer(dispatcher, app.bot, **kwargs)
+        async with TestClient(TestServer(server.app())) as client:
+            return await scenario(client, server, dispatcher)
+    return asyncio.run(wrapper())
+
+
+def _post(app, client, secret='s', data=None, body=None):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret is not None else {}
+    if body is not None:
+        return client.post(app.WEBHOOK_PATH, data=body, headers=headers)
+    return client.post(app.WEBHOOK_PATH, json=UPDATE if data is None else data, headers=headers)
+
+
+def test_webhook_statuses(app):
+    async def scenario(client, server, dispatcher):
+        statuses = {}
+        statuses['no secret'] = (await _post(app, client, secret=None)).status
+        statuses['wrong secret'] = (await _post(app, client, secret='x')).status
+        statuses['bad json'] = (await _post(app, client, body=b'{')).status
+        statuses['not update'] = (await _post(app, client, data={'update_id': 'x'})).status
+        statuses['ok'] = (await _post(app, client)).status
+        # первое обновление ещё обрабатывается, очередь (1) полна
+        statuses['backlog'] = (await _post(app, client)).status
+        dispatcher.release.set()
+        await asyncio.wait(set(server.tasks))
+        return statuses, dispatcher.updates, server
+
+    statuses, updates, server = _run(app, scenario, secret='s', max_backlog=1)
+    assert statuses == {'no secret': 401, 'wrong secret': 401, 'bad json': 400,
+                        'not update': 400, 'ok': 200, 'backlog': 503}
+    assert [update.update_id for update in updates] == [100]
+    assert updates[0].message.from_user.id == 42
+    assert (server.received, server.processed, server.rejected) == (1, 1, 1)
+
+
+def test_webhook_refuses_to_start_without_secret(app):
+    assert app.webhook_config_error(url='https://bot.example.com/webhook', host='0.0.0.0', secret='')
+    assert app.webhook_config_error(url='', host='0.0.0.0', secret='')
+    assert app.webhook_config_error(url='', host='127.0.0.1', secret='') is None
+    assert app.webhook_config_error(url='https://bot.example.com/webhook', host='0.0.0.0', secret='s') is None
+
+    async def scenario():
+        server = app.WebhookServer(FakeDispatcher(), app.bot, secret='')
+        try:
+            await server.start(host='0.0.0.0', port=0)
+        except RuntimeError:
+            return server.runner
+        raise AssertionError('сервер запустился без секрета')
+
+    assert asyncio.run(scenario()) is None
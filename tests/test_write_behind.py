@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import pytest
+
+
+def _no_space(*args):
+    raise OSError(28, 'No space left on device')
+
+
+def test_failed_apply_keeps_batch_for_next_flush(app, monkeypatch):
+    app.users['900001'] = {'nick': 'flush_keep', 'balance': 10}
+    app.credit('900001', 5, 'test')
+    pending = len(app._pending_mutations)
+    assert pending >= 2
+
+    monkeypatch.setattr(app.user_storage, 'apply', _no_space)
+    with pytest.raises(OSError):
+        app.flush_user_changes('test')
+    assert len(app._pending_mutations) == pending
+
+    monkeypatch.undo()
+    assert app.flush_user_changes('test') == pending
+    assert not app._pending_mutations
+    assert app.user_storage.load_all()['900001']['balance'] == 15
+
+
+def test_write_behind_retries_failed_flush(app, monkeypatch):
+    monkeypatch.setattr(app, 'USERS_FLUSH_RETRY_DELAY', 0.01)
+    real_apply = app.user_storage.apply
+    failures = []
+
+    def flaky(batch, reason, current):
+        if not failures:
+            failures.append(len(batch))
+            _no_space()
+        real_apply(batch, reason, current)
+
+    monkeypatch.setattr(app.user_storage, 'apply', flaky)
+
+    async def scenario():
+        write_behind = app.UsersWriteBehind(interval_ms=1)
+        write_behind.start()
+        app.users['900002'] = {'nick': 'flush_retry', 'balance': 1}
+        write_behind.mark_dirty()
+        # новых отметок нет - повторить запись задача должна сама
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if not app._pending_mutations:
+                break
+        write_behind.task.cancel()
+
+    asyncio.run(scenario())
+    assert failures
+    assert not app._pending_mutations
+    assert app.user_storage.load_all()['900002']['balance'] == 1
+
+
+def test_partial_journal_write_is_rolled_back(app, monkeypatch):
+    storage = app.user_storage
+    if storage.name != 'json':
+        pytest.skip('журнал только у json-хранилища')
+    app.flush_user_changes('test')
+    app.users['900003'] = {'nick': 'flush_torn', 'balance': 7}
+    real_file = open(storage.journal_path, 'a', encoding='utf-8')
+
+    class TornFile:
+        """пишет половину пачки и падает, как при кончившемся месте"""
+        closed = False
+
+        def tell(self):
+            return real_file.tell()
+
+        def write(self, text):
+            real_file.write(text[:len(text) // 2])
+            real_file.flush()
+            _no_space()
+
+        def close(self):
+            real_file.close()
+
+    storage._journal_file = TornFile()
+    with pytest.raises(OSError):
+        app.flush_user_changes('test')
+    app.flush_user_changes('test')
+
+    with open(storage.journal_path, encoding='utf-8') as f:
+        for line in f:
+            json.loads(line)  # ни одной склеенной строки
+    assert storage.load_all()['900003']['balance'] == 7